@@ -1,5 +1,3 @@
-from .pygrowup import Calculator
-
 __version_info__ = {
     'major': 0,
     'minor': 8,
@@ -19,3 +17,13 @@ def get_version(short=False):
     return ''.join(vers)
 
 __version__ = get_version()
+
+
+def __getattr__(name):
+    # defer importing the calculator (and decimal, tables, etc.)
+    # until it is used
+    if name in ['Calculator', 'BELOW_3SD', 'BELOW_2SD', 'NORMAL',
+                'ABOVE_2SD', 'ABOVE_3SD']:
+        from . import pygrowup
+        return getattr(pygrowup, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
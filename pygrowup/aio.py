@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+""" asyncio interface to a Calculator.
+
+AsyncCalculator collects the z-scores awaited by concurrent callers for a
+short time (max_delay seconds) or until max_batch_size are waiting, and
+calculates them together in an executor, so calculations do not block the
+event loop and many callers share the cost of one call to the executor::
+
+    calculator = AsyncCalculator(Calculator(engine='float'))
+
+    async def handle(request):
+        zscore = await calculator.wfa(weight, age_in_months, sex)
+
+Each caller gets its own z-score, or its own exception (e.g.,
+InvalidMeasurement). With the float engine and numpy installed, batches
+are calculated with Calculator.zscores.
+"""
+import asyncio
+import functools
+
+from . import parallel
+from .pygrowup import Calculator
+
+
+class AsyncCalculator(object):
+
+    def __init__(self, calculator=None, max_batch_size=256, max_delay=0.001,
+                 executor=None):
+        assert max_batch_size > 0
+        assert max_delay >= 0
+        self.calculator = calculator or Calculator()
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        # None for the event loop's default executor
+        self.executor = executor
+
+        # observations and futures waiting to be calculated
+        self._pending = []
+        self._timer = None
+        self._running = set()
+        # counts of z-scores and of batches calculated
+        self.calls = 0
+        self.batches = 0
+
+    def zscore(self, indicator, measurement, age_in_months, sex,
+               height=None):
+        """ Calculate a z-score, as Calculator.zscore_for_measurement.
+
+        Returns an asyncio.Future of the z-score (to be awaited in the
+        running event loop). """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((indicator, measurement, age_in_months, sex,
+                               height), future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+        return future
+
+    # convenience methods (which return awaitables)
+    def lhfa(self, measurement=None, age_in_months=None, sex=None,
+             height=None):
+        return self.zscore('lhfa', measurement, age_in_months, sex, height)
+
+    def wfl(self, measurement=None, age_in_months=None, sex=None,
+            height=None):
+        return self.zscore('wfl', measurement, age_in_months, sex, height)
+
+    def wfh(self, measurement=None, age_in_months=None, sex=None,
+            height=None):
+        return self.zscore('wfh', measurement, age_in_months, sex, height)
+
+    def wfa(self, measurement=None, age_in_months=None, sex=None,
+            height=None):
+        return self.zscore('wfa', measurement, age_in_months, sex, height)
+
+    def bmifa(self, measurement=None, age_in_months=None, sex=None,
+              height=None):
+        return self.zscore('bmifa', measurement, age_in_months, sex, height)
+
+    def hcfa(self, measurement=None, age_in_months=None, sex=None,
+             height=None):
+        return self.zscore('hcfa', measurement, age_in_months, sex, height)
+
+    async def drain(self):
+        """ Calculate any waiting z-scores now, and wait for all
+        calculations to finish """
+        self._flush()
+        while self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            batch = self._pending[:self.max_batch_size]
+            del self._pending[:self.max_batch_size]
+            task = asyncio.ensure_future(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        observations = [observation for observation, future in batch]
+        try:
+            results = await loop.run_in_executor(
+                self.executor, functools.partial(self.calculate,
+                                                 observations))
+        except Exception as e:
+            results = [(None, e)] * len(batch)
+        self.calls += len(batch)
+        self.batches += 1
+        for (observation, future), (zscore, error) in zip(batch, results):
+            if future.done():
+                # (e.g., the caller was cancelled)
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(zscore)
+
+    def calculate(self, observations):
+        """ Calculate z-scores for a list of (indicator, measurement,
+        age_in_months, sex, height) tuples, returning a list of
+        (zscore, exception) tuples (see parallel.score) """
+        return parallel.score(self.calculator, observations)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+""" Vectorized z-score calculations for arrays of observations.
+
+This module requires numpy, and is imported by Calculator only when
+one of its batch methods is called.
+"""
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    raise ImportError("pygrowup batch calculations require numpy "
+                      "(e.g., pip install pygrowup[numpy])")
+
+from . import exceptions
+from . import routing
+from . import tablestore
+
+
+def as_float_array(values):
+    """ Cast a sequence of numbers or numeric strings to a float64 array,
+    treating blanks and None as missing (NaN). """
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        pass
+    result = np.empty(len(values), dtype=np.float64)
+    for i, value in enumerate(values):
+        try:
+            result[i] = float(value)
+        except (TypeError, ValueError):
+            result[i] = np.nan
+    return result
+
+
+def as_sex_array(values):
+    """ Cast a sequence of sexes to an array of upper-cased strings. """
+    return np.char.upper(np.asarray(values).astype(str))
+
+
+def age_buckets(ages, weeks):
+    """ Vectorized routing.age_bucket: return an array of the buckets of
+    arrays of ages in months and in weeks """
+    return np.select([weeks <= 13, ages < 24, ages <= 60, ages <= 240],
+                     [routing.WEEKS, routing.UNDER_24, routing.TO_60,
+                      routing.TO_240], routing.OVER_240)
+
+
+def height_bands(indicator, heights):
+    """ Vectorized routing.height_band """
+    if indicator == "wfl":
+        standing = heights > 86
+    else:
+        standing = heights >= 65
+    return np.where(standing, routing.STANDING, routing.RECUMBENT)
+
+
+def locate(calculator, indicator, measurements, ages, sexes, heights=None):
+    """ Find the table row for each of equal-length arrays of observations.
+
+    Returns the measurements (as a float64 array, adjusted for the
+    indicator) and a list of (table, rows, positions) tuples, grouping
+    the indices of rows by their table along with the positions of their
+    rows in the table. Rows that cannot be scored are in no group. """
+    assert indicator is not None
+    assert isinstance(indicator, str)
+    assert indicator.lower() in routing.INDICATORS
+    indicator = indicator.lower()
+
+    y = as_float_array(measurements)
+    ages = as_float_array(ages)
+    sexes = as_sex_array(sexes)
+    if heights is None:
+        heights = np.full(y.shape, np.nan)
+    else:
+        heights = as_float_array(heights)
+    assert y.shape == ages.shape == sexes.shape == heights.shape
+
+    # indicator-specific methodology, as in Calculator.zscore_for_measurement
+    if indicator == "wfl":
+        y = np.where((y > 65.7) & (y < 120.7), y - 0.7, y)
+    if indicator == "wfh" and calculator.adjust_height_data:
+        y = y + 0.7
+
+    days = None
+    if calculator.age_in_days:
+        days = ages
+        ages = days / tablestore.DAYS_PER_MONTH
+        weeks = days / tablestore.DAYS_PER_WEEK
+    else:
+        weeks = (ages * tablestore.DAYS_PER_MONTH) / tablestore.DAYS_PER_WEEK
+    valid = ~np.isnan(ages)
+    if indicator in ["wfl", "wfh"]:
+        valid &= ~np.isnan(heights)
+        buckets = height_bands(indicator, heights)
+        out_of_range = (heights < 45) | (heights > 120)
+        # round to the closest half centimeter
+        keys = np.floor(heights / 0.5 + 0.5) * 0.5
+    else:
+        buckets = age_buckets(ages, weeks)
+        out_of_range = np.zeros(y.shape, dtype=bool)
+        if days is not None:
+            keys = np.floor(days)
+        else:
+            keys = np.where(buckets == routing.WEEKS, np.floor(weeks),
+                            np.floor(ages))
+    usable = valid & (y > 0) & ~out_of_range
+
+    groups = []
+    for bucket, sex, route in routing.routes(indicator,
+                                             bool(calculator.include_cdc)):
+        if route.error is not None:
+            # (e.g., InvalidAge in the scalar path)
+            continue
+        rows = np.flatnonzero(usable & (buckets == bucket) & (sexes == sex))
+        if not rows.size:
+            continue
+        try:
+            table = calculator.table(route.table_name)
+        except exceptions.DataNotFound:
+            continue
+        if days is not None and indicator not in ["wfl", "wfh"]:
+            table = table.days()
+        positions = (keys[rows] - table.start) / table.step
+        found = ((positions == np.floor(positions)) & (positions >= 0) &
+                 (positions < len(table)))
+        groups.append((table, rows[found], positions[found].astype(np.intp)))
+    return y, groups
+
+
+def gather(groups, columns, count, size):
+    """ Gather values from a count of table columns (e.g., for count 1,
+    lambda table: [table.L]) into float64 arrays with a value for each
+    row (NaN if none). """
+    gathered = [np.full(size, np.nan) for i in range(count)]
+    for table, rows, positions in groups:
+        for values, column in zip(gathered, columns(table)):
+            values[rows] = np.frombuffer(column, dtype=np.float64)[positions]
+    return gathered
+
+
+def zscores(calculator, indicator, measurements, ages, sexes, heights=None):
+    """ Calculate z-scores for equal-length arrays of observations.
+
+    See Calculator.zscores """
+    y, groups = locate(calculator, indicator, measurements, ages, sexes,
+                       heights)
+    L, M, S = gather(groups, lambda table: [table.L, table.M, table.S], 3,
+                     y.size)
+
+    #           [y/M(t)]^L(t) - 1
+    #   Zind =  -----------------
+    #               S(t)L(t)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = ((y / M) ** L - 1) / (S * L)
+
+        if calculator.adjust_weight_scores and indicator.lower() in [
+                "wfl", "wfh", "wfa"]:
+            # restricted application of the LMS method for weight-based
+            # indicators (see Calculator.zscore_for_measurement)
+            SD3neg, SD23neg, SD3pos, SD23pos = gather(
+                groups, lambda table: table.tails(), 4, y.size)
+            above = result > 3
+            if above.any():
+                adjusted = 3 + (y - SD3pos) / SD23pos
+                result = np.where(above, adjusted, result)
+            below = result < -3
+            if below.any():
+                adjusted = -3 + (y - SD3neg) / SD23neg
+                result = np.where(below, adjusted, result)
+
+    # round to hundredth, as the scalar path does
+    return np.round(result, 2)
+
+
+def all_zscores(calculator, weights=None, lengths_or_heights=None,
+                head_circumferences=None, ages=None, sexes=None):
+    """ Calculate every z-score equal-length arrays of observations allow.
+
+    See Calculator.all_zscores_batch """
+    assert ages is not None
+    assert sexes is not None
+    # (converted once for all indicators)
+    ages = as_float_array(ages)
+    sexes = as_sex_array(sexes)
+    nan = np.full(ages.shape, np.nan)
+    weights = nan if weights is None else as_float_array(weights)
+    heights = nan if lengths_or_heights is None else \
+        as_float_array(lengths_or_heights)
+    assert weights.shape == heights.shape == ages.shape == sexes.shape
+
+    results = {}
+    if lengths_or_heights is not None:
+        results["lhfa"] = zscores(calculator, "lhfa", heights, ages, sexes)
+    if weights is not None:
+        results["wfa"] = zscores(calculator, "wfa", weights, ages, sexes)
+    if weights is not None and lengths_or_heights is not None:
+        # weight-for-length under 24 months, and weight-for-height after
+        months = ages / tablestore.DAYS_PER_MONTH if \
+            calculator.age_in_days else ages
+        for indicator, rows in [("wfl", np.flatnonzero(months < 24)),
+                                ("wfh", np.flatnonzero(months >= 24))]:
+            results[indicator] = nan.copy()
+            results[indicator][rows] = zscores(
+                calculator, indicator, weights[rows], ages[rows],
+                sexes[rows], heights[rows])
+        #   BMI = weight (kg) / length or height (m) ^ 2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bmis = np.where(heights > 0, weights / (heights / 100) ** 2,
+                            np.nan)
+        results["bmifa"] = zscores(calculator, "bmifa", bmis, ages, sexes)
+    if head_circumferences is not None:
+        results["hcfa"] = zscores(calculator, "hcfa",
+                                  as_float_array(head_circumferences), ages,
+                                  sexes)
+    return results
+
+
+def classify(calculator, indicator, measurements, ages, sexes, heights=None):
+    """ Classify equal-length arrays of observations.
+
+    See Calculator.classify_batch """
+    y, groups = locate(calculator, indicator, measurements, ages, sexes,
+                       heights)
+    adjusted = (calculator.adjust_weight_scores and
+                indicator.lower() in ["wfl", "wfh", "wfa"])
+    SD3neg, SD2neg, SD2pos, SD3pos = gather(
+        groups, lambda table: table.cutoffs(adjusted), 4, y.size)
+    result = np.full(y.size, np.nan)
+    result[~np.isnan(SD2neg)] = 0
+    result[y > SD2pos] = 2
+    result[y > SD3pos] = 3
+    result[y < SD2neg] = -2
+    result[y < SD3neg] = -3
+    return result
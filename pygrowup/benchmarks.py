@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+""" Benchmarks of pygrowup's start-up time, calculations, and memory use.
+
+Run the benchmarks and save the results as JSON::
+
+    $ python -m pygrowup.benchmarks -o before.json
+
+and, after making changes, run them again and compare (the exit status is
+1 if any benchmark is more than --threshold slower or larger)::
+
+    $ python -m pygrowup.benchmarks -o after.json --compare before.json
+
+Workloads are the observations in testdata/survey_z_rc.csv, copied --scale
+times with random (but repeatable) variations of their ages and
+measurements. Every metric is a time in seconds or a size in bytes, so
+lower is better.
+"""
+import os
+import csv
+import sys
+import json
+import time
+import pickle
+import random
+import argparse
+import platform
+import subprocess
+import concurrent.futures
+
+from . import __version__
+
+INDICATORS = ["lhfa", "wfl", "wfh", "wfa", "bmifa", "hcfa"]
+
+module_dir = os.path.split(os.path.abspath(__file__))[0]
+project_dir = os.path.dirname(module_dir)
+survey_path = os.path.join(module_dir, 'testdata', 'survey_z_rc.csv')
+
+
+def survey(path=survey_path):
+    """ Return the observations in a survey file as a list of dicts of
+    sex, age, weight, height, head_circumference, and bmi (strings, or
+    None if blank) """
+    observations = []
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        for row in csv.DictReader(f):
+            sex = {'1': 'M', '2': 'F'}.get(row['GENDER'].strip())
+            if sex is None or not row['agemons'].strip():
+                continue
+            observations.append({
+                'sex': sex,
+                'age': row['agemons'].strip(),
+                'weight': row['WEIGHT'].strip() or None,
+                'height': row['HEIGHT'].strip() or None,
+                'head_circumference': row['HEAD'].strip() or None,
+                'bmi': row['_CBMI'].strip() or None})
+    return observations
+
+
+def scale(observations, times, seed=0, factor=None):
+    """ Return observations copied times over, with ages varied by up to
+    half a month and measurements by up to 5% (or multiplied by factor,
+    e.g., to make z-scores beyond +/- 3) """
+    rng = random.Random(seed)
+    scaled = []
+    for i in range(times):
+        for observation in observations:
+            copy = dict(observation)
+            copy['age'] = '%.2f' % max(
+                0, float(observation['age']) + rng.uniform(-0.5, 0.5))
+            for name in ['weight', 'height', 'head_circumference', 'bmi']:
+                if observation[name] is None:
+                    continue
+                value = float(observation[name])
+                if name == 'height':
+                    # keep heights within the wfl/wfh tables
+                    value = min(max(value * rng.uniform(0.95, 1.05), 45), 120)
+                elif factor is not None:
+                    value *= factor
+                else:
+                    value *= rng.uniform(0.95, 1.05)
+                copy[name] = '%.1f' % value
+            scaled.append(copy)
+    return scaled
+
+
+def workload(observations, indicator):
+    """ Return (measurement, age, sex, height) tuples of the observations
+    which have the measurements an indicator needs """
+    measurement = {"lhfa": "height", "wfl": "weight", "wfh": "weight",
+                   "wfa": "weight", "bmifa": "bmi",
+                   "hcfa": "head_circumference"}[indicator]
+    rows = []
+    for observation in observations:
+        if observation[measurement] is None:
+            continue
+        height = None
+        if indicator in ["wfl", "wfh"]:
+            height = observation['height']
+            if height is None:
+                continue
+        rows.append((observation[measurement], observation['age'],
+                     observation['sex'], height))
+    return rows
+
+
+def best_of(repeat, function):
+    """ Return the shortest time of repeat calls of function """
+    times = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def per_call(repeat, calculator, indicator, rows):
+    """ Return the best time per zscore_for_measurement call over rows """
+    zscore = calculator.zscore_for_measurement
+
+    def run():
+        for measurement, age, sex, height in rows:
+            try:
+                zscore(indicator, measurement, age, sex, height)
+            except RuntimeError:
+                pass
+    return best_of(repeat, run) / len(rows)
+
+
+def in_subprocess(code, repeat):
+    """ Run code in fresh interpreters, returning the smallest value it
+    prints """
+    values = []
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [project_dir] + [path for path in [env.get('PYTHONPATH')] if path])
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         env=env)
+        values.append(float(output))
+    return min(values)
+
+
+IMPORT_CODE = """
+import time
+started = time.perf_counter()
+import pygrowup
+print(time.perf_counter() - started)
+"""
+
+FIRST_ZSCORE_CODE = """
+import time
+started = time.perf_counter()
+from pygrowup import Calculator
+Calculator().wfa('8.0', 9, 'M')
+print(time.perf_counter() - started)
+"""
+
+# unpickling a Calculator and loading its tables, as a worker process does
+# (see parallel.map_zscores)
+WORKER_CODE = """
+import time
+import pickle
+started = time.perf_counter()
+calculator = pickle.loads(%r)
+calculator.load_tables()
+print(time.perf_counter() - started)
+"""
+
+# resident memory of all of the tables, once they have been read
+TABLES_RSS_CODE = """
+import gc
+import resource
+import sys
+from pygrowup import tablestore
+
+def rss():
+    if sys.platform.startswith('linux'):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    # (ru_maxrss is in bytes on macOS)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+gc.collect()
+before = rss()
+total = 0
+for name in tablestore.TABLE_FILES:
+    for column in tablestore.registry.get(name).columns.values():
+        total += sum(column)
+print(rss() - before)
+"""
+
+
+def run(scale_by=10, repeat=3, include_batch=True):
+    """ Run the benchmarks, returning a dict of metric names and values """
+    from .pygrowup import Calculator
+    from . import tablestore
+
+    metrics = {}
+    metrics['startup.import'] = in_subprocess(IMPORT_CODE, repeat)
+    metrics['startup.first_zscore'] = in_subprocess(FIRST_ZSCORE_CODE,
+                                                    repeat)
+    metrics['startup.worker'] = in_subprocess(
+        WORKER_CODE % pickle.dumps(Calculator()), repeat)
+    metrics['startup.construct'] = best_of(
+        repeat, lambda: [Calculator() for i in range(1000)]) / 1000
+
+    try:
+        import resource
+    except ImportError:
+        pass
+    else:
+        metrics['memory.tables_rss'] = in_subprocess(TABLES_RSS_CODE, 1)
+    metrics['memory.tables_bytes'] = sum(
+        column.nbytes for name in tablestore.TABLE_FILES
+        for column in tablestore.registry.get(name).columns.values())
+
+    observations = scale(survey(), scale_by)
+    for engine in ['decimal', 'float']:
+        calculator = Calculator(engine=engine, log_level='ERROR')
+        for indicator in INDICATORS:
+            metrics['scalar.%s.%s' % (engine, indicator)] = per_call(
+                repeat, calculator, indicator,
+                workload(observations, indicator))
+    # the decimal engine's reduced precision tier
+    calculator = Calculator(precision='fast', log_level='ERROR')
+    for indicator in INDICATORS:
+        metrics['scalar.fast.%s' % indicator] = per_call(
+            repeat, calculator, indicator, workload(observations, indicator))
+
+    # the restricted LMS method for z-scores beyond +/- 3
+    heavy = scale(survey(), scale_by, factor=1.6)
+    light = scale(survey(), scale_by, factor=0.55)
+    for engine, precision in [('decimal', 'exact'), ('fast', 'fast'),
+                              ('float', 'exact')]:
+        calculator = Calculator(engine='float' if engine == 'float' else
+                                'decimal', precision=precision,
+                                adjust_weight_scores=True, log_level='ERROR')
+        for indicator in ["wfl", "wfh", "wfa"]:
+            metrics['adjust.%s.%s' % (engine, indicator)] = per_call(
+                repeat, calculator, indicator,
+                workload(heavy, indicator) + workload(light, indicator))
+
+    # one calculator shared by several threads (which only run at once
+    # on free-threaded builds of Python)
+    rows = workload(observations, 'wfa')
+    chunks = [rows[i:i + 100] for i in range(0, len(rows), 100)]
+    for engine in ['decimal', 'float']:
+        calculator = Calculator(engine=engine, log_level='ERROR')
+        for threads in [1, 4]:
+            with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                metrics['threads.%s.%d' % (engine, threads)] = best_of(
+                    repeat, lambda: list(executor.map(
+                        lambda chunk: per_call(1, calculator, 'wfa', chunk),
+                        chunks))) / len(rows)
+
+    if include_batch:
+        try:
+            import numpy
+        except ImportError:
+            pass
+        else:
+            calculator = Calculator(log_level='ERROR')
+            for indicator in INDICATORS:
+                rows = workload(observations, indicator)
+                columns = [list(column) for column in zip(*rows)]
+                metrics['batch.%s' % indicator] = best_of(
+                    repeat, lambda: calculator.zscores(indicator, *columns)
+                ) / len(rows)
+    return metrics
+
+
+def compare(metrics, baseline, threshold=0.1):
+    """ Return a list of (name, baseline value, value, ratio) for metrics
+    which are more than threshold (a fraction) worse than baseline """
+    regressions = []
+    for name, value in sorted(metrics.items()):
+        if not baseline.get(name):
+            continue
+        ratio = value / baseline[name]
+        if ratio > 1 + threshold:
+            regressions.append((name, baseline[name], value, ratio))
+    return regressions
+
+
+def describe(value, name):
+    if name.startswith('memory.'):
+        return '%.1f KB' % (value / 1024.0)
+    if value < 1e-3:
+        return '%.2f us' % (value * 1e6)
+    return '%.2f ms' % (value * 1e3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pygrowup.benchmarks',
+        description='Benchmark pygrowup and save the results as JSON.')
+    parser.add_argument('-o', '--output',
+                        help='file to save results to (default: stdout)')
+    parser.add_argument('--scale', type=int, default=10,
+                        help='copies of the survey observations to make '
+                             '(default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times to run each benchmark, keeping the '
+                             'best (default: %(default)s)')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='results file to compare results to')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fraction by which a metric may exceed '
+                             'BASELINE before it is a regression '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    metrics = run(scale_by=args.scale, repeat=args.repeat)
+    results = {
+        'pygrowup': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'metrics': metrics,
+    }
+    text = json.dumps(results, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['metrics']
+        for name, value in sorted(metrics.items()):
+            if baseline.get(name):
+                sys.stderr.write('%-28s %12s %12s %+7.1f%%\n' % (
+                    name, describe(baseline[name], name),
+                    describe(value, name),
+                    (value / baseline[name] - 1) * 100))
+        regressions = compare(metrics, baseline, args.threshold)
+        for name, before, after, ratio in regressions:
+            sys.stderr.write('REGRESSION %s: %s -> %s\n' % (
+                name, describe(before, name), describe(after, name)))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
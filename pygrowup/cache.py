@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+""" Caches of calculated z-scores (see Calculator's cache_size and cache).
+
+LRUCache keeps z-scores in memory. SQLiteCache keeps them in a SQLite
+database file, so z-scores calculated in one run (e.g., of a nightly job
+over a whole database) are reused by the next, and only the observations
+that changed are calculated again.
+"""
+import decimal
+import sqlite3
+import threading
+import contextlib
+import collections
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    """ A size-bounded mapping which evicts its least recently used items.
+
+    get and put may be called from any number of threads, so a cache can
+    be shared by Calculators used in several threads. """
+
+    def __init__(self, maxsize=1024):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self._init()
+
+    def _init(self):
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return the value cached for key, or None """
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """ Cache value for key, evicting the least recently used item
+        if the cache is full """
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def info(self):
+        """ Return the cache's CacheInfo(hits, misses, evictions, maxsize,
+        currsize) """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self._items))
+
+    def clear(self):
+        """ Empty the cache and reset its counters """
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getstate__(self):
+        # copies (e.g., for worker processes) start empty
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.maxsize = state['maxsize']
+        self._init()
+
+
+# (normalizes decimals without rounding them)
+KEY_CONTEXT = decimal.Context(prec=decimal.MAX_PREC, Emax=decimal.MAX_EMAX,
+                              Emin=decimal.MIN_EMIN)
+
+
+def encode_key(key):
+    """ Return a cache key (see Calculator._cache_key) as a string, with
+    equal numbers (e.g., Decimal('8') and Decimal('8.0')) encoded alike """
+    return '|'.join([
+        str(part.normalize(KEY_CONTEXT)) if isinstance(part, decimal.Decimal)
+        else '' if part is None else str(part) for part in key])
+
+
+class SQLiteCache(object):
+    """ A persistent cache of z-scores in a SQLite database file.
+
+    The cache records the version of the tables its z-scores were
+    calculated with (by default, tablestore.registry.version()), and is
+    emptied when it is opened with other tables. Calculator settings are
+    part of each key, so calculators with different settings can share a
+    cache.
+
+    get_many and put_many read or write any number of z-scores in one
+    transaction, which is much faster than calling get and put for each.
+    Like LRUCache, a SQLiteCache may be shared by several threads, and is
+    never full (maxsize is None). """
+
+    maxsize = None
+
+    def __init__(self, path, version=None):
+        if version is None:
+            from . import tablestore
+            version = tablestore.registry.version()
+        self.path = path
+        self.version = version
+        self._init()
+
+    def _init(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(self.path, timeout=60,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        # (so readers do not wait for writers, and commits are not
+        # synced to disk until a checkpoint)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction():
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta '
+                             '(name TEXT PRIMARY KEY, value TEXT)')
+            # values are TEXT for decimals and REAL for floats
+            self._db.execute('CREATE TABLE IF NOT EXISTS zscores '
+                             '(key TEXT PRIMARY KEY, value) WITHOUT ROWID')
+            row = self._db.execute("SELECT value FROM meta "
+                                   "WHERE name = 'version'").fetchone()
+            if row is None or row[0] != self.version:
+                self._db.execute('DELETE FROM zscores')
+                self._db.execute("INSERT OR REPLACE INTO meta "
+                                 "VALUES ('version', ?)", (self.version,))
+
+    @contextlib.contextmanager
+    def _transaction(self, mode='IMMEDIATE'):
+        with self._lock:
+            self._db.execute('BEGIN ' + mode)
+            try:
+                yield
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def get(self, key):
+        """ Return the value cached for key, or None """
+        return self.get_many([key])[0]
+
+    def put(self, key, value):
+        """ Cache value for key """
+        self.put_many([(key, value)])
+
+    def get_many(self, keys):
+        """ Return a list of the values cached for a list of keys (None
+        for keys which are not cached, or are None) """
+        keys = [None if key is None else encode_key(key) for key in keys]
+        encoded = dict.fromkeys(key for key in keys if key is not None)
+        found = list(encoded)
+        # (deferred, so readers do not lock out writers)
+        with self._transaction('DEFERRED'):
+            # (in batches of fewer than SQLite's limit of parameters)
+            for i in range(0, len(found), 500):
+                batch = found[i:i + 500]
+                encoded.update(self._db.execute(
+                    'SELECT key, value FROM zscores WHERE key IN (%s)' %
+                    ','.join('?' * len(batch)), batch))
+        values = []
+        for key in keys:
+            value = None if key is None else encoded[key]
+            if isinstance(value, str):
+                value = decimal.Decimal(value)
+            values.append(value)
+        hits = sum(value is not None for value in values)
+        misses = sum(key is not None for key in keys) - hits
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+        return values
+
+    def put_many(self, items):
+        """ Cache a list of (key, value) tuples, ignoring those whose key
+        or value is None """
+        rows = []
+        for key, value in items:
+            if key is None or value is None:
+                continue
+            if isinstance(value, decimal.Decimal):
+                value = str(value)
+            else:
+                value = float(value)
+            rows.append((encode_key(key), value))
+        with self._transaction():
+            self._db.executemany('INSERT OR REPLACE INTO zscores '
+                                 'VALUES (?, ?)', rows)
+
+    def info(self):
+        """ Return the cache's CacheInfo(hits, misses, evictions, maxsize,
+        currsize) """
+        return CacheInfo(self.hits, self.misses, 0, self.maxsize, len(self))
+
+    def clear(self):
+        """ Empty the cache and reset its counters """
+        with self._transaction():
+            self._db.execute('DELETE FROM zscores')
+            self.hits = self.misses = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM zscores').fetchone()[0]
+
+    def __getstate__(self):
+        # copies (e.g., for worker processes) open their own connection
+        return {'path': self.path, 'version': self.version}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.version = state['version']
+        self._init()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+""" Command-line z-score calculations for CSV or JSON lines files.
+
+Rows are read, scored, and written a chunk at a time, so memory use does
+not grow with the size of the input. For example, to add wfa_zscore and
+lhfa_zscore columns to a CSV file with weight, height, dob, visit_date,
+and sex columns::
+
+    $ python -m pygrowup -z wfa=weight -z lhfa=height --dob dob \\
+        --visit-date visit_date --sex sex survey.csv > scored.csv
+
+Run ``python -m pygrowup --help`` for all options.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import datetime
+import importlib.util
+from decimal import Decimal as D
+
+from . import helpers
+from . import cache as caches
+from .exceptions import ROW_ERRORS
+from .pygrowup import Calculator
+
+INDICATORS = ["lhfa", "wfl", "wfh", "wfa", "bmifa", "hcfa"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pygrowup',
+        description='Append z-score columns to a CSV or JSON lines file.')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='input file (default: stdin)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='output file (default: stdout)')
+    parser.add_argument('-f', '--format', choices=['csv', 'jsonl'],
+                        help='input and output format (default: from the '
+                             'input file extension, or csv)')
+    parser.add_argument('-z', '--zscore', action='append', required=True,
+                        metavar='INDICATOR=COLUMN',
+                        help='calculate INDICATOR (one of %s) from the '
+                             'measurements in COLUMN into an '
+                             'INDICATOR_zscore column; may be repeated'
+                             % ', '.join(INDICATORS))
+    parser.add_argument('--sex', required=True, metavar='COLUMN',
+                        help='column of sexes (e.g., M, F, male, female)')
+    parser.add_argument('--height', metavar='COLUMN',
+                        help='column of lengths/heights (for wfl and wfh)')
+    age = parser.add_mutually_exclusive_group(required=True)
+    age.add_argument('--age', metavar='COLUMN',
+                     help='column of ages in months')
+    age.add_argument('--dob', metavar='COLUMN',
+                     help='column of dates of birth (e.g., DDMMYY or '
+                          'DD-MM-YYYY), to calculate ages from')
+    parser.add_argument('--visit-date', metavar='COLUMN',
+                        help='column of the dates measurements were taken, '
+                             'to calculate ages from dates of birth '
+                             '(default: --reference-date)')
+    parser.add_argument('--reference-date', metavar='YYYY-MM-DD',
+                        help='date to calculate ages from dates of birth '
+                             'on (default: today)')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='rows to read and score at a time '
+                             '(default: %(default)s)')
+    parser.add_argument('--engine', choices=['decimal', 'float'],
+                        default='decimal',
+                        help='arithmetic for calculations; float uses '
+                             'vectorized batch calculations if numpy is '
+                             'installed (default: %(default)s)')
+    parser.add_argument('--precision', choices=['exact', 'fast'],
+                        default='exact',
+                        help='precision tier of the decimal engine; both '
+                             'give the same z-scores (default: %(default)s)')
+    parser.add_argument('--adjust-height-data', action='store_true')
+    parser.add_argument('--adjust-weight-scores', action='store_true')
+    parser.add_argument('--include-cdc', action='store_true',
+                        help='use CDC growth standards for children '
+                             'older than 5 years')
+    parser.add_argument('--cache', metavar='PATH',
+                        help='SQLite file of z-scores to reuse from earlier '
+                             'runs (created if missing, and emptied if the '
+                             'tables have changed)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not report rows per second')
+    args = parser.parse_args(argv)
+
+    args.indicators = []
+    for zscore in args.zscore:
+        indicator, equals, column = zscore.partition('=')
+        if indicator.lower() not in INDICATORS or not column:
+            parser.error('invalid --zscore: %s' % zscore)
+        if indicator.lower() in ['wfl', 'wfh'] and not args.height:
+            parser.error('--height is required for %s' % indicator)
+        args.indicators.append((indicator.lower(), column))
+    if args.format is None:
+        args.format = 'jsonl' if args.input.endswith(
+            ('.jsonl', '.ndjson')) else 'csv'
+    if args.reference_date:
+        args.reference_date = datetime.datetime.strptime(
+            args.reference_date, '%Y-%m-%d').date()
+    else:
+        args.reference_date = datetime.date.today()
+    return args
+
+
+def get_value(row, column):
+    """ Return a row's value for a column as a string, or None if the
+    value is blank (JSON numbers are converted to strings so they are
+    read exactly as decimals). """
+    if column is None:
+        return None
+    value = row.get(column)
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+
+def get_date(value):
+    """ Normalize a date string with helpers.get_good_date """
+    if not value:
+        return None
+    delimiter = not value.isdigit()
+    try:
+        good_date_str, good_date_obj = helpers.get_good_date(value,
+                                                             delimiter)
+    except (ValueError, IndexError):
+        return None
+    return good_date_obj
+
+
+class Scorer(object):
+    """ Calculates z-scores for chunks of rows (dicts of strings) """
+
+    def __init__(self, args):
+        self.args = args
+        self.calculator = Calculator(
+            adjust_height_data=args.adjust_height_data,
+            adjust_weight_scores=args.adjust_weight_scores,
+            include_cdc=args.include_cdc, engine=args.engine,
+            precision=args.precision,
+            # rather than warning about each row that is
+            # switched between wfl and wfh tables
+            log_level='ERROR')
+        # z-scores are looked up in (and added to) the cache a chunk at a
+        # time, rather than by the calculator one at a time
+        self.cache = None
+        if args.cache:
+            self.cache = caches.SQLiteCache(args.cache)
+        self.batch = (args.engine == 'float' and
+                      importlib.util.find_spec('numpy') is not None)
+
+    def age(self, row):
+        """ Age in months of the child in a row, or None """
+        if self.args.age:
+            return get_value(row, self.args.age)
+        dob = get_date(get_value(row, self.args.dob))
+        if self.args.visit_date:
+            on = get_date(get_value(row, self.args.visit_date))
+        else:
+            on = self.args.reference_date
+        if dob is None or on is None:
+            return None
+        return D((on - dob).days) / D(repr(helpers.DAYS_PER_MONTH))
+
+    def ages(self, rows):
+        """ Ages in months of the children in rows, as an array (NaN if
+        unknown) or a list of strings """
+        if self.args.age:
+            return [get_value(row, self.args.age) for row in rows]
+        dobs = [get_value(row, self.args.dob) for row in rows]
+        if self.args.visit_date:
+            on = [get_value(row, self.args.visit_date) for row in rows]
+        else:
+            on = self.args.reference_date
+        ages, invalid = helpers.dates_to_ages(dobs, on)
+        return ages
+
+    def sex(self, row):
+        return helpers.get_good_sex(get_value(row, self.args.sex) or '')
+
+    def score(self, rows):
+        """ Add an INDICATOR_zscore value to each row (None if the row
+        could not be scored) """
+        if self.batch:
+            ages = self.ages(rows)
+            sexes, unknown = helpers.get_good_sexes(
+                [get_value(row, self.args.sex) for row in rows])
+        else:
+            ages = [self.age(row) for row in rows]
+            sexes = [self.sex(row) for row in rows]
+        heights = [get_value(row, self.args.height) for row in rows]
+        for indicator, column in self.args.indicators:
+            measurements = [get_value(row, column) for row in rows]
+            if self.cache is None:
+                zscores = self.calculate(indicator, measurements, ages,
+                                         sexes, heights)
+            else:
+                zscores = self.calculate_cached(indicator, measurements,
+                                                ages, sexes, heights)
+            for row, zscore in zip(rows, zscores):
+                row['%s_zscore' % indicator] = zscore
+
+    def calculate(self, indicator, measurements, ages, sexes, heights):
+        """ Return a list of z-scores for columns of observations (None
+        for those that could not be scored) """
+        if self.batch:
+            zscores = self.calculator.zscores(
+                indicator, measurements, ages, sexes, heights)
+            return [None if zscore != zscore else float(zscore)
+                    for zscore in zscores]
+        return [self.score_one(indicator, *observation)
+                for observation in zip(measurements, ages, sexes, heights)]
+
+    def calculate_cached(self, indicator, measurements, ages, sexes,
+                         heights):
+        """ Return a list of z-scores for columns of observations, as
+        calculate, reading those already in the cache in one transaction
+        and caching the rest in another """
+        # (batch z-scores are cached apart from those of the float engine)
+        suffix = ('batch',) if self.batch else ()
+        keys = []
+        for observation in zip(measurements, ages, sexes, heights):
+            key = self.calculator._cache_key(indicator, *observation)
+            keys.append(None if key is None else key + suffix)
+        zscores = self.cache.get_many(keys)
+        missing = [i for i, zscore in enumerate(zscores) if zscore is None]
+        if missing:
+            calculated = self.calculate(indicator, *[
+                [column[i] for i in missing]
+                for column in [measurements, ages, sexes, heights]])
+            for i, zscore in zip(missing, calculated):
+                zscores[i] = zscore
+            self.cache.put_many([(keys[i], zscore) for i, zscore
+                                 in zip(missing, calculated)])
+        return zscores
+
+    def score_one(self, indicator, measurement, age, sex, height):
+        try:
+            return self.calculator.zscore_for_measurement(
+                indicator, measurement, age, sex, height)
+        except ROW_ERRORS:
+            return None
+
+
+def format_zscore(zscore):
+    return '' if zscore is None else str(zscore)
+
+
+def parse_lines(lines):
+    """ Yield the JSON object of each line, skipping (with a warning)
+    lines which are not JSON objects """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        if isinstance(row, dict):
+            yield row
+        else:
+            sys.stderr.write('skipping line %d: not a JSON object (%s)\n' %
+                             (number, line.strip()[:50]))
+
+
+def run(args, infile, outfile):
+    """ Score rows from infile into outfile, returning the row count """
+    scorer = Scorer(args)
+    zscore_columns = ['%s_zscore' % indicator
+                      for indicator, column in args.indicators]
+    count = 0
+    if args.format == 'csv':
+        reader = csv.DictReader(infile)
+        if reader.fieldnames is None:
+            # (an empty file)
+            return count
+        fieldnames = list(reader.fieldnames) + [
+            column for column in zscore_columns
+            if column not in reader.fieldnames]
+        # (the extra fields of ragged rows, under None, are left out)
+        writer = csv.DictWriter(outfile, fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        outfile.flush()
+        for chunk in helpers.chunks(reader, args.chunk_size):
+            scorer.score(chunk)
+            for row in chunk:
+                for column in zscore_columns:
+                    row[column] = format_zscore(row[column])
+            writer.writerows(chunk)
+            outfile.flush()
+            count += len(chunk)
+    else:
+        for rows in helpers.chunks(parse_lines(infile), args.chunk_size):
+            scorer.score(rows)
+            for row in rows:
+                for column in zscore_columns:
+                    if row[column] is not None:
+                        row[column] = float(row[column])
+                outfile.write(json.dumps(row) + '\n')
+            outfile.flush()
+            count += len(rows)
+    return count
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.input == '-':
+        infile = sys.stdin
+    else:
+        infile = open(args.input, 'r', encoding='utf-8', newline='')
+    if args.output == '-':
+        outfile = sys.stdout
+    else:
+        outfile = open(args.output, 'w', encoding='utf-8', newline='')
+    started = time.time()
+    try:
+        count = run(args, infile, outfile)
+    except BrokenPipeError:
+        # output was closed early (e.g., piped to head); point stdout at
+        # devnull so flushing it on exit does not raise again
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+    elapsed = time.time() - started
+    if not args.quiet:
+        sys.stderr.write('%d rows in %.2f seconds (%d rows per second)\n' %
+                         (count, elapsed, count / elapsed if elapsed else 0))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+""" Z-score columns for pandas DataFrames and pyarrow Tables.
+
+Importing this module registers a ``growup`` accessor on pandas
+DataFrames (if pandas is installed)::
+
+    import pygrowup.dataframe
+
+    df['wfa_zscore'] = df.growup.zscore('wfa', weight='w', age='age_mo',
+                                        sex='sex')
+
+and ``arrow_zscore`` does the same for pyarrow Tables::
+
+    zscores = pygrowup.dataframe.arrow_zscore(table, 'wfa', weight='w',
+                                              age='age_mo', sex='sex')
+
+Columns are read as numpy arrays (without copying, where they are
+already float64) and scored a column at a time with Calculator.zscores.
+"""
+import numpy as np
+
+from .pygrowup import Calculator
+
+# the keyword naming the measured column for each indicator
+MEASUREMENTS = {
+    "lhfa": "height",
+    "wfl": "weight",
+    "wfh": "weight",
+    "wfa": "weight",
+    "bmifa": "bmi",
+    "hcfa": "head_circumference",
+}
+
+
+def column_names(indicator, weight=None, height=None, bmi=None,
+                 head_circumference=None, age=None, sex=None):
+    """ Return the names of the (measurement, age, sex, height) columns
+    for an indicator (height is None unless the indicator is wfl or wfh) """
+    assert indicator is not None
+    assert indicator.lower() in MEASUREMENTS
+    indicator = indicator.lower()
+    measurement = {"weight": weight, "height": height, "bmi": bmi,
+                   "head_circumference": head_circumference}[
+        MEASUREMENTS[indicator]]
+    assert measurement is not None, \
+        "%s requires a %s column" % (indicator, MEASUREMENTS[indicator])
+    assert age is not None, "an age column is required"
+    assert sex is not None, "a sex column is required"
+    if indicator in ["wfl", "wfh"]:
+        assert height is not None, "%s requires a height column" % indicator
+    else:
+        height = None
+    return measurement, age, sex, height
+
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+else:
+    @pd.api.extensions.register_dataframe_accessor("growup")
+    class GrowupAccessor(object):
+        """ DataFrame.growup accessor """
+
+        def __init__(self, df):
+            self.df = df
+
+        def column(self, name):
+            series = self.df[name]
+            if series.dtype == object or isinstance(
+                    series.dtype, (pd.CategoricalDtype, pd.StringDtype)):
+                return series.to_numpy()
+            return series.to_numpy(dtype=np.float64, na_value=np.nan)
+
+        def zscore(self, indicator, weight=None, height=None, bmi=None,
+                   head_circumference=None, age=None, sex=None,
+                   calculator=None, nullable=False):
+            """ Return a Series of z-scores for an indicator, calculated
+            from the named columns (age in months, and height for wfl and
+            wfh). Rows which cannot be scored are NaN, or <NA> with
+            nullable (a Float64 Series). calculator defaults to
+            Calculator(). """
+            names = column_names(indicator, weight, height, bmi,
+                                 head_circumference, age, sex)
+            calculator = calculator or Calculator()
+            columns = [None if name is None else self.column(name)
+                       for name in names]
+            zscores = calculator.zscores(indicator, *columns)
+            series = pd.Series(zscores, index=self.df.index,
+                               name="%s_zscore" % indicator.lower())
+            if nullable:
+                series = series.astype("Float64")
+            return series
+
+
+def arrow_column(table, name):
+    """ Return a pyarrow Table column as a numpy array (nulls as NaN, for
+    numeric columns) """
+    import pyarrow as pa
+    column = table.column(name)
+    if column.num_chunks == 1:
+        column = column.chunk(0)
+    if pa.types.is_floating(column.type) or pa.types.is_integer(column.type):
+        column = column.cast(pa.float64())
+    return column.to_numpy(zero_copy_only=False)
+
+
+def arrow_zscore(table, indicator, weight=None, height=None, bmi=None,
+                 head_circumference=None, age=None, sex=None,
+                 calculator=None):
+    """ Return a pyarrow float64 Array of z-scores for an indicator,
+    calculated from the named columns of a pyarrow Table (as with
+    DataFrame.growup.zscore). Rows which cannot be scored are null. """
+    import pyarrow as pa
+    names = column_names(indicator, weight, height, bmi, head_circumference,
+                         age, sex)
+    calculator = calculator or Calculator()
+    columns = [None if name is None else arrow_column(table, name)
+               for name in names]
+    zscores = calculator.zscores(indicator, *columns)
+    return pa.array(zscores, mask=np.isnan(zscores))
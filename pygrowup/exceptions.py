@@ -12,3 +12,11 @@ class InvalidAge(RuntimeError):
 
 class InvalidMeasurement(RuntimeError):
     pass
+
+
+# errors of individual observations (e.g., a blank measurement, or an age
+# outside of the tables), which batch interfaces (the command line,
+# parallel.map_zscores, etc.) report for the observation rather than
+# raising
+ROW_ERRORS = (RuntimeError, AssertionError, ArithmeticError, ValueError,
+              TypeError)
@@ -2,16 +2,23 @@ import re
 import datetime
 import logging
 
+from .tablestore import DAYS_PER_MONTH
+
+# patterns, compiled once
+DELIMITERS = re.compile(r"[./\\-]+")
+DELIMITED_DATE = re.compile(r"(\d+)[./\\-]+(\d+)[./\\-]+(\d+)")
+MALE = re.compile("(m[a-z]*)", re.I)
+FEMALE = re.compile("(f[a-z]*)", re.I)
+
 
 def get_good_date(date, delimiter=False):
     # TODO parameter to choose formating
     # e.g., DDMMYY vs YYMMDD etc
     logging.debug('getting good date...')
     logging.debug(date)
-    delimiters = r"[./\\-]+"
     if delimiter:
         # expecting DDMMYY
-        Allsect = re.split(delimiters, date)
+        Allsect = DELIMITERS.split(date)
     else:
         logging.debug('no delimiter')
         if len(date) == 6:
@@ -46,10 +53,10 @@ def get_good_date(date, delimiter=False):
         if month.isdigit():
             if int(month) == 2:
                 if int(day) > 28:
-                    day = 28
+                    day = '28'
             if int(month) in [4, 6, 9, 11]:
                 if int(day) > 30:
-                    day = 30
+                    day = '30'
         else:
             return None, None
 
@@ -82,10 +89,8 @@ def get_good_date(date, delimiter=False):
 
 def get_good_sex(gender):
     # TODO improve patterns so 'monkey' isnt a match for 'male'
-    male_pattern = "(m[a-z]*)"
-    female_pattern = "(f[a-z]*)"
-    its_a_boy = re.match(male_pattern, gender, re.I)
-    its_a_girl = re.match(female_pattern, gender, re.I)
+    its_a_boy = MALE.match(gender)
+    its_a_girl = FEMALE.match(gender)
     if its_a_boy is not None:
         return 'M'
     elif its_a_girl is not None:
@@ -95,10 +100,126 @@ def get_good_sex(gender):
         return None
 
 
-def date_to_age_in_months(date):
-    delta = datetime.date.today() - date
+def date_to_age_in_months(date, today=None):
+    # (today defaults to the current date)
+    delta = (today or datetime.date.today()) - date
     #years = delta.days / 365.25
-    return str(int(delta.days / 30.4375))
+    return str(int(delta.days / DAYS_PER_MONTH))
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:  # pragma: no cover
+        raise ImportError("pygrowup batch helpers require numpy "
+                          "(e.g., pip install pygrowup[numpy])")
+    return numpy
+
+
+def _date_parts(value):
+    """ Return the (year, month, day) of a date string as get_good_date
+    reads it, or (0, 0, 0) if it is not a date """
+    if isinstance(value, datetime.date):
+        return value.year, value.month, value.day
+    if value is None or value != value:
+        # (None or NaN)
+        return 0, 0, 0
+    value = str(value).strip()
+    if value.isdigit():
+        if len(value) in [6, 8]:
+            # DDMMYY or DDMMYYYY
+            day, month, year = value[:2], value[2:4], value[4:]
+        elif len(value) == 4:
+            # DMYY
+            day, month, year = value[0], value[1], value[2:]
+        else:
+            # (including ambiguous 5 digit dates)
+            return 0, 0, 0
+    else:
+        match = DELIMITED_DATE.fullmatch(value)
+        if match is None:
+            return 0, 0, 0
+        day, month, year = match.groups()
+    if len(year) < 4:
+        year = "20%s" % year
+    return int(year), int(month), int(day)
+
+
+def get_good_dates(dates):
+    """ Batch get_good_date: read a sequence of DDMMYY(YY) date strings,
+    delimited (e.g., 26-06-2015) or not (e.g., 260615), into a numpy
+    datetime64[D] array.
+
+    Days past the end of February and of 30-day months are moved back to
+    the 28th or 30th, as get_good_date does. Returns the dates and a
+    boolean mask of the rows which are not dates (and are NaT). """
+    np = _numpy()
+    values = np.asarray(dates)
+    if values.dtype.kind == 'M':
+        dates = values.astype('datetime64[D]')
+        return dates, np.isnat(dates)
+
+    # each distinct value is parsed once
+    if values.dtype.kind in 'US':
+        distinct, inverse = np.unique(values, return_inverse=True)
+    else:
+        codes = {}
+        inverse = np.array([codes.setdefault(value, len(codes))
+                            for value in values.tolist()], dtype=np.intp)
+        distinct = list(codes)
+    parts = np.array([_date_parts(value) for value in distinct],
+                     dtype=np.int64).reshape(-1, 3)
+    year, month, day = parts[inverse.ravel()].T
+
+    # make sure we have a REAL day
+    day = np.where((month == 2) & (day > 28), 28, day)
+    day = np.where(np.isin(month, [4, 6, 9, 11]) & (day > 30), 30, day)
+    invalid = ((year < 1) | (year > 9999) | (month < 1) | (month > 12) |
+               (day < 1) | (day > 31))
+    year, month, day = [np.where(invalid, 1, part)
+                        for part in [year, month, day]]
+    dates = ((year - 1970).astype('datetime64[Y]').astype('datetime64[M]') +
+             (month - 1).astype('timedelta64[M]')).astype('datetime64[D]') + \
+        (day - 1).astype('timedelta64[D]')
+    dates[invalid] = np.datetime64('NaT')
+    return dates, invalid
+
+
+def get_good_sexes(genders):
+    """ Batch get_good_sex: return a numpy array of 'M', 'F', or '' (for
+    unknown) for a sequence of genders (e.g., 'male', 'F', None), and a
+    boolean mask of the rows which are unknown. """
+    np = _numpy()
+    values = np.asarray(genders, dtype=object)
+    values[np.equal(values, None)] = ''
+    # the first character of each gender, as MALE and FEMALE match them
+    first = np.char.upper(values.astype(str).astype('<U1'))
+    sexes = np.where((first == 'M') | (first == 'F'), first, '')
+    return sexes, sexes == ''
+
+
+def dates_to_ages(birth_dates, reference_date, in_days=False):
+    """ Batch date_to_age_in_months: return numpy arrays of ages (in
+    months, as fractions of 30.4375 days, or in whole days if in_days)
+    and a boolean mask of invalid rows, for a sequence of dates of birth
+    and a fixed reference date (or a sequence of dates, e.g., of visits).
+
+    Dates may be datetime64 arrays or anything get_good_dates reads.
+    Rows with no date, or born after their reference date, are invalid
+    (and NaN). """
+    np = _numpy()
+    births, invalid = get_good_dates(birth_dates)
+    if isinstance(reference_date, datetime.date):
+        references = np.datetime64(reference_date, 'D')
+    else:
+        references, invalid_references = get_good_dates(reference_date)
+        invalid = invalid | invalid_references
+    days = (references - births).astype(np.float64)
+    invalid = invalid | ~(days >= 0)
+    days[invalid] = np.nan
+    if in_days:
+        return days, invalid
+    return days / DAYS_PER_MONTH, invalid
 
 
 def age_to_estimated_bday(age_in_months):
@@ -116,3 +237,15 @@ def age_to_estimated_bday(age_in_months):
             return None
     except Exception as e:
         logging.info(e)
+
+
+def chunks(iterable, size):
+    """ Split an iterable into lists of (at most) size items """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
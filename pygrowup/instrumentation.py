@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+""" Counters and timings of the stages of z-score calculations.
+
+A Calculator given an Instruments object records, for each indicator,
+how many times each stage of zscore_for_measurement ran and how long it
+took in total:
+
+    resolution   validating the observation and choosing its table
+    lookup       fetching the table and finding the observation's row
+    lms          calculating the z-score from the row's L, M, and S
+    adjustment   rounding, and adjusting z-scores beyond +/- 3 (see
+                 adjust_weight_scores)
+
+along with how many calculations raised an exception. Observations of
+indicators other than those in routing.INDICATORS are counted together,
+as the indicator 'invalid'::
+
+    instruments = Instruments()
+    calculator = Calculator(instruments=instruments)
+    ...
+    instruments.as_dict()['wfa']['lookup']  # {'count': 10, 'seconds': ...}
+    print(instruments.prometheus())
+
+Calculators without instruments do not time anything.
+"""
+import threading
+import time
+
+STAGES = ['resolution', 'lookup', 'lms', 'adjustment']
+
+
+def escape(value):
+    """ Escape a label value for the Prometheus text format """
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class Instruments(object):
+    """ Thread-safe stage counters and timings, by indicator """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        # copies (e.g., for worker processes) start from zero
+        return {}
+
+    def __setstate__(self, state):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Set all counters and timings to zero """
+        with self._lock:
+            # {(indicator, stage): [count, seconds]}
+            self._stages = {}
+            # {indicator: count}
+            self._errors = {}
+
+    def record(self, indicator, stage, seconds):
+        """ Record that a stage of a calculation took seconds """
+        with self._lock:
+            totals = self._stages.get((indicator, stage))
+            if totals is None:
+                self._stages[(indicator, stage)] = [1, seconds]
+            else:
+                totals[0] += 1
+                totals[1] += seconds
+
+    def stopwatch(self, indicator):
+        """ Return a Stopwatch recording the stages of a calculation """
+        return Stopwatch(self, indicator)
+
+    def error(self, indicator):
+        """ Record that a calculation raised an exception """
+        with self._lock:
+            self._errors[indicator] = self._errors.get(indicator, 0) + 1
+
+    def as_dict(self):
+        """ Return counts and timings as a dict, e.g.:
+
+            {'wfa': {'resolution': {'count': 2, 'seconds': 0.0001}, ...,
+                     'errors': 0}}
+        """
+        with self._lock:
+            result = {}
+            for (indicator, stage), (count, seconds) in self._stages.items():
+                stages = result.setdefault(indicator, {'errors': 0})
+                stages[stage] = {'count': count, 'seconds': seconds}
+            for indicator, count in self._errors.items():
+                result.setdefault(indicator, {})['errors'] = count
+            return result
+
+    def prometheus(self, prefix='pygrowup'):
+        """ Return counts and timings in the Prometheus text format """
+        with self._lock:
+            stages = sorted(self._stages.items(),
+                            key=lambda item: (item[0][0],
+                                              STAGES.index(item[0][1])))
+            errors = sorted(self._errors.items())
+        lines = [
+            '# HELP %s_stage_calls_total Stages of z-score calculations '
+            'run.' % prefix,
+            '# TYPE %s_stage_calls_total counter' % prefix]
+        for (indicator, stage), (count, seconds) in stages:
+            lines.append('%s_stage_calls_total{indicator="%s",stage="%s"} %d'
+                         % (prefix, escape(indicator), escape(stage),
+                            count))
+        lines.extend([
+            '# HELP %s_stage_seconds_total Time spent in stages of z-score '
+            'calculations.' % prefix,
+            '# TYPE %s_stage_seconds_total counter' % prefix])
+        for (indicator, stage), (count, seconds) in stages:
+            lines.append('%s_stage_seconds_total{indicator="%s",stage="%s"} '
+                         '%r' % (prefix, escape(indicator), escape(stage),
+                                 seconds))
+        lines.extend([
+            '# HELP %s_errors_total Z-score calculations which raised an '
+            'exception.' % prefix,
+            '# TYPE %s_errors_total counter' % prefix])
+        for indicator, count in errors:
+            lines.append('%s_errors_total{indicator="%s"} %d'
+                         % (prefix, escape(indicator), count))
+        return '\n'.join(lines) + '\n'
+
+
+class Stopwatch(object):
+    """ Records the stages of one calculation in Instruments, each timed
+    from the end of the one before it (or from the Stopwatch's creation) """
+
+    def __init__(self, instruments, indicator):
+        self.instruments = instruments
+        self.indicator = indicator
+        self.started = time.perf_counter()
+
+    def lap(self, stage):
+        """ Record that a stage has finished """
+        finished = time.perf_counter()
+        self.instruments.record(self.indicator, stage,
+                                finished - self.started)
+        self.started = finished
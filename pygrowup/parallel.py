@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+""" Parallel z-score calculations across worker processes.
+
+Observations are split into chunks which are scored by a pool of worker
+processes, each with its own copy of a Calculator. A Calculator pickles to
+its settings and a handle to the compiled tables file, which every worker
+memory-maps, so workers share one copy of the tables however many there
+are (see tablestore.Registry.handle). Results
+come back in the order of the observations, and an error scoring one
+observation is returned with its result rather than stopping the job::
+
+    from pygrowup import parallel
+
+    observations = [('wfa', '8.0', '9', 'M', None),
+                    ('wfl', '8.0', '9', 'M', '69.5'), ...]
+    for result in parallel.map_zscores(observations, workers=8):
+        if result.error is None:
+            print(result.zscore)
+"""
+import os
+import collections
+import concurrent.futures
+
+from . import helpers
+from . import routing
+from .exceptions import ROW_ERRORS
+from .pygrowup import Calculator
+
+Result = collections.namedtuple('Result', ['zscore', 'error'])
+
+# each worker process's calculator
+_calculator = None
+
+
+def score(calculator, observations):
+    """ Calculate z-scores for a list of (indicator, measurement,
+    age_in_months, sex, height) tuples, returning a list of
+    Result(zscore, error) as map_zscores does.
+
+    With the float engine and numpy installed, observations are
+    calculated in batches (by indicator) with Calculator.zscores; those
+    which cannot be calculated in a batch are calculated alone, so their
+    results (or errors) are those of zscore_for_measurement. """
+    results = [None] * len(observations)
+    if calculator.engine == 'float' and len(observations) > 1:
+        try:
+            import numpy
+        except ImportError:
+            pass
+        else:
+            by_indicator = {}
+            for i, observation in enumerate(observations):
+                # (others, e.g., of unknown or non-string indicators, are
+                # left to raise their errors alone)
+                indicator = observation[0]
+                if isinstance(indicator, str) and \
+                        indicator in routing.INDICATORS:
+                    by_indicator.setdefault(indicator, []).append(i)
+            for indicator, rows in by_indicator.items():
+                try:
+                    zscores = calculator.zscores(
+                        indicator, *[[observations[i][column] for i in rows]
+                                     for column in range(1, 5)])
+                except ROW_ERRORS:
+                    continue
+                for i, zscore in zip(rows, zscores):
+                    if zscore == zscore:
+                        results[i] = Result(float(zscore), None)
+    for i, observation in enumerate(observations):
+        if results[i] is None:
+            try:
+                results[i] = Result(calculator.zscore_for_measurement(
+                    *observation), None)
+            except ROW_ERRORS as e:
+                results[i] = Result(None, e)
+    return results
+
+
+def _initialize(calculator):
+    global _calculator
+    _calculator = calculator
+    # map tables before the first chunk arrives
+    calculator.load_tables()
+
+
+def _score_chunk(chunk):
+    return score(_calculator, chunk)
+
+
+def map_zscores(observations, calculator=None, workers=None,
+                chunk_size=1000):
+    """ Calculate z-scores for an iterable of (indicator, measurement,
+    age_in_months, sex, height) tuples in worker processes.
+
+    Yields a Result(zscore, error) for each observation, in order, where
+    error is the exception raised while scoring the observation (e.g.,
+    InvalidMeasurement) or None. Workers use copies of calculator
+    (default: Calculator()). workers defaults to the number of CPUs.
+    Observations are read chunk_size at a time, and only a few chunks
+    per worker are in flight at once, so any number of observations
+    can be processed in constant memory. """
+    if calculator is None:
+        calculator = Calculator()
+    workers = workers or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_initialize,
+            initargs=(calculator,)) as executor:
+        pending = collections.deque()
+        for chunk in helpers.chunks(observations, chunk_size):
+            pending.append(executor.submit(_score_chunk, chunk))
+            if len(pending) >= workers * 2:
+                for result in pending.popleft().result():
+                    yield result
+        while pending:
+            for result in pending.popleft().result():
+                yield result
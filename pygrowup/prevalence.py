@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+""" Streaming prevalence of stunting, wasting, and underweight by group.
+
+An Aggregator scores records (dicts of a child's measurements, age, and
+sex, along with any values to group by, e.g., region) as they arrive,
+keeping only an Accumulator for each group and indicator: the count, mean,
+and variance of its z-scores (by Welford's method) and how many are below
+-2 and -3. Z-scores outside of WHO's limits of plausible values are
+counted as flagged and left out, in the same pass::
+
+    from pygrowup.prevalence import Aggregator
+
+    aggregator = Aggregator(Calculator(engine='float'),
+                            group_by=['region', 'sex', 'age_group'])
+    for record in records:
+        aggregator.add(record)
+    aggregator.results()[('North', 'F', '12-23')]['lhfa']
+    # {'count': ..., 'mean': ..., 'sd': ..., 'below_2': ...,
+    #  'prevalence_below_2': ..., ..., 'flagged': ...}
+
+Stunting is lhfa below -2 (severe stunting below -3), wasting is wflh
+below -2, and underweight is wfa below -2. wflh is weight-for-length
+(under 24 months) and weight-for-height (from 24 months) together, as WHO
+reports them. Aggregators of parts of the records (e.g., in worker
+processes) can be merged, giving the same results as one Aggregator of
+all of them::
+
+    def aggregate(chunk):
+        aggregator = Aggregator(calculator, group_by=['region'])
+        aggregator.add_many(chunk)
+        return aggregator
+
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        total = Aggregator(calculator, group_by=['region'])
+        for part in executor.map(aggregate, chunks):
+            total.merge(part)
+"""
+import math
+
+from . import helpers
+from .exceptions import ROW_ERRORS
+from .pygrowup import Calculator
+
+INDICATORS = ["lhfa", "wfa", "wflh", "bmifa", "hcfa"]
+
+# z-scores outside of these limits are implausible (WHO flags, as in WHO
+# Anthro and the igrowup software), and likely to be errors of
+# measurement or data entry
+FLAGS = {
+    "lhfa": (-6, 6),
+    "wfa": (-6, 5),
+    "wflh": (-5, 5),
+    "bmifa": (-5, 5),
+    "hcfa": (-5, 5),
+}
+
+# bounds of age groups, in months
+AGE_GROUPS = [0, 6, 12, 24, 36, 48, 60]
+
+# record keys of the values given to Calculator.all_zscores
+FIELDS = {
+    "weight": "weight",
+    "length_or_height": "height",
+    "head_circumference": "head_circumference",
+    "age_in_months": "age",
+    "sex": "sex",
+}
+
+
+def age_group(age_in_months, bounds=AGE_GROUPS):
+    """ Return the label of the age group of an age in months (e.g.,
+    '12-23', or '60+' past the last bound), or None if the age is
+    unknown or negative """
+    if age_in_months is None or not age_in_months >= bounds[0]:
+        return None
+    for lower, upper in zip(bounds, bounds[1:]):
+        if age_in_months < upper:
+            return '%d-%d' % (lower, upper - 1)
+    return '%d+' % bounds[-1]
+
+
+class Accumulator(object):
+    """ The count, mean, and variance of a stream of z-scores, and counts
+    of those below -2 and -3 and of those flagged as implausible """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        # sum of squared differences from the mean
+        self.m2 = 0.0
+        self.below_2 = 0
+        self.below_3 = 0
+        self.flagged = 0
+
+    def add(self, zscore):
+        """ Add a (plausible) z-score """
+        # Welford's method, which (unlike sums of squares) does not lose
+        # precision as the count grows
+        self.count += 1
+        delta = zscore - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (zscore - self.mean)
+        if zscore < -2:
+            self.below_2 += 1
+            if zscore < -3:
+                self.below_3 += 1
+
+    def merge(self, other):
+        """ Add the z-scores of another Accumulator (e.g., of another
+        part of the records) """
+        self.combine(other.count, other.mean, other.m2, other.below_2,
+                     other.below_3, other.flagged)
+
+    def combine(self, count, mean, m2, below_2, below_3, flagged):
+        """ Add the count, mean, and m2 (sum of squared differences from
+        the mean) of some z-scores, and their counts below -2 and -3 and
+        flagged """
+        # (Chan et al.'s method of combining Welford's statistics)
+        total = self.count + count
+        if count:
+            delta = mean - self.mean
+            self.mean += delta * count / total
+            self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.below_2 += below_2
+        self.below_3 += below_3
+        self.flagged += flagged
+
+    @property
+    def sd(self):
+        """ The (sample) standard deviation of the z-scores, or None for
+        fewer than two """
+        if self.count < 2:
+            return None
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def as_dict(self):
+        """ Return the statistics as a dict, with prevalences below -2
+        and -3 as fractions of the count (None if the count is 0) """
+        return {
+            'count': self.count,
+            'mean': self.mean if self.count else None,
+            'sd': self.sd,
+            'below_2': self.below_2,
+            'below_3': self.below_3,
+            'prevalence_below_2': (self.below_2 / self.count
+                                   if self.count else None),
+            'prevalence_below_3': (self.below_3 / self.count
+                                   if self.count else None),
+            'flagged': self.flagged,
+        }
+
+
+class Aggregator(object):
+    """ Per-group Accumulators of z-scores of records (dicts), calculated
+    by a Calculator.
+
+    group_by is a list of the record keys to group by; 'age_group' groups
+    by age_group (of the record's age), and 'sex' by the sex as
+    normalized by helpers.get_good_sex. fields maps the arguments of
+    Calculator.all_zscores to record keys (see FIELDS). Records which
+    cannot be scored at all (e.g., of unknown sex or age) are counted in
+    skipped. """
+
+    def __init__(self, calculator=None, group_by=(), fields=None,
+                 age_groups=AGE_GROUPS):
+        self.calculator = calculator or Calculator(log_level='ERROR')
+        self.group_by = list(group_by)
+        self.fields = dict(FIELDS)
+        self.fields.update(fields or {})
+        self.age_groups = age_groups
+        # {(group values): {indicator: Accumulator}}
+        self.groups = {}
+        self.skipped = 0
+
+    def _months(self, age):
+        if self.calculator.age_in_days:
+            return age / helpers.DAYS_PER_MONTH
+        return age
+
+    def _group(self, record, sex, age):
+        key = []
+        for name in self.group_by:
+            if name == 'age_group':
+                key.append(age_group(self._months(age), self.age_groups))
+            elif name == 'sex':
+                key.append(sex)
+            else:
+                key.append(record.get(name))
+        return tuple(key)
+
+    def _accumulators(self, group):
+        accumulators = self.groups.get(group)
+        if accumulators is None:
+            accumulators = self.groups[group] = dict(
+                (indicator, Accumulator()) for indicator in INDICATORS)
+        return accumulators
+
+    def add(self, record):
+        """ Score a record and add its z-scores to its group """
+        fields = self.fields
+        sex = helpers.get_good_sex(str(record.get(fields['sex']) or ''))
+        try:
+            age = float(record.get(fields['age_in_months']))
+            zscores = self.calculator.all_zscores(
+                weight=record.get(fields['weight']),
+                length_or_height=record.get(fields['length_or_height']),
+                head_circumference=record.get(fields['head_circumference']),
+                age_in_months=record.get(fields['age_in_months']),
+                sex=sex)
+        except ROW_ERRORS:
+            self.skipped += 1
+            return
+        accumulators = self._accumulators(self._group(record, sex, age))
+        for indicator, zscore in zscores.items():
+            if zscore is None:
+                continue
+            if indicator in ["wfl", "wfh"]:
+                indicator = "wflh"
+            zscore = float(zscore)
+            low, high = FLAGS[indicator]
+            if low <= zscore <= high:
+                accumulators[indicator].add(zscore)
+            else:
+                accumulators[indicator].flagged += 1
+
+    def add_many(self, records):
+        """ Score a list of records and add their z-scores to their
+        groups, as add does for each. With numpy installed, the records
+        are scored with Calculator.all_zscores_batch and accumulated
+        with array operations """
+        try:
+            import numpy as np
+            from . import batch
+        except ImportError:
+            for record in records:
+                self.add(record)
+            return
+        fields = self.fields
+        sexes, unknown = helpers.get_good_sexes(
+            [record.get(fields['sex']) for record in records])
+        columns = {}
+        for argument in ['weight', 'length_or_height', 'head_circumference',
+                         'age_in_months']:
+            columns[argument] = [record.get(fields[argument])
+                                 for record in records]
+        zscores = self.calculator.all_zscores_batch(
+            weights=columns['weight'],
+            lengths_or_heights=columns['length_or_height'],
+            head_circumferences=columns['head_circumference'],
+            ages=columns['age_in_months'], sexes=sexes)
+        ages = batch.as_float_array(columns['age_in_months'])
+        if "wfl" in zscores:
+            zscores["wflh"] = np.where(np.isnan(zscores["wfl"]),
+                                       zscores.pop("wfh"), zscores.pop("wfl"))
+        skipped = unknown | np.isnan(ages)
+        self.skipped += int(skipped.sum())
+
+        rows = {}
+        for i, record in enumerate(records):
+            if not skipped[i]:
+                rows.setdefault(self._group(record, sexes[i], ages[i]),
+                                []).append(i)
+        for group, indices in rows.items():
+            accumulators = self._accumulators(group)
+            indices = np.array(indices)
+            for indicator, values in zscores.items():
+                values = values[indices]
+                values = values[~np.isnan(values)]
+                low, high = FLAGS[indicator]
+                plausible = (values >= low) & (values <= high)
+                flagged = values.size - int(plausible.sum())
+                values = values[plausible]
+                mean = values.mean() if values.size else 0.0
+                accumulators[indicator].combine(
+                    values.size, float(mean),
+                    float(((values - mean) ** 2).sum()),
+                    int((values < -2).sum()), int((values < -3).sum()),
+                    flagged)
+
+    def merge(self, other):
+        """ Add the groups (and skipped count) of another Aggregator """
+        for group, accumulators in other.groups.items():
+            mine = self._accumulators(group)
+            for indicator, accumulator in accumulators.items():
+                mine[indicator].merge(accumulator)
+        self.skipped += other.skipped
+
+    def results(self):
+        """ Return a dict of groups (tuples of the values of group_by) and
+        dicts of indicators and their statistics (see
+        Accumulator.as_dict) """
+        return dict(
+            (group, dict((indicator, accumulator.as_dict())
+                         for indicator, accumulator in accumulators.items()))
+            for group, accumulators in self.groups.items())
+
+    def total(self):
+        """ Return a dict of indicators and their statistics over every
+        group """
+        totals = dict((indicator, Accumulator()) for indicator in INDICATORS)
+        for accumulators in self.groups.values():
+            for indicator, accumulator in accumulators.items():
+                totals[indicator].merge(accumulator)
+        return dict((indicator, accumulator.as_dict())
+                    for indicator, accumulator in totals.items())
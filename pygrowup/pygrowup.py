@@ -1,30 +1,52 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
-import os
 import math
 import decimal
 import logging
-import json
+import functools
 from decimal import Decimal as D
 
-import six
-
+from . import cache as caches
 from . import exceptions
+from . import routing
+from . import tablestore
 
+# bands returned by Calculator.classify
+BELOW_3SD = -3
+BELOW_2SD = -2
+NORMAL = 0
+ABOVE_2SD = 2
+ABOVE_3SD = 3
 
-# TODO is this the best way to get this file's directory?
-module_dir = os.path.split(os.path.abspath(__file__))[0]
+# working precision (in significant digits) of the decimal engine's
+# 'fast' precision tier (see Calculator's precision)
+FAST_PRECISION = 12
 
 
 class Observation(object):
     def __init__(self, indicator, measurement, age_in_months, sex,
-                 height, american, logger_name):
-        self.logger = logging.getLogger(logger_name)
+                 height, american, logger_name, age_in_days=False):
+        # (a Logger may be passed to save looking it up by name)
+        if isinstance(logger_name, logging.Logger):
+            self.logger = logger_name
+        else:
+            self.logger = logging.getLogger(logger_name)
 
         self.indicator = indicator
         self.measurement = measurement
         self.position = None
-        self.age = D(age_in_months)
+        # if age_in_days, the age given is in days, and
+        # rows are looked up by day (see Table.days)
+        self.days = None
+        self._age_in_weeks = None
+        self._age_key = None
+        self._age_bucket = None
+        if age_in_days:
+            self.days = D(age_in_months)
+            self.age = self.days / D(repr(tablestore.DAYS_PER_MONTH))
+            self._age_in_weeks = self.days / D(7)
+        else:
+            self.age = D(age_in_months)
         self.sex = sex.upper()
         self.height = height
         self.american = american
@@ -38,7 +60,12 @@ class Observation(object):
 
     @property
     def age_in_weeks(self):
-        return ((self.age * D('30.4374')) / D(7))
+        # (calculated once)
+        if self._age_in_weeks is None:
+            self._age_in_weeks = ((self.age *
+                                   D(repr(tablestore.DAYS_PER_MONTH))) /
+                                  D(tablestore.DAYS_PER_WEEK))
+        return self._age_in_weeks
 
     @property
     def rounded_height(self):
@@ -57,155 +84,162 @@ class Observation(object):
         # otherwise return with decimal places
         return rounded.to_eng_string()
 
-    def get_zscores(self, growth):
-        table_name = self.resolve_table()
-        table = getattr(growth, table_name)
+    @property
+    def half_centimeters(self):
+        """ Height rounded to the closest half centimeter -- the resolution
+            of the WHO tables -- as a count of half centimeters. """
+        correction = D('0.5') if D(self.height) >= D(0) else D('-0.5')
+        return int(D(self.height) / D('0.5') + correction)
+
+    def get_row(self, growth):
+        """ Return the table for this observation and the index of
+        its row in the table. """
+        return self.find_row(growth.table(self.resolve_table()))
+
+    def find_row(self, table):
+        """ Return the table and the index of this observation's row in
+        the table (see get_row). """
         if self.indicator in ["wfh", "wfl"]:
             assert self.height is not None
             if D(self.height) < D(45):
                 raise exceptions.InvalidMeasurement("too short")
             if D(self.height) > D(120):
                 raise exceptions.InvalidMeasurement("too tall")
-            # find closest height from WHO table (which has data at a resolution
-            # of half a centimeter).
-            # round height to closest tenth of a centimeter
-            # NOTE heights in tables are EITHER ints or floats!
-            # (e.g., 60, 60.5)
-            closest_height = self.rounded_height
-            self.logger.debug("looking up scores with: %s" % closest_height)
-            scores = table.get(closest_height)
-            if scores is not None:
-                return scores
+            # find closest height from WHO table (which has data at a
+            # resolution of half a centimeter)
+            index = table.position(self.half_centimeters)
+            if index is not None:
+                return table, index
             raise exceptions.DataNotFound("SCORES NOT FOUND BY HEIGHT: %s => "
-                                          "%s" % (self.height, closest_height))
+                                          "%s" % (self.height,
+                                                  self.rounded_height))
 
         elif self.indicator in ["lhfa", "wfa", "bmifa", "hcfa"]:
-            if self.age_in_weeks <= D(13):
-                closest_week = str(int(math.floor(self.age_in_weeks)))
-                scores = table.get(closest_week)
-                if scores is not None:
-                    return scores
-                raise exceptions.DataNotFound("SCORES NOT FOUND BY WEEK: %s => "
-                                              " %s" % (str(self.age_in_weeks),
-                                                       closest_week))
-            closest_month = str(int(math.floor(self.age)))
-            scores = table.get(closest_month)
-            if scores is not None:
-                return scores
-            raise exceptions.DataNotFound("SCORES NOT FOUND BY MONTH: %s =>"
-                                          " %s" % (str(self.age),
-                                                   closest_month))
+            unit, age, closest = self.age_key
+            if unit == "DAY":
+                table = table.days()
+            index = table.position(closest)
+            if index is not None:
+                return table, index
+            raise exceptions.DataNotFound("SCORES NOT FOUND BY %s: %s => %s"
+                                          % (unit, str(age), closest))
+
+    @property
+    def age_key(self):
+        """ The unit ('DAY', 'WEEK', or 'MONTH') age-based tables are
+        looked up by for this observation, its age in that unit, and the
+        whole number of units (the key of its row). """
+        # (calculated once, and shared by every indicator of the
+        # observation; see Calculator.all_zscores)
+        if self._age_key is None:
+            if self.days is not None:
+                self._age_key = ("DAY", self.days,
+                                 int(math.floor(self.days)))
+            elif self.age_in_weeks <= 13:
+                self._age_key = ("WEEK", self.age_in_weeks,
+                                 int(math.floor(self.age_in_weeks)))
+            else:
+                self._age_key = ("MONTH", self.age,
+                                 int(math.floor(self.age)))
+        return self._age_key
+
+    @property
+    def age_bucket(self):
+        """ The routing bucket of this observation's age """
+        if self._age_bucket is None:
+            self._age_bucket = routing.age_bucket(self.age, self.age_in_weeks)
+        return self._age_bucket
+
+    def get_zscores(self, growth):
+        """ Return the table row for this observation as a dict """
+        table, index = self.get_row(growth)
+        return table.row(index)
 
     def resolve_table(self):
         """ Choose a WHO/CDC table to use, making adjustments
         based on age, length, or height. If, for example, the
         indicator is set to wfl while the child is too long for
         the recumbent tables, this method will make the lookup
-        in the wfh table. """
-        if self.indicator == 'wfl' and D(self.height) > D(86):
-            self.logger.warning('too long for recumbent')
-            self.table_indicator = 'wfh'
-            self.table_age = '2_5'
-        elif self.indicator == 'wfh' and D(self.height) < D(65):
-            self.logger.warning('too short for standing')
-            self.table_indicator = 'wfl'
-            self.table_age = '0_2'
-        else:
-            self.table_indicator = self.indicator
-            if self.table_indicator == 'wfl':
-                self.table_age = '0_2'
-            if self.table_indicator == 'wfh':
-                self.table_age = '2_5'
-
-        if self.sex == 'M':
-            self.table_sex = 'boys'
-        if self.sex == 'F':
-            self.table_sex = 'girls'
-
-        # weight for age has only one table per sex,
-        # as does head circumference for age
-        # and CDC goes unused before 24mos
-        if self.indicator in ["wfa", "lhfa", "hcfa"]:
-            self.table_age = "0_5"
-            if self.age <= D(3):
-                if self.age_in_weeks <= D(13):
-                    self.table_age = "0_13"
-            if self.american and self.age >= D(24):
-                if self.indicator == "hcfa":
-                    raise exceptions.InvalidAge('TOO OLD: %d' % self.age)
-                self.table_age = "2_20"
-        elif self.indicator in ["bmifa"]:
-            if self.age > D(240):
-                raise exceptions.InvalidAge('TOO OLD: %d' % self.age)
-            elif self.age <= D(3) and self.age_in_weeks <= D(13):
-                self.table_age = "0_13"
-            elif self.age < D(24):
-                self.table_age = '0_2'
-            elif self.age >= D(24) and self.age <= D(60):
-                self.table_age = '2_5'
-            elif self.age >= D(24) and self.age > D(60):
-                self.table_age = '2_20'
-            else:
-                raise exceptions.DataNotFound()
+        in the wfh table. (see routing.py) """
+        if self.indicator in ['wfl', 'wfh']:
+            bucket = routing.height_band(self.indicator, D(self.height))
+        elif self.indicator in routing.INDICATORS:
+            bucket = self.age_bucket
         else:
-            if self.table_age is None:
-                if self.table_indicator == 'wfl':
-                    self.table_age = '0_2'
-                if self.table_indicator == 'wfh':
-                    self.table_age = '2_5'
-                if self.age < D(24):
-                    if self.table_indicator == 'wfh':
-                        self.logger.warning('too young for standing')
-                        self.table_indicator == 'wfl'
-                    self.table_age = '0_2'
-                elif self.age >= D(24):
-                    if self.table_indicator == 'wfl':
-                        self.logger.warning('too old for recumbent')
-                        self.table_indicator == 'wfh'
-                    self.table_age = '2_5'
-                else:
-                    raise exceptions.DataNotFound()
-        table = "%(table_indicator)s_%(table_sex)s_%(table_age)s" %\
-                {"table_indicator": self.table_indicator,
-                 "table_sex": self.table_sex,
-                 "table_age": self.table_age}
-        self.logger.debug(table)
-        # raise if any table name parts have not been resolved
-        if not all([self.table_indicator, self.table_sex, self.table_age]):
+            raise exceptions.DataNotFound('table not available for %s' %
+                                          self.indicator)
+        try:
+            route = routing.ROUTES[(self.indicator, self.sex,
+                                    bool(self.american), bucket)]
+        except KeyError:
+            # raise if any table name parts have not been resolved
             raise exceptions.DataError()
-        return table
+        if route.error is not None:
+            raise route.error('TOO OLD: %d' % self.age)
+        if route.warning is not None:
+            self.logger.warning(route.warning)
+        self.table_indicator = route.table_indicator
+        self.table_sex = route.table_sex
+        self.table_age = route.table_age
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(route.table_name)
+        return route.table_name
+
+
+def in_local_context(method):
+    """ Run a Calculator method in a local copy of the calculator's
+    decimal context (see Calculator.context) """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with decimal.localcontext(self.context):
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class Calculator(object):
 
-    def __reformat_table(self, table_name):
-        """ Reformat list of dicts to single dict
-        with each item keyed by age, length, or height."""
-        list_of_dicts = getattr(self, table_name)
-        if 'Length' in list_of_dicts[0]:
-            field_name = 'Length'
-        elif 'Height' in list_of_dicts[0]:
-            field_name = 'Height'
-        elif 'Month' in list_of_dicts[0]:
-            field_name = 'Month'
-        elif 'Week' in list_of_dicts[0]:
-            field_name = 'Week'
-        else:
-            raise exceptions.DataError('error loading: %s' % table_name)
-        new_dict = {'field_name': field_name}
-        for d in list_of_dicts:
-            new_dict.update({d[field_name]: d})
-        setattr(self, table_name, new_dict)
-
     def __init__(self, adjust_height_data=False, adjust_weight_scores=False,
-                 include_cdc=False, logger_name='pygrowup', log_level="INFO"):
+                 include_cdc=False, logger_name='pygrowup', log_level="INFO",
+                 engine='decimal', cache_size=None, cache=None,
+                 instruments=None, age_in_days=False, precision='exact'):
         self.logger = logging.getLogger(logger_name)
         self.logger.setLevel(getattr(logging, log_level))
 
+        # z-scores are calculated with decimal.Decimal by default.
+        # The 'float' engine uses hardware floats, which is much faster
+        # and gives the same z-scores once rounded to the hundredth
+        # (see test_float_engine_parity), but returns floats
+        assert engine in ['decimal', 'float']
+        self.engine = engine
+
         # use decimal.Decimal instead of float to avoid unwanted rounding
         # http://docs.sun.com/source/806-3568/ncg_goldberg.html
-        # TODO set a custom precision
-        self.context = decimal.getcontext()
+        #
+        # self.context holds the settings (e.g., precision) of decimal
+        # arithmetic, copied from the current thread's context. Each
+        # calculation is done in its own local copy of it (see
+        # in_local_context), and tables are read-only, so one Calculator
+        # can be used by any number of threads at once without locks
+        # (including on free-threaded builds of Python)
+        self.context = decimal.getcontext().copy()
+
+        # the decimal engine's precision tier. 'exact' calculates z-scores
+        # in self.context (28 digits by default). 'fast' calculates them in
+        # a working context of FAST_PRECISION digits (or precision digits,
+        # given an int), along with a bound on their error, and calculates
+        # again in self.context any z-score whose bound does not rule out
+        # rounding to another hundredth. Every tier gives the same z-scores
+        # (see _working_zscore)
+        assert precision in ['exact', 'fast'] or (
+            isinstance(precision, int) and precision > 0)
+        self.precision = precision
+        self.working_context = None
+        if precision != 'exact':
+            self.working_context = self.context.copy()
+            self.working_context.prec = FAST_PRECISION if \
+                precision == 'fast' else precision
+            # (working in less precision than the exact tier)
+            assert self.working_context.prec < self.context.prec
 
         # Height adjustments are part of the WHO specification
         # (to correct for recumbent vs standing measurements),
@@ -229,52 +263,81 @@ class Calculator(object):
 
         self.include_cdc = include_cdc
 
-        # load WHO Growth Standards
-        # http://www.who.int/childgrowth/standards/en/
-        # WHO tab-separated txt files have been converted to json,
-        # and the seperate lhfa tables (0-2 and 2-5) have been combined
-
-        WHO_tables = [
-            'wfl_boys_0_2_zscores.json',  'wfl_girls_0_2_zscores.json',
-            'wfh_boys_2_5_zscores.json',  'wfh_girls_2_5_zscores.json',
-            'lhfa_boys_0_5_zscores.json', 'lhfa_girls_0_5_zscores.json',
-            'hcfa_boys_0_5_zscores.json', 'hcfa_girls_0_5_zscores.json',
-            'wfa_boys_0_5_zscores.json',  'wfa_girls_0_5_zscores.json',
-            'wfa_boys_0_13_zscores.json',  'wfa_girls_0_13_zscores.json',
-            'lhfa_boys_0_13_zscores.json', 'lhfa_girls_0_13_zscores.json',
-            'hcfa_boys_0_13_zscores.json', 'hcfa_girls_0_13_zscores.json',
-            'bmifa_boys_0_13_zscores.json', 'bmifa_girls_0_13_zscores.json',
-            'bmifa_boys_0_2_zscores.json',  'bmifa_girls_0_2_zscores.json',
-            'bmifa_boys_2_5_zscores.json',  'bmifa_girls_2_5_zscores.json']
-
-        # load CDC growth standards
-        # http://www.cdc.gov/growthcharts/
-        # CDC csv files have been converted to JSON, and the third standard
-        # deviation has been fudged for the purpose of this tool.
-
-        CDC_tables = [
-            'lhfa_boys_2_20_zscores.cdc.json',
-            'lhfa_girls_2_20_zscores.cdc.json',
-            'wfa_boys_2_20_zscores.cdc.json',
-            'wfa_girls_2_20_zscores.cdc.json',
-            'bmifa_boys_2_20_zscores.cdc.json',
-            'bmifa_girls_2_20_zscores.cdc.json', ]
-
-        # TODO is this the best way to find the tables?
-        table_dir = os.path.join(module_dir, 'tables')
-        tables_to_load = WHO_tables
-        if self.include_cdc:
-            tables_to_load = tables_to_load + CDC_tables
-        for table in tables_to_load:
-            table_file = os.path.join(table_dir, table)
-            with open(table_file, 'r') as f:
-                # drop _zscores.json from table name and use
-                # result as attribute name
-                # (e.g., wfa_boys_0_5_zscores.json => wfa_boys_0_5)
-                table_name, underscore, zscore_part =\
-                    table.split('.')[0].rpartition('_')
-                setattr(self, table_name, json.load(f))
-                self.__reformat_table(table_name)
+        # if age_in_days, ages are given in days rather than months
+        # (e.g., calculator.wfa(weight, 304, sex) for a child of 304
+        # days), and measurements are compared to L, M, and S
+        # interpolated for the day of age (as in WHO's igrowup software)
+        # rather than for the week or month of age
+        self.age_in_days = age_in_days
+
+        # optionally cache z-scores, for applications which see the same
+        # observations over and over (e.g., forms that are validated on
+        # every edit). cache_size is the number of z-scores to keep (least
+        # recently used z-scores are evicted), or a cache (e.g., an
+        # LRUCache) can be shared by several calculators. A SQLiteCache
+        # keeps z-scores from one run to the next (see cache.py)
+        if cache is None and cache_size:
+            cache = caches.LRUCache(cache_size)
+        self.cache = cache
+
+        # optionally count and time the stages of z-score calculations
+        # (see instrumentation.Instruments)
+        self.instruments = instruments
+
+    def __getstate__(self):
+        # pickles (e.g., sent to worker processes) hold only settings and
+        # a handle to the tables: the logger by name and level, and the
+        # compiled tables file which every process memory-maps, sharing
+        # one copy of the tables (see tablestore.Registry.handle)
+        state = dict(self.__dict__)
+        state['logger'] = (self.logger.name, self.logger.level)
+        state['tables'] = tablestore.registry.handle()
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        name, level = state.pop('logger')
+        tablestore.registry.attach(state.pop('tables'))
+        self.__dict__.update(state)
+        self.logger = logging.getLogger(name)
+        self.logger.setLevel(level)
+
+    def cache_info(self):
+        """ Return the CacheInfo(hits, misses, evictions, maxsize,
+        currsize) of the calculator's cache, or None """
+        if self.cache is None:
+            return None
+        return self.cache.info()
+
+    def table(self, name):
+        """ Return a WHO/CDC table by name (e.g., wfa_boys_0_5).
+
+        Tables are loaded the first time they are needed and shared by
+        every Calculator (see tablestore.py). CDC tables are only
+        available if include_cdc is True. """
+        if name in tablestore.WHO_TABLE_NAMES or (
+                name in tablestore.CDC_TABLE_NAMES and self.include_cdc):
+            return tablestore.registry.get(name)
+        raise exceptions.DataNotFound('table not available: %s' % name)
+
+    def load_tables(self):
+        """ Load every table this calculator can use now, rather than
+        the first time each is needed (e.g., before serving requests) """
+        for name in tablestore.TABLE_FILES:
+            try:
+                self.table(name)
+            except exceptions.DataNotFound:
+                pass
+
+    def __getattr__(self, name):
+        # tables are also available as attributes (e.g., calc.wfa_boys_0_5)
+        if name in tablestore.TABLE_FILES and 'include_cdc' in self.__dict__:
+            try:
+                return self.table(name)
+            except exceptions.DataNotFound:
+                pass
+        raise AttributeError("%r object has no attribute %r" %
+                             (self.__class__.__name__, name))
 
     # convenience methods
     def lhfa(self, measurement=None, age_in_months=None, sex=None, height=None):
@@ -313,16 +376,272 @@ class Calculator(object):
                                            age_in_months=age_in_months,
                                            sex=sex, height=height)
 
+    def zscores(self, indicator, measurements, ages, sexes, heights=None):
+        """ Calculate z-scores for equal-length sequences of measurements,
+        ages (in months), sexes, and (for wfl and wfh) heights.
+
+        Rows are grouped by the table they resolve to and calculated with
+        numpy array operations. Returns a float64 numpy array of z-scores
+        rounded to the hundredth; rows which cannot be scored (e.g., blank
+        or invalid measurements, or ages outside of the tables) are NaN.
+        Requires numpy. """
+        from . import batch
+        return batch.zscores(self, indicator, measurements, ages, sexes,
+                             heights=heights)
+
+    @in_local_context
+    def all_zscores(self, weight=None, length_or_height=None,
+                    head_circumference=None, age_in_months=None, sex=None):
+        """ Calculate every z-score a child's measurements allow, in one
+        pass: lhfa (given a length or height), wfa (given a weight), wfl
+        or wfh and bmifa (given both), and hcfa (given a head
+        circumference).
+
+        Age and sex are validated and resolved once for all indicators.
+        Weight-for-length is used under 24 months of age, and
+        weight-for-height from 24 months; BMI is calculated from the
+        weight and length or height. Returns a dict of indicators and
+        z-scores, as zscore_for_measurement returns them, or None for
+        indicators which cannot be calculated (e.g., a length outside of
+        the tables, or hcfa for a child too old for its tables).
+
+        Like zscore_for_measurement, z-scores are cached in self.cache
+        and timed by self.instruments (if given), by indicator. """
+        assert sex is not None
+        assert isinstance(sex, str)
+        assert sex.upper() in ["M", "F"]
+        assert age_in_months is not None
+        blank = ['', ' ', None]
+
+        obs = Observation(None, None, age_in_months, sex, length_or_height,
+                          self.include_cdc, self.logger, self.age_in_days)
+        measurements = []
+        if length_or_height not in blank:
+            measurements.append(("lhfa", length_or_height))
+        if weight not in blank:
+            measurements.append(("wfa", weight))
+            if length_or_height not in blank:
+                measurements.append(("wfl" if obs.age < 24 else "wfh",
+                                     weight))
+                measurements.append(("bmifa", None))
+        if head_circumference not in blank:
+            measurements.append(("hcfa", head_circumference))
+
+        zscores = {}
+        for indicator, measurement in measurements:
+            try:
+                if indicator == "bmifa":
+                    if D(length_or_height) <= D(0):
+                        raise exceptions.InvalidMeasurement(
+                            'length or height must be greater than zero')
+                    #   BMI = weight (kg) / length or height (m) ^ 2
+                    meters = D(length_or_height) / D(100)
+                    measurement = D(weight) / (meters * meters)
+                key = None
+                if self.cache is not None:
+                    key = self._cache_key(indicator, measurement,
+                                          age_in_months, sex,
+                                          length_or_height)
+                zscores[indicator] = self._cached(
+                    key, self._observed_zscore, indicator, measurement, obs)
+            except (RuntimeError, ArithmeticError):
+                zscores[indicator] = None
+        return zscores
+
+    def all_zscores_batch(self, weights=None, lengths_or_heights=None,
+                          head_circumferences=None, ages=None, sexes=None):
+        """ Calculate every z-score equal-length sequences of measurements
+        allow, like all_zscores, with numpy array operations.
+
+        Returns a dict of indicators and float64 numpy arrays of
+        z-scores (NaN for rows which cannot be scored). Both wfl and wfh
+        are included given weights and lengths or heights, each NaN for
+        the rows that use the other. Requires numpy. """
+        from . import batch
+        return batch.all_zscores(self, weights, lengths_or_heights,
+                                 head_circumferences, ages, sexes)
+
     def zscore_for_measurement(self, indicator, measurement, age_in_months, sex, height=None):
+        if self.cache is None:
+            return self._zscore_for_measurement(indicator, measurement,
+                                                age_in_months, sex, height)
+        key = self._cache_key(indicator, measurement, age_in_months, sex,
+                              height)
+        return self._cached(key, self._zscore_for_measurement, indicator,
+                            measurement, age_in_months, sex, height)
+
+    def _cached(self, key, calculate, *args):
+        """ Return the z-score cached for key, or calculate(*args) and
+        cache it. If key is None (see _cache_key), the z-score is
+        calculated without the cache (leaving invalid observations to
+        raise as usual) """
+        if key is None:
+            return calculate(*args)
+        zscore = self.cache.get(key)
+        if zscore is None:
+            zscore = calculate(*args)
+            self.cache.put(key, zscore)
+        return zscore
+
+    def _cache_key(self, indicator, measurement, age_in_months, sex, height):
+        """ Return a key for caching the z-score of an observation, or
+        None if the observation is invalid. Numbers are normalized as
+        decimals (so '8', '8.0' and 8 share a key), and the key includes
+        the settings that change z-scores so calculators with different
+        settings can share a cache. """
+        # (heights are only used by wfl and wfh)
+        if indicator not in ["wfl", "wfh"]:
+            height = None
+        try:
+            key = (indicator, D(measurement), D(age_in_months), sex.upper(),
+                   None if height is None else D(height),
+                   self.adjust_height_data, self.adjust_weight_scores,
+                   self.include_cdc, self.engine, self.age_in_days,
+                   self.context.prec, self.context.rounding)
+            hash(key)
+        except (AttributeError, TypeError, ValueError, ArithmeticError):
+            return None
+        return key
+
+    @in_local_context
+    def _zscore_for_measurement(self, indicator, measurement, age_in_months,
+                                sex, height):
+        if self.instruments is not None:
+            return self._instrumented_zscore(indicator, measurement,
+                                             age_in_months, sex, height)
+        y, obs = self._observe(indicator, measurement, age_in_months, sex,
+                               height)
+        return self._score(indicator, y, obs)
+
+    def _score(self, indicator, y, obs, stopwatch=None):
+        """ Calculate the z-score of an (adjusted) measurement and its
+        Observation, timing its stages with stopwatch (see
+        _instrumented_zscore) if given """
+        # get table and row index from appropriate table
+        # (as obs.get_row does)
+        table_name = obs.resolve_table()
+        if stopwatch is not None:
+            stopwatch.lap('resolution')
+        table, index = obs.find_row(self.table(table_name))
+        if stopwatch is not None:
+            stopwatch.lap('lookup')
+
+        if self.engine == 'float':
+            return self._float_zscore(indicator, float(y), table, index,
+                                      stopwatch)
+        if self._working(table, index):
+            zscore = self._working_zscore(indicator, y, table, index,
+                                          stopwatch)
+            if zscore is not None:
+                return zscore
+            # (recalculating in the exact tier is timed as adjustment)
+            zscore = self._decimal_zscore(indicator, y, table, index)
+            if stopwatch is not None:
+                stopwatch.lap('adjustment')
+            return zscore
+        return self._decimal_zscore(indicator, y, table, index, stopwatch)
+
+    def _observed_zscore(self, indicator, measurement, obs):
+        """ Calculate the z-score of a measurement of an Observation
+        shared by several indicators (see all_zscores), timed by
+        self.instruments if given """
+        stopwatch = None
+        if self.instruments is not None:
+            stopwatch = self.instruments.stopwatch(indicator)
+        try:
+            y = self._measurement(indicator, measurement)
+            # (the observation's age, in months and weeks, and sex are
+            # shared by every indicator)
+            obs.indicator = indicator
+            return self._score(indicator, y, obs, stopwatch)
+        except Exception:
+            if self.instruments is not None:
+                self.instruments.error(indicator)
+            raise
+
+    def _instrumented_zscore(self, indicator, measurement, age_in_months,
+                             sex, height):
+        """ zscore_for_measurement, recording each stage's time in
+        self.instruments """
+        name = indicator.lower() if isinstance(indicator, str) else None
+        if name not in routing.INDICATORS:
+            # (so that caller input neither appears in nor multiplies the
+            # instruments' labels)
+            name = 'invalid'
+        stopwatch = self.instruments.stopwatch(name)
+        try:
+            y, obs = self._observe(indicator, measurement, age_in_months, sex,
+                                   height)
+            return self._score(indicator, y, obs, stopwatch)
+        except Exception:
+            self.instruments.error(name)
+            raise
+
+    @in_local_context
+    def classify(self, indicator, measurement, age_in_months, sex,
+                 height=None):
+        """ Classify a measurement by the band its z-score falls in:
+
+            BELOW_3SD (-3)   z-score below -3
+            BELOW_2SD (-2)   z-score below -2 (but not below -3)
+            NORMAL (0)       z-score from -2 to 2
+            ABOVE_2SD (2)    z-score above 2 (but not above 3)
+            ABOVE_3SD (3)    z-score above 3
+
+        e.g., below -2 is stunting for lhfa, wasting for wfl/wfh, and
+        underweight for wfa. The band is the one that the z-score returned
+        by zscore_for_measurement (rounded to the hundredth, and adjusted
+        if adjust_weight_scores) falls in, but is found by comparing the
+        measurement to cut-offs precomputed for each table row, without
+        calculating the z-score. """
+        y, obs = self._observe(indicator, measurement, age_in_months, sex,
+                               height)
+        table, index = obs.get_row(self)
+        SD3neg, SD2neg, SD2pos, SD3pos = table.cutoffs(
+            self.adjust_weight_scores and indicator in ["wfl", "wfh", "wfa"])
+        y = float(y)
+        if y < SD2neg[index]:
+            if y < SD3neg[index]:
+                return BELOW_3SD
+            return BELOW_2SD
+        if y > SD2pos[index]:
+            if y > SD3pos[index]:
+                return ABOVE_3SD
+            return ABOVE_2SD
+        return NORMAL
+
+    def classify_batch(self, indicator, measurements, ages, sexes,
+                       heights=None):
+        """ Classify equal-length sequences of measurements, ages (in
+        months), sexes, and (for wfl and wfh) heights, like classify.
+
+        Returns a float64 numpy array of bands (e.g., -2.0 for BELOW_2SD);
+        rows which cannot be classified are NaN. Requires numpy. """
+        from . import batch
+        return batch.classify(self, indicator, measurements, ages, sexes,
+                              heights=heights)
+
+    def _observe(self, indicator, measurement, age_in_months, sex, height):
+        """ Validate parameters and return the measurement (adjusted for
+        the indicator, as a decimal.Decimal) and an Observation """
         assert sex is not None
-        assert isinstance(sex, six.string_types)
+        assert isinstance(sex, str)
         assert sex.upper() in ["M", "F"]
         assert age_in_months is not None
         assert indicator is not None
+        assert isinstance(indicator, str)
         assert indicator.lower() in ["lhfa", "wfl", "wfh", "wfa", "bmifa", "hcfa"]
         # reject blank measurements
         assert measurement not in ['', ' ', None]
 
+        y = self._measurement(indicator, measurement)
+        obs = Observation(indicator, measurement, age_in_months, sex, height,
+                          self.include_cdc, self.logger, self.age_in_days)
+        return y, obs
+
+    def _measurement(self, indicator, measurement):
+        """ Return a measurement as a decimal.Decimal, adjusted for the
+        indicator """
         # this is our length or height or weight or bmi measurement.
         # allow exception if measurement cannot be cast as Decimal
         y = D(measurement)
@@ -331,10 +650,8 @@ class Calculator(object):
             # and that would be an impossibly shaped human.
             raise exceptions.InvalidMeasurement('measurement must be greater'
                                                 ' than zero')
-        self.logger.debug("MEASUREMENT: %d" % y)
-
-        obs = Observation(indicator, measurement, age_in_months, sex, height,
-                          self.include_cdc, self.logger.name)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("MEASUREMENT: %s", y)
 
         # indicator-specific methodology
         # (see section 5.1 of http://www.who.int/entity/childgrowth/standards/\
@@ -354,22 +671,29 @@ class Calculator(object):
             # (basically to convert all height measurments to lengths)
             y = y + D('0.7')
 
-        # get zscore from appropriate table
-        zscores = obs.get_zscores(self)
-
-        if zscores is None:
-            raise exceptions.DataNotFound()
-
-        # fetch necessary scores from zscores dict and cast as decimals
+        return y
+
+    def _decimal_zscore(self, indicator, y, table, index, stopwatch=None):
+        """ Calculate z-score with decimal.Decimal arithmetic """
+        zscore, lms = self._decimal_lms(y, table, index)
+        if stopwatch is not None:
+            stopwatch.lap('lms')
+        zscore = self._decimal_adjust(indicator, y, zscore, table, index)
+        if stopwatch is not None:
+            stopwatch.lap('adjustment')
+        return zscore
+
+    def _decimal_lms(self, y, table, index):
+        """ Return the (unrounded, unadjusted) z-score and the L, M, and S
+        values of a table row as decimals """
+        # fetch necessary scores from table and cast as decimals
+        # (repr gives back the digits of the source tables exactly)
         # L(t)
-        box_cox_power = D(zscores.get("L"))
-        self.logger.debug("BOX-COX: %d" % box_cox_power)
+        box_cox_power = D(repr(table.L[index]))
         # M(t)
-        median_for_age = D(zscores.get("M"))
-        self.logger.debug("MEDIAN: %d" % median_for_age)
+        median_for_age = D(repr(table.M[index]))
         # S(t)
-        coefficient_of_variance_for_age = D(zscores.get("S"))
-        self.logger.debug("COEF VAR: %d" % coefficient_of_variance_for_age)
+        coefficient_of_variance_for_age = D(repr(table.S[index]))
 
         ###
         # calculate z-score
@@ -381,27 +705,40 @@ class Calculator(object):
         #   Zind =  -----------------
         #               S(t)L(t)
         ###
-        base = self.context.divide(y, median_for_age)
-        self.logger.debug("BASE: %d" % base)
+        # (the calculation's local context; see in_local_context)
+        context = decimal.getcontext()
+        base = context.divide(y, median_for_age)
         power = base ** box_cox_power
-        self.logger.debug("POWER: %d" % power)
         numerator = D(str(power)) - D(1)
-        self.logger.debug("NUMERATOR: %d" % numerator)
-        denomenator = self.context.multiply(coefficient_of_variance_for_age,
-                                            box_cox_power)
-        self.logger.debug("DENOMENATOR: %d" % denomenator)
-        zscore = self.context.divide(numerator, denomenator)
-        self.logger.debug("ZSCORE: %d" % zscore)
+        denomenator = context.multiply(coefficient_of_variance_for_age,
+                                       box_cox_power)
+        zscore = context.divide(numerator, denomenator)
+        # (check the level first so nothing is formatted
+        # unless debug logging is enabled)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("BOX-COX: %s", box_cox_power)
+            self.logger.debug("MEDIAN: %s", median_for_age)
+            self.logger.debug("COEF VAR: %s", coefficient_of_variance_for_age)
+            self.logger.debug("BASE: %s", base)
+            self.logger.debug("POWER: %s", power)
+            self.logger.debug("NUMERATOR: %s", numerator)
+            self.logger.debug("DENOMENATOR: %s", denomenator)
+            self.logger.debug("ZSCORE: %s", zscore)
 
         # TODO this is probably unneccesary, as it should work out to be the
         # same as the above z-score calculation
         # if indicator == "lhfa":
-        #    numerator_lhfa = self.context.subtract(D(y), median_for_age)
-        #    denomenator_lhfa = self.context.multiply(median_for_age,\
+        #    numerator_lhfa = context.subtract(D(y), median_for_age)
+        #    denomenator_lhfa = context.multiply(median_for_age,\
         #        coefficient_of_variance_for_age)
-        #    zscore_lhfa = self.context.divide(numerator_lhfa, denomenator_lhfa)
+        #    zscore_lhfa = context.divide(numerator_lhfa, denomenator_lhfa)
         #    zscore = zscore_lhfa
+        return zscore, (box_cox_power, median_for_age,
+                        coefficient_of_variance_for_age)
 
+    def _decimal_adjust(self, indicator, y, zscore, table, index):
+        """ Round a z-score, applying the restricted LMS method to z-scores
+        beyond +/- 3 if adjust_weight_scores """
         # return z-score unless adjust_weight_scores indicates that
         # further processing is desired (see comment in __init__())
         if not self.adjust_weight_scores:
@@ -442,59 +779,169 @@ class Calculator(object):
                 #           |          SD23neg
                 #           |
                 #           |_
-                def calc_stdev(sd):
-                    #   e.g.,
-                    #
-                    #   SD3neg = M(t)[1 + L(t) * S(t) * (-3)]^ 1/L(t)
-                    #   SD2pos = M(t)[1 + L(t) * S(t) * (2)]^ 1/L(t)
-                    #
-                    ###
-                    base = self.context.add(D(1), self.context.multiply(
-                        self.context.multiply(box_cox_power,
-                                              coefficient_of_variance_for_age), D(sd)))
-                    exponent = self.context.divide(D(1), box_cox_power)
-                    power = math.pow(base, exponent)
-                    stdev = self.context.multiply(median_for_age, D(str(power)))
-                    return D(stdev)
+                #
+                # SD3pos, SD3neg, and the distances SD23pos and SD23neg
+                # depend only on the table row, so they are calculated
+                # when the table is loaded (see Table.tails)
+                SD3neg_c, SD23neg_c, SD3pos_c, SD23pos_c = table.tails()
+                context = decimal.getcontext()
 
                 if (zscore > D(3)):
-                    logging.info("Z greater than 3")
-                    # TODO measure performance of lookup vs calculation
-                    # calculate for now so we have greater precision
-
-                    # get cutoffs from z-scores dict
-                    # SD2pos = D(zscores.get("SD2"))
-                    # SD3pos = D(zscores.get("SD3"))
-
-                    # calculate SD
-                    SD2pos_c = calc_stdev(2)
-                    SD3pos_c = calc_stdev(3)
-
-                    # compute distance
-                    SD23pos_c = SD3pos_c - SD2pos_c
-
                     # compute final z-score
                     # zscore = D(3) + ((y - SD3pos_c)/SD23pos_c)
-                    sub = self.context.subtract(D(y), SD3pos_c)
-                    div = self.context.divide(sub, SD23pos_c)
-                    zscore = self.context.add(D(3), div)
+                    sub = context.subtract(D(y), D(repr(SD3pos_c[index])))
+                    div = context.divide(sub, D(repr(SD23pos_c[index])))
+                    zscore = context.add(D(3), div)
                     return zscore.quantize(D('.01'))
 
                 if (zscore < D(-3)):
-                    # get cutoffs from z-scores dict
-                    # SD2neg = D(zscores.get("SD2neg"))
-                    # SD3neg = D(zscores.get("SD3neg"))
-
-                    # calculate SD
-                    SD2neg_c = calc_stdev(-2)
-                    SD3neg_c = calc_stdev(-3)
-
-                    # compute distance
-                    SD23neg_c = SD2neg_c - SD3neg_c
-
                     # compute final z-score
                     # zscore = D(-3) + ((y - SD3neg_c)/SD23neg_c)
-                    sub = self.context.subtract(D(y), SD3neg_c)
-                    div = self.context.divide(sub, SD23neg_c)
-                    zscore = self.context.add(D(-3), div)
+                    sub = context.subtract(D(y), D(repr(SD3neg_c[index])))
+                    div = context.divide(sub, D(repr(SD23neg_c[index])))
+                    zscore = context.add(D(-3), div)
                     return zscore.quantize(D('.01'))
+
+    def _working(self, table, index):
+        """ Return True if a z-score for a table row is calculated in the
+        working context of a reduced precision tier: with the decimal
+        engine, for rows whose L is not an integer (integral powers, e.g.,
+        for lhfa and hcfa, are as fast in the exact tier) """
+        return (self.working_context is not None and
+                self.engine == 'decimal' and
+                not table.L[index].is_integer())
+
+    def _working_zscore(self, indicator, y, table, index, stopwatch=None):
+        """ Calculate a z-score in the working context of a reduced
+        precision tier (see __init__), or return None if it must be
+        calculated again in the exact tier.
+
+        The error of every decimal operation is at most an ulp (a unit in
+        its last place), so the error of the z-score is bounded (see
+        _working_lms). The exact tier's z-score is within the same bound
+        of the true z-score (with its greater precision, its error is
+        smaller), so if no value within twice the bound of the z-score
+        rounds to another hundredth (or, for adjust_weight_scores, is on
+        the other side of +/- 3), both tiers round to the same
+        hundredth. """
+        with decimal.localcontext(self.working_context):
+            zscore, bound = self._working_lms(y, table, index)
+            if stopwatch is not None:
+                stopwatch.lap('lms')
+            zscore = self._working_adjust(indicator, y, zscore, bound,
+                                          table, index)
+        if zscore is None:
+            return None
+        # (rounded in the exact tier's context, as _decimal_adjust does)
+        zscore = zscore.quantize(D('.01'))
+        if stopwatch is not None:
+            stopwatch.lap('adjustment')
+        return zscore
+
+    def _working_lms(self, y, table, index):
+        """ Return the (unrounded, unadjusted) z-score calculated in the
+        working context, and a bound on its error """
+        box_cox_power = D(repr(table.L[index]))
+        median_for_age = D(repr(table.M[index]))
+        coefficient_of_variance_for_age = D(repr(table.S[index]))
+
+        # (as _decimal_lms, but with the power calculated by exp and ln,
+        # which are several times faster than ** for non-integral powers)
+        context = decimal.getcontext()
+        base = context.divide(y, median_for_age)
+        exponent = context.multiply(box_cox_power, base.ln())
+        power = exponent.exp()
+        numerator = context.subtract(power, D(1))
+        denomenator = context.multiply(coefficient_of_variance_for_age,
+                                       box_cox_power)
+        zscore = context.divide(numerator, denomenator)
+
+        # relative to u, an ulp of 1 (i.e., within the relative error of
+        # any one operation), the errors are at most:
+        #   base                u
+        #   exponent            u * (|L| + |exponent|)
+        #   power               u * power * (|L| + |exponent| + 1)
+        #   numerator           that, plus u * |numerator|
+        #   zscore              that over |denomenator|, plus
+        #                       u * |zscore| for denomenator and division
+        # (doubled, for the products of errors)
+        u = D(1).scaleb(1 - context.prec)
+        bound = 2 * u * (
+            (power * (abs(box_cox_power) + abs(exponent) + 1) +
+             abs(numerator)) / abs(denomenator) + abs(zscore))
+        return zscore, bound
+
+    def _working_adjust(self, indicator, y, zscore, bound, table, index):
+        """ Apply the restricted LMS method to a z-score calculated in the
+        working context (see _decimal_adjust), returning None if its error
+        bound does not rule out the exact z-score being adjusted otherwise
+        or rounding to another hundredth """
+        context = decimal.getcontext()
+        # (see _working_zscore)
+        margin = 2 * bound
+        if self.adjust_weight_scores and indicator in ["wfl", "wfh", "wfa"]:
+            if abs(abs(zscore) - D(3)) <= margin:
+                return None
+            if abs(zscore) > D(3):
+                SD3neg_c, SD23neg_c, SD3pos_c, SD23pos_c = table.tails()
+                if zscore > D(3):
+                    limit, SD3, SD23 = D(3), SD3pos_c, SD23pos_c
+                else:
+                    limit, SD3, SD23 = D(-3), SD3neg_c, SD23neg_c
+                sub = context.subtract(y, D(repr(SD3[index])))
+                div = context.divide(sub, D(repr(SD23[index])))
+                zscore = context.add(limit, div)
+                # (sub and div within u * |div|, and the sum within
+                # u * |zscore| of that; doubled, and doubled again as
+                # above)
+                margin = 4 * D(1).scaleb(1 - context.prec) * (
+                    abs(div) + abs(zscore))
+
+        # the distance from the z-score to the closest value at which its
+        # hundredth changes: a half hundredth, or for rounding other than
+        # to nearest (e.g., ROUND_FLOOR), a hundredth
+        scaled = zscore.scaleb(2)
+        fraction = scaled - scaled.to_integral_value(decimal.ROUND_FLOOR)
+        if self.context.rounding in [decimal.ROUND_HALF_EVEN,
+                                     decimal.ROUND_HALF_UP,
+                                     decimal.ROUND_HALF_DOWN]:
+            distance = abs(fraction - D('0.5'))
+        else:
+            distance = min(fraction, 1 - fraction)
+        if distance.scaleb(-2) <= margin:
+            return None
+        return zscore
+
+    def _float_zscore(self, indicator, y, table, index, stopwatch=None):
+        """ Calculate z-score with float arithmetic
+        (see _decimal_zscore for the methodology) """
+        zscore, lms = self._float_lms(y, table, index)
+        if stopwatch is not None:
+            stopwatch.lap('lms')
+        zscore = self._float_adjust(indicator, y, zscore, table, index)
+        if stopwatch is not None:
+            stopwatch.lap('adjustment')
+        return zscore
+
+    def _float_lms(self, y, table, index):
+        box_cox_power = table.L[index]
+        median_for_age = table.M[index]
+        coefficient_of_variance_for_age = table.S[index]
+
+        zscore = (((y / median_for_age) ** box_cox_power - 1) /
+                  (coefficient_of_variance_for_age * box_cox_power))
+        return zscore, (box_cox_power, median_for_age,
+                        coefficient_of_variance_for_age)
+
+    def _float_adjust(self, indicator, y, zscore, table, index):
+        if (self.adjust_weight_scores and indicator in ["wfl", "wfh", "wfa"]
+                and abs(zscore) > 3):
+            # restricted application of LMS method
+            SD3neg, SD23neg, SD3pos, SD23pos = table.tails()
+            if zscore > 3:
+                zscore = 3 + (y - SD3pos[index]) / SD23pos[index]
+            else:
+                zscore = -3 + (y - SD3neg[index]) / SD23neg[index]
+
+        # round to hundreth and return
+        return round(zscore, 2)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+""" Routing of observations to WHO/CDC tables.
+
+The table an observation is scored with depends only on its indicator,
+its sex, whether CDC tables are used, and which bucket its age (or, for
+wfl and wfh, its length/height) falls in. Every combination is resolved
+once, when this module is imported, into a Route in ROUTES, so routing an
+observation is a single dict lookup:
+
+    ROUTES[(indicator, sex, american, bucket)]
+
+Age buckets:
+
+    WEEKS       up to 13 weeks (the 0_13 tables, by week)
+    UNDER_24    under 24 months
+    TO_60       24 to 60 months
+    TO_240      over 60 months, up to 240 months
+    OVER_240    over 240 months
+
+Height bands (for wfl and wfh):
+
+    RECUMBENT   lengths (up to 86cm for wfl, under 65cm for wfh)
+    STANDING    heights (over 86cm for wfl, 65cm and over for wfh)
+"""
+import collections
+
+from . import exceptions
+
+INDICATORS = ["lhfa", "wfl", "wfh", "wfa", "bmifa", "hcfa"]
+SEXES = {"M": "boys", "F": "girls"}
+
+# age buckets
+WEEKS, UNDER_24, TO_60, TO_240, OVER_240 = range(5)
+AGE_BUCKETS = [WEEKS, UNDER_24, TO_60, TO_240, OVER_240]
+
+# height bands
+RECUMBENT, STANDING = range(2)
+HEIGHT_BANDS = [RECUMBENT, STANDING]
+
+# table_name is None if error (an exception class) is to be raised
+# instead; warning is a message to log about the observation, or None
+Route = collections.namedtuple('Route', [
+    'table_indicator', 'table_sex', 'table_age', 'table_name', 'warning',
+    'error'])
+
+
+def age_bucket(age, age_in_weeks):
+    """ Return the bucket of an age in months (and in weeks) """
+    if age_in_weeks <= 13:
+        return WEEKS
+    if age < 24:
+        return UNDER_24
+    if age <= 60:
+        return TO_60
+    if age <= 240:
+        return TO_240
+    return OVER_240
+
+
+def height_band(indicator, height):
+    """ Return the band of a wfl or wfh length/height (in centimeters) """
+    if indicator == "wfl":
+        return STANDING if height > 86 else RECUMBENT
+    return RECUMBENT if height < 65 else STANDING
+
+
+def resolve(indicator, sex, american, bucket):
+    """ Return the Route for an indicator, sex ('M' or 'F'), use of CDC
+    tables (american), and age bucket or height band """
+    warning = None
+    if indicator in ["wfl", "wfh"]:
+        # children too long for the recumbent tables are looked up in the
+        # standing tables, and children too short for the standing tables
+        # in the recumbent tables
+        if bucket == STANDING:
+            table_indicator, table_age = "wfh", "2_5"
+            if indicator == "wfl":
+                warning = 'too long for recumbent'
+        else:
+            table_indicator, table_age = "wfl", "0_2"
+            if indicator == "wfh":
+                warning = 'too short for standing'
+    elif indicator == "bmifa":
+        table_indicator = indicator
+        if bucket == OVER_240:
+            return Route(None, None, None, None, None, exceptions.InvalidAge)
+        table_age = {WEEKS: "0_13", UNDER_24: "0_2", TO_60: "2_5",
+                     TO_240: "2_20"}[bucket]
+    else:
+        # weight for age has only one table per sex,
+        # as does head circumference for age
+        # and CDC goes unused before 24mos
+        table_indicator = indicator
+        if bucket == WEEKS:
+            table_age = "0_13"
+        elif american and bucket != UNDER_24:
+            if indicator == "hcfa":
+                return Route(None, None, None, None, None,
+                             exceptions.InvalidAge)
+            table_age = "2_20"
+        else:
+            table_age = "0_5"
+    table_sex = SEXES[sex]
+    return Route(table_indicator, table_sex, table_age,
+                 "%s_%s_%s" % (table_indicator, table_sex, table_age),
+                 warning, None)
+
+
+def build():
+    """ Return a dict of every (indicator, sex, american, bucket) and its
+    Route """
+    routes = {}
+    for indicator in INDICATORS:
+        buckets = HEIGHT_BANDS if indicator in ["wfl", "wfh"] else \
+            AGE_BUCKETS
+        for sex in SEXES:
+            for american in [False, True]:
+                for bucket in buckets:
+                    routes[(indicator, sex, american, bucket)] = resolve(
+                        indicator, sex, american, bucket)
+    return routes
+
+
+ROUTES = build()
+
+
+def routes(indicator, american):
+    """ Return a list of (bucket, sex, Route) for an indicator """
+    return [(bucket, sex, route)
+            for (route_indicator, sex, route_american, bucket), route
+            in sorted(ROUTES.items())
+            if route_indicator == indicator and route_american == american]
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+""" A z-score HTTP service.
+
+Serves z-scores as JSON from one Calculator, whose tables are loaded once
+when the server starts. Connections are kept alive (HTTP/1.1), so clients
+can make any number of requests on one connection::
+
+    $ python -m pygrowup.server --port 8000
+
+    GET  /zscore/<indicator>?measurement=8.0&age=9&sex=M[&height=70]
+    POST /zscore/<indicator>  {"measurement": 8.0, "age": 9, "sex": "M"}
+        -> {"zscore": -0.98}
+        -> {"error": "InvalidMeasurement", "message": "..."} (status 400)
+
+    POST /zscores  {"observations": [{"indicator": "wfa", "measurement":
+                    8.0, "age": 9, "sex": "M"}, ...]}
+        -> {"results": [{"zscore": -0.98}, {"error": ..., "message": ...},
+                        ...]}
+
+    GET  /stats
+        -> {"requests": ..., "observations": ..., "requests_per_second":
+            ..., "latency_ms": {"p50": ..., "p90": ..., "p99": ...}, ...}
+
+Indicators are lhfa, wfl, wfh, wfa, bmifa, and hcfa. Ages are in months
+(or in days, with --age-in-days).
+"""
+import sys
+import json
+import time
+import argparse
+import threading
+import collections
+from urllib.parse import urlsplit, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import parallel
+from . import routing
+from .pygrowup import Calculator
+
+# largest request body accepted, in bytes
+MAX_BODY = 16 * 1024 * 1024
+
+
+class Stats(object):
+    """ Thread-safe counts of requests and observations, and the
+    latencies of recent requests """
+
+    def __init__(self, window=10000):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.observations = 0
+        self.latencies = collections.deque(maxlen=window)
+
+    def record(self, seconds, observations, error=False):
+        with self._lock:
+            self.requests += 1
+            self.errors += error
+            self.observations += observations
+            self.latencies.append(seconds)
+
+    def as_dict(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            requests, errors = self.requests, self.errors
+            observations = self.observations
+        uptime = time.time() - self.started
+        result = {
+            'uptime_seconds': uptime,
+            'requests': requests,
+            'errors': errors,
+            'observations': observations,
+            'requests_per_second': requests / uptime if uptime else 0,
+            'observations_per_second': observations / uptime if uptime else 0,
+            'latency_ms': {},
+        }
+        if latencies:
+            for name, fraction in [('p50', 0.5), ('p90', 0.9),
+                                   ('p99', 0.99)]:
+                # (nearest rank)
+                index = min(int(fraction * len(latencies)),
+                            len(latencies) - 1)
+                result['latency_ms'][name] = latencies[index] * 1000
+            result['latency_ms']['max'] = latencies[-1] * 1000
+        return result
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def observation(values, indicator=None):
+    """ Return an (indicator, measurement, age, sex, height) tuple from a
+    dict of request values """
+    if not isinstance(values, dict):
+        raise HTTPError(400, 'observations must be JSON objects')
+    return (indicator or values.get('indicator'), values.get('measurement'),
+            values.get('age'), values.get('sex'), values.get('height'))
+
+
+def result(zscore, error):
+    if error is not None:
+        return {'error': type(error).__name__, 'message': str(error)}
+    return {'zscore': float(zscore)}
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep connections alive
+    protocol_version = 'HTTP/1.1'
+    # and send responses right away (rather than waiting, with Nagle's
+    # algorithm, for the client to acknowledge the headers)
+    disable_nagle_algorithm = True
+    server_version = 'pygrowup'
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        started = time.perf_counter()
+        observations = 0
+        status = 200
+        try:
+            path, query = self.parse()
+            if path == '/stats' and self.command == 'GET':
+                body = self.server.stats.as_dict()
+            elif path.startswith('/zscore/'):
+                indicator = path[len('/zscore/'):]
+                if indicator not in routing.INDICATORS:
+                    raise HTTPError(404, 'unknown indicator: %s' % indicator)
+                values = self.read_json() if self.command == 'POST' else \
+                    query
+                zscore, error = parallel.score(
+                    self.server.calculator,
+                    [observation(values, indicator)])[0]
+                body = result(zscore, error)
+                observations = 1
+                if error is not None:
+                    status = 400
+            elif path == '/zscores' and self.command == 'POST':
+                values = self.read_json()
+                if isinstance(values, dict):
+                    values = values.get('observations')
+                if not isinstance(values, list):
+                    raise HTTPError(400, 'expected a list of observations')
+                results = parallel.score(
+                    self.server.calculator,
+                    [observation(value) for value in values])
+                body = {'results': [result(zscore, error)
+                                    for zscore, error in results]}
+                observations = len(results)
+            else:
+                raise HTTPError(404, 'not found')
+        except HTTPError as e:
+            status = e.status
+            body = {'error': 'HTTPError', 'message': str(e)}
+        except Exception as e:
+            # (so the client still gets a response, and the request is
+            # still counted)
+            self.log_error('error handling %s: %r', self.path, e)
+            status = 500
+            body = {'error': type(e).__name__, 'message': str(e)}
+        self.respond(status, body)
+        self.server.stats.record(time.perf_counter() - started,
+                                 observations, status != 200)
+
+    def parse(self):
+        url = urlsplit(self.path)
+        return url.path.rstrip('/') or '/', dict(parse_qsl(url.query))
+
+    def read_json(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            raise HTTPError(400, 'invalid Content-Length')
+        if length < 0:
+            # (reading would wait for the connection to close)
+            raise HTTPError(400, 'invalid Content-Length')
+        if length > MAX_BODY:
+            raise HTTPError(413, 'request body too large')
+        try:
+            return json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            raise HTTPError(400, 'invalid JSON')
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, calculator=None, verbose=False):
+        ThreadingHTTPServer.__init__(self, address, Handler)
+        # rather than warning about each observation that is
+        # switched between wfl and wfh tables
+        self.calculator = calculator or Calculator(log_level='ERROR')
+        self.calculator.load_tables()
+        self.stats = Stats()
+        self.verbose = verbose
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pygrowup.server',
+        description='Serve z-scores over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to listen on (default: %(default)s)')
+    parser.add_argument('--engine', choices=['decimal', 'float'],
+                        default='decimal')
+    parser.add_argument('--precision', choices=['exact', 'fast'],
+                        default='exact',
+                        help='precision tier of the decimal engine; both '
+                             'give the same z-scores (default: %(default)s)')
+    parser.add_argument('--adjust-height-data', action='store_true')
+    parser.add_argument('--adjust-weight-scores', action='store_true')
+    parser.add_argument('--include-cdc', action='store_true')
+    parser.add_argument('--age-in-days', action='store_true',
+                        help='ages are in days rather than months')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log each request')
+    args = parser.parse_args(argv)
+
+    calculator = Calculator(
+        adjust_height_data=args.adjust_height_data,
+        adjust_weight_scores=args.adjust_weight_scores,
+        include_cdc=args.include_cdc, engine=args.engine,
+        precision=args.precision, age_in_days=args.age_in_days,
+        log_level='ERROR')
+    server = Server((args.host, args.port), calculator, args.verbose)
+    sys.stderr.write('serving z-scores on http://%s:%d\n' %
+                     server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
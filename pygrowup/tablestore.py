@@ -0,0 +1,575 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+""" Loading of WHO/CDC tables.
+
+The JSON tables in pygrowup/tables are compiled into a single binary file
+(tables/zscores.bin) of little-endian float64 columns, which is
+memory-mapped when tables are loaded, so no parsing or per-row objects
+are needed. The compiled file records a SHA-256 digest of the JSON
+sources it was built from. After changing a JSON table, rebuild it with::
+
+    $ python -m pygrowup.tablestore
+
+If the compiled file is missing, tables are loaded from JSON instead.
+"""
+import os
+import sys
+import math
+import mmap
+import atexit
+import array
+import struct
+import logging
+import decimal
+import threading
+from decimal import Decimal as D
+
+from . import exceptions
+
+
+module_dir = os.path.split(os.path.abspath(__file__))[0]
+table_dir = os.path.join(module_dir, 'tables')
+compiled_path = os.path.join(table_dir, 'zscores.bin')
+
+# load WHO Growth Standards
+# http://www.who.int/childgrowth/standards/en/
+# WHO tab-separated txt files have been converted to json,
+# and the seperate lhfa tables (0-2 and 2-5) have been combined
+WHO_TABLES = [
+    'wfl_boys_0_2_zscores.json',  'wfl_girls_0_2_zscores.json',
+    'wfh_boys_2_5_zscores.json',  'wfh_girls_2_5_zscores.json',
+    'lhfa_boys_0_5_zscores.json', 'lhfa_girls_0_5_zscores.json',
+    'hcfa_boys_0_5_zscores.json', 'hcfa_girls_0_5_zscores.json',
+    'wfa_boys_0_5_zscores.json',  'wfa_girls_0_5_zscores.json',
+    'wfa_boys_0_13_zscores.json',  'wfa_girls_0_13_zscores.json',
+    'lhfa_boys_0_13_zscores.json', 'lhfa_girls_0_13_zscores.json',
+    'hcfa_boys_0_13_zscores.json', 'hcfa_girls_0_13_zscores.json',
+    'bmifa_boys_0_13_zscores.json', 'bmifa_girls_0_13_zscores.json',
+    'bmifa_boys_0_2_zscores.json',  'bmifa_girls_0_2_zscores.json',
+    'bmifa_boys_2_5_zscores.json',  'bmifa_girls_2_5_zscores.json']
+
+# load CDC growth standards
+# http://www.cdc.gov/growthcharts/
+# CDC csv files have been converted to JSON, and the third standard
+# deviation has been fudged for the purpose of this tool.
+CDC_TABLES = [
+    'lhfa_boys_2_20_zscores.cdc.json',
+    'lhfa_girls_2_20_zscores.cdc.json',
+    'wfa_boys_2_20_zscores.cdc.json',
+    'wfa_girls_2_20_zscores.cdc.json',
+    'bmifa_boys_2_20_zscores.cdc.json',
+    'bmifa_girls_2_20_zscores.cdc.json', ]
+
+# columns kept from the source tables, in the order they are stored
+SOURCE_COLUMNS = ['L', 'M', 'S', 'SD3neg', 'SD2neg', 'SD1neg', 'SD0', 'SD1',
+                  'SD2', 'SD3']
+# columns computed from L, M, and S when tables are loaded (see tails)
+TAIL_COLUMNS = ['SD3neg_c', 'SD23neg_c', 'SD3pos_c', 'SD23pos_c']
+COLUMNS = SOURCE_COLUMNS + TAIL_COLUMNS
+KEY_FIELDS = ['Length', 'Height', 'Month', 'Week']
+
+# z-scores are rounded to the hundredth
+HALF_HUNDREDTH = 0.005
+
+# days in each step of tables keyed by age (see Table.days), and in the
+# months of ages (e.g., for routing ages in months to tables by week)
+DAYS_PER_WEEK = 7.0
+DAYS_PER_MONTH = 30.4375
+
+MAGIC = b'PYGROWUP'
+FORMAT_VERSION = 3
+# magic, format version, column count, digest of sources, table count
+HEADER = struct.Struct('<8sHH32sI')
+COLUMN_NAME = struct.Struct('<16s')
+# table name, key field name, first key, key step, row count,
+# reserved, offset of first column
+ENTRY = struct.Struct('<24s8sddIIQ')
+# suffix of the names of the tables of replaced rows (see Table.replaced)
+REPLACED = '_replaced'
+
+
+def table_name(file_name):
+    """ Drop _zscores.json from a table's file name
+    (e.g., wfa_boys_0_5_zscores.json => wfa_boys_0_5) """
+    name, underscore, zscore_part = file_name.split('.')[0].rpartition('_')
+    return name
+
+
+TABLE_FILES = dict((table_name(file_name), file_name)
+                   for file_name in WHO_TABLES + CDC_TABLES)
+WHO_TABLE_NAMES = frozenset(table_name(file_name) for file_name in WHO_TABLES)
+CDC_TABLE_NAMES = frozenset(table_name(file_name) for file_name in CDC_TABLES)
+
+
+class Table(object):
+    """ A WHO/CDC table held as read-only columns of floats.
+
+    Rows are keyed by age (in weeks or months), length, or height, which
+    increase by a constant step from the first row, so rows are found by
+    their position rather than by their key. The L, M, and S columns are
+    also attributes of the table.
+
+    replaced is a table of the rows which later rows with the same key
+    replaced in the source table (e.g., the length rows of lhfa tables at
+    24 months, where they switch to heights), or None. """
+
+    def __init__(self, name, field_name, start, step, columns,
+                 replaced=None):
+        self.name = name
+        self.field_name = field_name
+        self.start = start
+        self.step = step
+        self.columns = columns
+        self.replaced = replaced
+        self.L = columns['L']
+        self.M = columns['M']
+        self.S = columns['S']
+        # number of steps from zero to the first row
+        self.first = int(round(start / step))
+        # classification cut-offs, by whether tails are adjusted
+        self._cutoffs = {}
+        self._tails = None
+        # the table by age in days
+        self._days = None
+
+    def __len__(self):
+        return len(self.L)
+
+    def __repr__(self):
+        return "<Table %s (%d rows)>" % (self.name, len(self))
+
+    def position(self, steps):
+        """ Return the index of the row for an integer number of steps
+        from zero (e.g., weeks, months or half centimeters), or None if
+        the table has no such row. """
+        index = steps - self.first
+        if 0 <= index < len(self.L):
+            return index
+        return None
+
+    def index(self, key):
+        """ Return the row index for a key (e.g., '60' or '60.5'),
+        or None if the table has no such row. """
+        steps = float(key) / self.step
+        if steps != int(steps):
+            return None
+        return self.position(int(steps))
+
+    def row(self, index):
+        """ Return a row as a dict of strings, like the rows of the
+        source tables. """
+        # repr gives back the digits of the source tables exactly
+        row = dict((column, repr(self.columns[column][index]))
+                   for column in SOURCE_COLUMNS if column in self.columns)
+        row[self.field_name] = repr(self.start + index * self.step)
+        return row
+
+    def get(self, key, default=None):
+        """ Return the row for a key (e.g., '60' or '60.5') as a dict """
+        index = self.index(key)
+        if index is None:
+            return default
+        return self.row(index)
+
+    def tails(self):
+        """ Return the SD3neg_c, SD23neg_c, SD3pos_c, and SD23pos_c
+        columns: the measurements at z-scores of -3 and +3, and the
+        distances between those at -2 and -3 and at +2 and +3, as used by
+        the restricted application of the LMS method (see
+        Calculator.zscore_for_measurement).
+
+        Tables loaded from JSON (and so the compiled tables) have these
+        columns; tables by age in days compute them the first time they
+        are needed. """
+        if self._tails is None:
+            if all(column in self.columns for column in TAIL_COLUMNS):
+                tails = self.columns
+            else:
+                tails = tail_columns(self.L, self.M, self.S)
+            self._tails = tuple(tails[column] for column in TAIL_COLUMNS)
+        return self._tails
+
+    def cutoffs(self, adjusted=False):
+        """ Return columns of the measurements below which z-scores fall
+        below -3 and -2, and above which they rise above 2 and 3, once
+        rounded to the hundredth (i.e., z-scores of -3.005, -2.005, 2.005
+        and 3.005, which round toward -3, -2, 2 and 3). If adjusted,
+        z-scores beyond +/- 3 are those of the restricted application
+        of the LMS method (see Calculator.zscore_for_measurement).
+
+        Cut-offs are computed the first time they are needed. """
+        cutoffs = self._cutoffs.get(adjusted)
+        if cutoffs is None:
+            cutoffs = [array.array('d') for i in range(4)]
+            tails = zip(*self.tails()) if adjusted else [None] * len(self)
+            for L, M, S, tail in zip(self.L, self.M, self.S, tails):
+                SD3neg = measurement_at(L, M, S, -3 - HALF_HUNDREDTH)
+                SD2neg = measurement_at(L, M, S, -2 - HALF_HUNDREDTH)
+                SD2pos = measurement_at(L, M, S, 2 + HALF_HUNDREDTH)
+                SD3pos = measurement_at(L, M, S, 3 + HALF_HUNDREDTH)
+                if adjusted:
+                    SD3neg_c, SD23neg_c, SD3pos_c, SD23pos_c = tail
+                    SD3neg = SD3neg_c - HALF_HUNDREDTH * SD23neg_c
+                    SD3pos = SD3pos_c + HALF_HUNDREDTH * SD23pos_c
+                for column, value in zip(cutoffs,
+                                         [SD3neg, SD2neg, SD2pos, SD3pos]):
+                    column.append(value)
+            cutoffs = self._cutoffs[adjusted] = tuple(
+                memoryview(column.tobytes()).cast('d') for column in cutoffs)
+        return cutoffs
+
+    def days(self):
+        """ Return a table (keyed by 'Day') of L, M, and S for each day of
+        age this table covers, interpolated linearly between its rows
+        (by week or by month, taking a month to be 30.4375 days). Days
+        after the last row, up to the next week or month, take the last
+        row's values (as they do when looked up by week or month). Days
+        before a replaced row (see replaced) are interpolated toward it,
+        e.g., lhfa toward the length row at 24 months rather than the
+        height row.
+
+        Interpolated tables are built the first time they are needed, so
+        looking up a day is as quick as looking up a week or month. """
+        if self._days is None:
+            days_per_step = self.step * {
+                'Week': DAYS_PER_WEEK, 'Month': DAYS_PER_MONTH}[
+                    self.field_name]
+            first_day = self.start / self.step * days_per_step
+            end_day = first_day + len(self) * days_per_step
+            columns = dict((column, array.array('d'))
+                           for column in ['L', 'M', 'S'])
+            for day in range(int(math.ceil(first_day)),
+                             int(math.ceil(end_day))):
+                steps = (day - first_day) / days_per_step
+                index = int(steps)
+                fraction = steps - index
+                # the row interpolated toward
+                following, source = index + 1, self.columns
+                if self.replaced is not None:
+                    position = self.replaced.position(self.first + index + 1)
+                    if position is not None:
+                        following, source = position, self.replaced.columns
+                for column, values in columns.items():
+                    value = self.columns[column][index]
+                    if fraction and index + 1 < len(self):
+                        value += fraction * (source[column][following] -
+                                             value)
+                    values.append(value)
+            self._days = Table(
+                self.name + '_days', 'Day', float(math.ceil(first_day)), 1.0,
+                dict((column, memoryview(values.tobytes()).cast('d'))
+                     for column, values in columns.items()))
+        return self._days
+
+
+def measurement_at(L, M, S, zscore):
+    """ Return the measurement with a z-score (by the LMS method) """
+    #   y = M(t)[1 + L(t) * S(t) * Zind]^ 1/L(t)
+    base = 1 + L * S * zscore
+    if base <= 0:
+        # z-scores are bounded on this side of the median,
+        # so no measurement reaches this one
+        return 0.0 if zscore < 0 else float('inf')
+    return M * base ** (1 / L)
+
+
+def tail_columns(Ls, Ms, Ss):
+    """ Return a dict of the tail columns (see Table.tails) for columns
+    of L, M, and S.
+
+    Measurements are calculated with 25 significant digits (enough that
+    each is the float nearest its exact value), then stored as floats. """
+    context = decimal.Context(prec=25)
+    columns = dict((column, array.array('d')) for column in TAIL_COLUMNS)
+
+    def stdev(L, M, S, sd):
+        #   e.g., SD3neg = M(t)[1 + L(t) * S(t) * (-3)]^ 1/L(t)
+        base = context.add(1, context.multiply(context.multiply(L, S), sd))
+        if base <= 0:
+            # z-scores are bounded on this side of the median (e.g., in
+            # some CDC BMI tables), so no measurement has this one
+            return D('NaN')
+        return context.multiply(M, context.exp(
+            context.divide(context.ln(base), L)))
+
+    for L, M, S in zip(Ls, Ms, Ss):
+        # (repr gives back the digits of the source tables exactly)
+        L, M, S = D(repr(L)), D(repr(M)), D(repr(S))
+        SD3neg, SD2neg, SD2pos, SD3pos = [stdev(L, M, S, sd)
+                                          for sd in [-3, -2, 2, 3]]
+        for column, value in zip(TAIL_COLUMNS, [
+                SD3neg, context.subtract(SD2neg, SD3neg),
+                SD3pos, context.subtract(SD3pos, SD2pos)]):
+            columns[column].append(float(value))
+    # read-only, like the other columns
+    return dict((column, memoryview(values.tobytes()).cast('d'))
+                for column, values in columns.items())
+
+
+def sources_digest(file_names=None):
+    """ SHA-256 digest of the JSON source tables """
+    import hashlib
+    digest = hashlib.sha256()
+    for file_name in file_names or WHO_TABLES + CDC_TABLES:
+        digest.update(file_name.encode('ascii') + b'\0')
+        with open(os.path.join(table_dir, file_name), 'rb') as f:
+            digest.update(f.read())
+    return digest.digest()
+
+
+def load_json(file_name):
+    """ Load a table from its JSON source """
+    import json
+    name = table_name(file_name)
+    with open(os.path.join(table_dir, file_name), 'r') as f:
+        list_of_dicts = json.load(f)
+    for field_name in KEY_FIELDS:
+        if field_name in list_of_dicts[0]:
+            break
+    else:
+        raise exceptions.DataError('error loading: %s' % name)
+
+    # rows are keyed by their field, and later duplicates replace earlier
+    # ones (e.g., lhfa 0-5 tables have a length and a height row for
+    # 24 months, and the height row is used), which are kept as the
+    # table's replaced rows (see Table.days)
+    rows, replaced = {}, {}
+    for d in list_of_dicts:
+        key = D(d[field_name])
+        if key in rows:
+            replaced[key] = rows[key]
+        rows[key] = d
+    keys = sorted(rows)
+    step = keys[1] - keys[0]
+    table = rows_table(name, field_name, rows, step)
+    if replaced:
+        table.replaced = rows_table(name + REPLACED, field_name, replaced,
+                                    step)
+    return table
+
+
+def rows_table(name, field_name, rows, step):
+    """ Return a Table of a dict of keys and rows (dicts of strings) """
+    keys = sorted(rows)
+    start = keys[0]
+    if keys != [start + step * i for i in range(len(keys))]:
+        raise exceptions.DataError('uneven keys in: %s' % name)
+    # columns are read-only, like those of the compiled tables
+    columns = dict((column, memoryview(array.array(
+        'd', [float(rows[key][column]) for key in keys]).tobytes()).cast('d'))
+                   for column in SOURCE_COLUMNS)
+    columns.update(tail_columns(columns['L'], columns['M'], columns['S']))
+    return Table(name, field_name, float(start), float(step), columns)
+
+
+def compile_tables(path=compiled_path, file_names=None):
+    """ Compile JSON source tables into a single binary file """
+    file_names = file_names or WHO_TABLES + CDC_TABLES
+    tables = []
+    for file_name in file_names:
+        table = load_json(file_name)
+        tables.append(table)
+        if table.replaced is not None:
+            tables.append(table.replaced)
+
+    offset = (HEADER.size + COLUMN_NAME.size * len(COLUMNS) +
+              ENTRY.size * len(tables))
+    entries, data = [], []
+    for table in tables:
+        entries.append(ENTRY.pack(table.name.encode('ascii'),
+                                  table.field_name.encode('ascii'),
+                                  table.start, table.step, len(table), 0,
+                                  offset))
+        for column in COLUMNS:
+            values = array.array('d', table.columns[column])
+            if sys.byteorder != 'little':
+                values.byteswap()
+            data.append(values.tobytes())
+            offset += len(values) * values.itemsize
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(COLUMNS),
+                            sources_digest(file_names), len(tables)))
+        for column in COLUMNS:
+            f.write(COLUMN_NAME.pack(column.encode('ascii')))
+        f.write(b''.join(entries))
+        f.write(b''.join(data))
+
+
+class CompiledTables(object):
+    """ A memory-mapped compiled tables file.
+
+    Only the header and table index are read when the file is opened;
+    each table's columns are views of the mapped file. If verify is True,
+    raise DataError if the JSON sources have changed since the file
+    was compiled. """
+
+    def __init__(self, path=compiled_path, verify=False):
+        self.path = path
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(mapped)
+        try:
+            magic, version, column_count, self.digest, table_count =\
+                HEADER.unpack_from(self.buf, 0)
+        except struct.error:
+            raise exceptions.DataError('error loading: %s' % path)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise exceptions.DataError('unsupported tables file: %s' % path)
+        if verify and self.digest != sources_digest():
+            raise exceptions.DataError('compiled tables are out of date: %s'
+                                       % path)
+
+        position = HEADER.size
+        self.columns = []
+        for i in range(column_count):
+            column, = COLUMN_NAME.unpack_from(self.buf, position)
+            self.columns.append(column.rstrip(b'\0').decode('ascii'))
+            position += COLUMN_NAME.size
+
+        self.index = {}
+        for i in range(table_count):
+            entry = ENTRY.unpack_from(self.buf, position)
+            position += ENTRY.size
+            self.index[entry[0].rstrip(b'\0').decode('ascii')] = entry
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def table(self, name):
+        """ Return a table by name """
+        name_, field_name, start, step, rows, reserved, offset =\
+            self.index[name]
+        columns = {}
+        for column in self.columns:
+            data = self.buf[offset:offset + rows * 8]
+            if sys.byteorder == 'little':
+                values = data.cast('d')
+            else:
+                values = array.array('d', data.tobytes())
+                values.byteswap()
+            columns[column] = values
+            offset += rows * 8
+        replaced = None
+        if name + REPLACED in self.index:
+            replaced = self.table(name + REPLACED)
+        return Table(name, field_name.rstrip(b'\0').decode('ascii'),
+                     start, step, columns, replaced)
+
+
+class Registry(object):
+    """ Tables loaded once per process and shared, read-only, by every
+    Calculator.
+
+    Each table is loaded the first time it is requested, from the
+    compiled tables file if possible and otherwise from its JSON source.
+    """
+
+    def __init__(self, path=compiled_path):
+        self.path = path
+        # opened on first use (False if it could not be opened)
+        self.compiled = None
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.tables
+
+    def get(self, name):
+        """ Return a table by name (e.g., wfa_boys_0_5) """
+        table = self.tables.get(name)
+        if table is None:
+            with self.lock:
+                table = self.tables.get(name)
+                if table is None:
+                    table = self.tables[name] = self.load(name)
+        return table
+
+    def load(self, name):
+        self.open()
+        if self.compiled and name in self.compiled:
+            return self.compiled.table(name)
+        return load_json(TABLE_FILES[name])
+
+    def open(self):
+        """ Open the compiled tables file, if it has not been opened """
+        if self.compiled is None:
+            try:
+                self.compiled = CompiledTables(self.path)
+            except (IOError, OSError, exceptions.DataError) as e:
+                logging.getLogger('pygrowup').warning(
+                    'loading JSON tables (%s: %s)' % (e.__class__.__name__, e))
+                self.compiled = False
+
+    def handle(self):
+        """ Return the path of a compiled tables file with every table,
+        which other processes can memory-map (see attach) so that all of
+        them share one copy of the tables.
+
+        If this registry cannot load tables from a compiled file (e.g.,
+        it is missing), the JSON tables are compiled into a temporary
+        file (removed when this process exits), which this registry then
+        loads its tables from too. """
+        import tempfile
+        with self.lock:
+            self.open()
+            if not self.compiled or any(name not in self.compiled
+                                        for name in TABLE_FILES):
+                fd, path = tempfile.mkstemp(prefix='pygrowup-',
+                                            suffix='.bin')
+                os.close(fd)
+                atexit.register(remove, path)
+                compile_tables(path)
+                self.path = path
+                self.compiled = CompiledTables(path)
+            return self.path
+
+    def version(self):
+        """ Return a string which identifies the tables this registry
+        loads (the digest of their JSON sources, and the compiled tables
+        format), e.g., to invalidate z-scores calculated with other
+        tables (see cache.SQLiteCache) """
+        with self.lock:
+            self.open()
+            digest = self.compiled.digest if self.compiled else \
+                sources_digest()
+        return '%s-%d' % (digest.hex(), FORMAT_VERSION)
+
+    def attach(self, path):
+        """ Load tables from the compiled tables file at path (e.g., the
+        handle of another process's registry) from now on """
+        with self.lock:
+            if path != self.path:
+                self.path = path
+                self.compiled = None
+                self.tables = {}
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+registry = Registry()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='compile WHO/CDC JSON tables into %s' % compiled_path)
+    parser.add_argument('--check', action='store_true',
+                        help='only check that the compiled tables are '
+                             'up to date with the JSON sources')
+    args = parser.parse_args()
+    if args.check:
+        try:
+            CompiledTables(verify=True)
+        except (IOError, OSError, exceptions.DataError) as e:
+            sys.exit(str(e))
+    else:
+        compile_tables()
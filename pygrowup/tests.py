@@ -1,13 +1,19 @@
 import logging
+import math
 import os
 import csv
 import codecs
+import datetime
+import json
+import tempfile
+import subprocess
+import sys
 from decimal import Decimal as D
 
 import nose
 
 from . import pygrowup
-from six.moves import zip
+from . import tablestore
 
 
 class WHOResult(object):
@@ -80,7 +86,7 @@ def test_generator():
     # software uses error-prone floating-point calculations
     module_dir = os.path.split(os.path.abspath(__file__))[0]
     test_file = os.path.join(module_dir, 'testdata', 'survey_z_rc.csv')
-    csvee = codecs.open(test_file, "rU", encoding='utf-8', errors='ignore')
+    csvee = codecs.open(test_file, "r", encoding='utf-8', errors='ignore')
 
     reader = csv.reader(csvee, dialect="excel")
     # skip column labels
@@ -120,5 +126,1280 @@ def test_bmifa_bug():
                                                              3.1, 'F', 50)
     assert should_use_bmifa_girls_0_2 == D('7.41')
 
+
+def survey_rows():
+    module_dir = os.path.split(os.path.abspath(__file__))[0]
+    test_file = os.path.join(module_dir, 'testdata', 'survey_z_rc.csv')
+    with codecs.open(test_file, "r", encoding='utf-8', errors='ignore') as f:
+        reader = csv.reader(f, dialect="excel")
+        # skip column labels
+        next(reader)
+        for row in reader:
+            if row[0] in ["287", "381"]:
+                continue
+            yield row
+
+
+def test_batch_zscores():
+    # vectorized results should match the scalar path to the hundredth
+    calc = pygrowup.Calculator(include_cdc=True, adjust_weight_scores=True)
+    for indicator in ["lhfa", "wfl", "wfh", "wfa", "bmifa"]:
+        whos = [WHOResult(indicator, row) for row in survey_rows()]
+        whos = [who for who in whos if who.measurement and who.gender]
+        if indicator in ["wfl", "wfh"]:
+            whos = [who for who in whos if who.height]
+        batch = calc.zscores(indicator, [who.measurement for who in whos],
+                             [who.age for who in whos],
+                             [who.gender for who in whos],
+                             [who.height for who in whos])
+        for who, batch_result in zip(whos, batch):
+            try:
+                our_result = calc.zscore_for_measurement(
+                    indicator, who.measurement, who.age, who.gender,
+                    who.height)
+            except RuntimeError:
+                assert math.isnan(batch_result)
+                continue
+            assert abs(float(our_result) - batch_result) <= 0.01
+
+
+def test_all_zscores():
+    # one pass gives the z-scores of separate calls
+    calc = pygrowup.Calculator(adjust_weight_scores=True, log_level='ERROR')
+    rows = [WHOResult('wfa', row) for row in survey_rows()]
+    rows = [who for who in rows if who.gender and who.age]
+    for who in rows:
+        weight, height = who.weight or None, who._height or None
+        head = who.head or None
+        zscores = calc.all_zscores(weight, height, head, who.age,
+                                   who.gender)
+        expected = {}
+        measurements = [("lhfa", height), ("wfa", weight), ("hcfa", head)]
+        if weight and height:
+            measurements.append(
+                ("wfl" if D(who.age) < 24 else "wfh", weight))
+            measurements.append(("bmifa", D(weight) / (D(height) / 100) ** 2))
+        for indicator, measurement in measurements:
+            if measurement is None:
+                continue
+            try:
+                expected[indicator] = calc.zscore_for_measurement(
+                    indicator, measurement, who.age, who.gender, height)
+            except RuntimeError:
+                expected[indicator] = None
+        assert zscores == expected, (who, zscores, expected)
+
+    try:
+        import numpy as np
+    except ImportError:
+        raise nose.SkipTest("numpy is not installed")
+    batch = calc.all_zscores_batch(
+        [who.weight for who in rows], [who._height for who in rows],
+        [who.head for who in rows], [who.age for who in rows],
+        [who.gender for who in rows])
+    assert sorted(batch) == ["bmifa", "hcfa", "lhfa", "wfa", "wfh", "wfl"]
+    for i, who in enumerate(rows):
+        zscores = calc.all_zscores(who.weight or None, who._height or None,
+                                   who.head or None, who.age, who.gender)
+        for indicator, values in batch.items():
+            zscore = zscores.get(indicator)
+            if zscore is None:
+                assert np.isnan(values[i])
+            else:
+                assert abs(float(zscore) - values[i]) <= 0.01
+
+
+def test_batch_zscores_invalid_rows():
+    calc = pygrowup.Calculator()
+    result = calc.zscores('wfl', ['8.0', '', '-1', '8.0', '8.0'],
+                          [9, 9, 9, 9, 9], ['M', 'M', 'M', 'X', 'F'],
+                          [69.5, 69.5, 69.5, 69.5, 30])
+    assert result[0] == float(calc.wfl('8.0', 9, 'M', 69.5))
+    assert all(math.isnan(z) for z in result[1:])
+
+
+def test_compiled_tables():
+    # compiled tables must be rebuilt (python -m pygrowup.tablestore)
+    # whenever the JSON tables change
+    compiled = tablestore.CompiledTables(verify=True)
+    for file_name in tablestore.WHO_TABLES + tablestore.CDC_TABLES:
+        table = tablestore.load_json(file_name)
+        compiled_table = compiled.table(table.name)
+        assert compiled_table.field_name == table.field_name
+        assert compiled_table.start == table.start
+        assert compiled_table.step == table.step
+        for column in tablestore.COLUMNS:
+            # (as bytes, since tail columns may hold NaN)
+            assert (compiled_table.columns[column].tobytes() ==
+                    table.columns[column].tobytes())
+        if table.replaced is None:
+            assert compiled_table.replaced is None
+        else:
+            assert (compiled_table.replaced.M.tobytes() ==
+                    table.replaced.M.tobytes())
+
+
+def test_table_rows():
+    calc = pygrowup.Calculator()
+    assert calc.wfl_boys_0_2.get('60.5')['M'] == '6.1284'
+    assert calc.wfl_boys_0_2.get('60.25') is None
+    assert calc.wfl_boys_0_2.get('44.5') is None
+    # the later of the two 24 month rows (height) is used
+    assert calc.lhfa_boys_0_5.get('24')['M'] == '87.1161'
+    assert calc.lhfa_boys_0_5.replaced.get('24')['M'] == '87.8161'
+    assert calc.wfa_boys_0_5.replaced is None
+
+
+def test_tail_columns():
+    # the measurements at +/- 3 z-scores and the distances to those at
+    # +/- 2, for the restricted application of the LMS method
+    for name in ['wfa_boys_0_5', 'wfl_girls_0_2', 'wfa_girls_0_5_days']:
+        if name.endswith('_days'):
+            table = tablestore.registry.get(name[:-len('_days')]).days()
+        else:
+            table = tablestore.registry.get(name)
+        SD3neg, SD23neg, SD3pos, SD23pos = table.tails()
+        for i in range(0, len(table), 7):
+            L, M, S = table.L[i], table.M[i], table.S[i]
+            for value, expected in [
+                    (SD3neg[i], tablestore.measurement_at(L, M, S, -3)),
+                    (SD23neg[i], tablestore.measurement_at(L, M, S, -2) -
+                     tablestore.measurement_at(L, M, S, -3)),
+                    (SD3pos[i], tablestore.measurement_at(L, M, S, 3)),
+                    (SD23pos[i], tablestore.measurement_at(L, M, S, 3) -
+                     tablestore.measurement_at(L, M, S, 2))]:
+                # (float arithmetic loses digits when L is near 0)
+                assert abs(value - expected) < 1e-9 * expected
+    # source rows do not include them
+    assert 'SD3pos_c' not in tablestore.registry.get('wfa_boys_0_5').row(0)
+    # z-scores above 3 and below -3
+    calc = pygrowup.Calculator(adjust_weight_scores=True)
+    table = calc.wfa_boys_0_5
+    SD3neg, SD23neg, SD3pos, SD23pos = table.tails()
+    assert calc.wfa(SD3pos[9] + SD23pos[9], 9, 'M') == D('4.00')
+    assert calc.wfa(SD3neg[9] - SD23neg[9] / 2, 9, 'M') == D('-3.50')
+
+
+def test_lazy_tables():
+    registry = tablestore.Registry()
+    assert 'wfa_boys_0_5' not in registry
+    table = registry.get('wfa_boys_0_5')
+    assert 'wfa_boys_0_5' in registry
+    assert 'lhfa_boys_0_5' not in registry
+    assert registry.get('wfa_boys_0_5') is table
+    # without a compiled tables file, tables are loaded from JSON
+    json_registry = tablestore.Registry(path=os.devnull + '.missing')
+    json_table = json_registry.get('wfa_boys_0_5')
+    assert list(json_table.columns['M']) == list(table.columns['M'])
+
+
+def test_pickling():
+    import pickle
+    # calculators pickle to their settings and a handle to the tables
+    calc = pygrowup.Calculator(engine='float', cache_size=10,
+                               log_level='ERROR')
+    calc.load_tables()
+    data = pickle.dumps(calc)
+    assert len(data) < 1024
+    copy = pickle.loads(data)
+    assert copy.engine == 'float' and copy.cache_info().currsize == 0
+    assert copy.wfa('8.0', 9, 'M') == calc.wfa('8.0', 9, 'M')
+    # which a new process maps rather than reading the tables itself
+    script = ("import sys, pickle; from pygrowup import tablestore; "
+              "calc = pickle.loads(sys.stdin.buffer.read()); "
+              "calc.load_tables(); "
+              "print(tablestore.registry.path); "
+              "print(type(calc.wfa_boys_0_5.M.obj).__name__); "
+              "print(calc.wfa('8.0', 9, 'M'))")
+    output = subprocess.run(
+        [sys.executable, '-c', script], input=data, stdout=subprocess.PIPE,
+        check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert output.stdout.decode().split() == [
+        tablestore.registry.handle(), 'mmap', '-0.98']
+
+    # tables loaded from JSON are compiled to a temporary file to share
+    registry = tablestore.Registry(path=os.devnull + '.missing')
+    table = registry.get('wfa_boys_0_5')
+    handle = registry.handle()
+    assert handle != tablestore.compiled_path and os.path.exists(handle)
+    attached = tablestore.Registry()
+    attached.attach(handle)
+    assert (attached.get('wfa_boys_0_5').M.tobytes() ==
+            table.M.tobytes())
+    assert attached.compiled.path == handle
+
+
+def test_shared_tables():
+    # every calculator uses the same, process-wide tables
+    calc = pygrowup.Calculator()
+    other_calc = pygrowup.Calculator(adjust_weight_scores=True)
+    assert calc.table('wfa_boys_0_5') is other_calc.table('wfa_boys_0_5')
+    assert calc.wfa_boys_0_5 is tablestore.registry.get('wfa_boys_0_5')
+    assert 'wfa_boys_0_5' not in calc.__dict__
+    # CDC tables are only available with include_cdc
+    assert not hasattr(calc, 'wfa_boys_2_20')
+    try:
+        calc.bmifa(16, 61, 'M')
+    except pygrowup.exceptions.DataNotFound:
+        pass
+    else:
+        assert False
+    assert hasattr(pygrowup.Calculator(include_cdc=True), 'wfa_boys_2_20')
+
+
+def test_light_import():
+    script = ("import sys, pygrowup; "
+              "print(','.join(sorted(m for m in ['six', 'json', 'decimal'] "
+              "if m in sys.modules)))")
+    output = subprocess.check_output(
+        [sys.executable, '-c', script],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert output.strip() == b''
+
+
+def test_routing():
+    from . import batch, routing
+    routes = routing.ROUTES
+    assert routes[('wfl', 'M', False, routing.STANDING)][3:5] == (
+        'wfh_boys_2_5', 'too long for recumbent')
+    assert routes[('wfa', 'F', False, routing.WEEKS)].table_name == \
+        'wfa_girls_0_13'
+    assert routes[('wfa', 'F', False, routing.TO_60)].table_name == \
+        'wfa_girls_0_5'
+    assert routes[('wfa', 'F', True, routing.TO_60)].table_name == \
+        'wfa_girls_2_20'
+    assert routes[('hcfa', 'F', True, routing.TO_60)].error is \
+        pygrowup.exceptions.InvalidAge
+    assert routes[('bmifa', 'M', False, routing.TO_240)].table_name == \
+        'bmifa_boys_2_20'
+    # array buckets match scalar buckets
+    ages = ['-1', '0', '2.98', '2.99', '3', '23.99', '24', '60', '60.01',
+            '240', '240.01']
+    buckets = batch.age_buckets(batch.as_float_array(ages),
+                                batch.as_float_array(ages) * 30.4374 / 7)
+    for age, bucket in zip(ages, buckets):
+        obs = pygrowup.Observation('wfa', '5', age, 'M', None, False,
+                                   'pygrowup')
+        assert bucket == routing.age_bucket(obs.age, obs.age_in_weeks)
+    for indicator in ['wfl', 'wfh']:
+        heights = ['64.9', '65', '86', '86.1']
+        bands = batch.height_bands(indicator, batch.as_float_array(heights))
+        assert list(bands) == [routing.height_band(indicator, D(height))
+                               for height in heights]
+
+
+def test_age_in_days():
+    calc = pygrowup.Calculator(age_in_days=True)
+    months = pygrowup.Calculator()
+    # rows at whole weeks and months are used as they are
+    # (0.95 months is 4.13 weeks)
+    assert calc.wfa('5.0', 28, 'F') == months.wfa('5.0', '0.95', 'F')
+    assert calc.wfa('8.0', 274, 'M') == months.wfa('8.0', 9, 'M')
+    table = calc.table('wfa_boys_0_5').days()
+    assert (table.start, len(table)) == (0, 1857)
+    # and rows between them are interpolated
+    assert months.wfa('8.0', 10, 'M') < calc.wfa('8.0', 290, 'M') < \
+        months.wfa('8.0', 9, 'M')
+    try:
+        calc.wfa('8.0', 1857, 'M')
+    except pygrowup.exceptions.DataNotFound:
+        pass
+    else:
+        assert False
+
+    # the survey's z-scores were calculated with ages in days
+    exact = {True: 0, False: 0}
+    for row in survey_rows():
+        who = WHOResult('wfa', row)
+        if not who.measurement or not who.gender or not who.result:
+            continue
+        ages = [who.agedays, who.agemons]
+        for age_in_days, age in zip([True, False], ages):
+            zscore = pygrowup.Calculator(age_in_days=age_in_days).wfa(
+                who.measurement, age, who.gender)
+            exact[age_in_days] += zscore == D(who.result)
+        zscore = calc.zscores('wfa', [who.measurement], [who.agedays],
+                              [who.gender])[0]
+        assert zscore == float(calc.wfa(who.measurement, who.agedays,
+                                        who.gender))
+    assert exact[True] > 400 > 100 > exact[False]
+
+    # days under 24 months are interpolated toward the length row for 24
+    # months, not the height row which replaces it
+    table = calc.table('lhfa_boys_0_5')
+    assert table.replaced.get('24')['M'] == '87.8161'
+    days = table.days()
+    assert table.M[24] < days.M[725] < 87.8161
+    assert days.M[731] < table.M[25]
+    near = 0
+    for row in survey_rows():
+        who = WHOResult('lhfa', row)
+        if who.gender and who.result and 700 <= int(who.agedays) <= 730:
+            near += 1
+            assert calc.lhfa(who.clenhei, who.agedays, who.gender) == \
+                D(who.result), who
+    assert near > 5
+
+
+def test_table_positions():
+    calc = pygrowup.Calculator()
+    table, index = pygrowup.Observation(
+        'wfl', '8.0', 9, 'M', '60.75', False, 'pygrowup').get_row(calc)
+    assert table.name == 'wfl_boys_0_2'
+    assert table.row(index)['Length'] == '61.0'
+    table, index = pygrowup.Observation(
+        'wfa', '8.0', 2, 'M', None, False, 'pygrowup').get_row(calc)
+    assert (table.name, index) == ('wfa_boys_0_13', 8)
+    table, index = pygrowup.Observation(
+        'wfa', '8.0', '11.9', 'F', None, False, 'pygrowup').get_row(calc)
+    assert (table.name, index) == ('wfa_girls_0_5', 11)
+    for args, error in [(('wfl', '8.0', 9, 'M', '44.7'), 'too short'),
+                        (('wfh', '8.0', 30, 'M', '120.3'), 'too tall'),
+                        (('wfa', '8.0', 61, 'M'), 'BY MONTH'),
+                        (('lhfa', '80', -1, 'M'), 'BY WEEK')]:
+        try:
+            calc.zscore_for_measurement(*args)
+        except (pygrowup.exceptions.InvalidMeasurement,
+                pygrowup.exceptions.DataNotFound) as e:
+            assert error in str(e)
+        else:
+            assert False, args
+
+
+def band(zscore):
+    if zscore < -3:
+        return pygrowup.BELOW_3SD
+    if zscore < -2:
+        return pygrowup.BELOW_2SD
+    if zscore > 3:
+        return pygrowup.ABOVE_3SD
+    if zscore > 2:
+        return pygrowup.ABOVE_2SD
+    return pygrowup.NORMAL
+
+
+def test_classify():
+    # classifications must agree with the calculated z-scores
+    for adjust_weight_scores in [False, True]:
+        calc = pygrowup.Calculator(include_cdc=True,
+                                   adjust_weight_scores=adjust_weight_scores)
+        for indicator in ["lhfa", "wfl", "wfh", "wfa", "bmifa"]:
+            whos = [WHOResult(indicator, row) for row in survey_rows()]
+            whos = [who for who in whos if who.measurement and who.gender]
+            if indicator in ["wfl", "wfh"]:
+                whos = [who for who in whos if who.height]
+            # scale measurements to populate every band
+            measurements = []
+            for who in whos:
+                for scale in ['0.6', '0.75', '0.85', '1', '1.15', '1.3']:
+                    measurements.append(str(D(who.measurement) * D(scale)))
+            whos = [who for who in whos for scale in range(6)]
+            batch = calc.classify_batch(indicator, measurements,
+                                        [who.age for who in whos],
+                                        [who.gender for who in whos],
+                                        [who.height for who in whos])
+            for who, measurement, batch_result in zip(whos, measurements,
+                                                      batch):
+                try:
+                    zscore = calc.zscore_for_measurement(
+                        indicator, measurement, who.age, who.gender,
+                        who.height)
+                except RuntimeError:
+                    assert math.isnan(batch_result)
+                    continue
+                result = calc.classify(indicator, measurement, who.age,
+                                       who.gender, who.height)
+                assert result == band(zscore), (who, measurement, zscore)
+                assert batch_result == result
+
+
+def test_classify_rounding():
+    calc = pygrowup.Calculator()
+    table = calc.table('lhfa_boys_0_5')
+    # lhfa is normally distributed (L is 1), so a measurement just under
+    # 2.005 SDs below the median has a z-score of -2.00
+    M, S = D(repr(table.M[12])), D(repr(table.S[12]))
+    measurement = M - D('2.0049') * M * S
+    assert calc.lhfa(measurement, 12, 'M') == D('-2.00')
+    assert calc.classify('lhfa', measurement, 12, 'M') == pygrowup.NORMAL
+    measurement = M - D('2.0051') * M * S
+    assert calc.lhfa(measurement, 12, 'M') == D('-2.01')
+    assert calc.classify('lhfa', measurement, 12, 'M') == pygrowup.BELOW_2SD
+
+
+def test_float_engine_parity():
+    # the float engine must round to the same hundredths as the
+    # decimal engine for every row of every table...
+    for adjust_weight_scores in [False, True]:
+        decimal_calc = pygrowup.Calculator(
+            include_cdc=True, adjust_weight_scores=adjust_weight_scores)
+        float_calc = pygrowup.Calculator(
+            include_cdc=True, adjust_weight_scores=adjust_weight_scores,
+            engine='float')
+        for name in tablestore.TABLE_FILES:
+            indicator = name.split('_')[0]
+            table = decimal_calc.table(name)
+            for index in range(len(table)):
+                row = table.row(index)
+                measurements = [row[column] for column in
+                                ['SD3neg', 'SD2neg', 'SD1neg', 'SD0', 'SD1',
+                                 'SD2', 'SD3']]
+                # ...including the tails
+                measurements.append(str(D(row['SD3neg']) * D('0.85')))
+                measurements.append(str(D(row['SD3']) * D('1.15')))
+                for measurement in measurements:
+                    expected = decimal_calc._decimal_zscore(
+                        indicator, D(measurement), table, index)
+                    result = float_calc._float_zscore(
+                        indicator, float(measurement), table, index)
+                    assert D(repr(result)) == expected, (name, measurement)
+
+    # ...and for the survey data
+    for adjust_weight_scores in [False, True]:
+        decimal_calc = pygrowup.Calculator(
+            include_cdc=True, adjust_weight_scores=adjust_weight_scores)
+        float_calc = pygrowup.Calculator(
+            include_cdc=True, adjust_weight_scores=adjust_weight_scores,
+            engine='float')
+        for row in survey_rows():
+            for indicator in ["lhfa", "wfl", "wfh", "wfa", "bmifa"]:
+                who = WHOResult(indicator, row)
+                if not who.measurement:
+                    continue
+                if indicator in ["wfl", "wfh"] and not who.height:
+                    continue
+                expected = decimal_calc.zscore_for_measurement(
+                    indicator, who.measurement, who.age, who.gender,
+                    who.height)
+                result = float_calc.zscore_for_measurement(
+                    indicator, who.measurement, who.age, who.gender,
+                    who.height)
+                assert isinstance(result, float)
+                assert D(repr(result)) == expected, (who, result, expected)
+
+
+def test_precision_tiers():
+    import decimal
+    # the fast precision tier must round to the same hundredths as the
+    # exact tier for every row of every table, including the tails...
+    for adjust_weight_scores in [False, True]:
+        exact = pygrowup.Calculator(
+            include_cdc=True, adjust_weight_scores=adjust_weight_scores)
+        fast = pygrowup.Calculator(
+            include_cdc=True, adjust_weight_scores=adjust_weight_scores,
+            precision='fast')
+        for name in tablestore.TABLE_FILES:
+            indicator = name.split('_')[0]
+            table = exact.table(name)
+            for index in range(len(table)):
+                if not fast._working(table, index):
+                    continue
+                row = table.row(index)
+                measurements = [D(row[column]) for column in
+                                ['SD3neg', 'SD2neg', 'SD0', 'SD2', 'SD3']]
+                measurements.append(D(row['SD3neg']) * D('0.85'))
+                measurements.append(D(row['SD3']) * D('1.15'))
+                for y in measurements:
+                    with decimal.localcontext(exact.context):
+                        expected = exact._decimal_zscore(indicator, y, table,
+                                                         index)
+                    result = fast._working_zscore(indicator, y, table, index)
+                    assert result == expected, (name, y)
+
+    # ...and a tier with too little precision to rule out other
+    # hundredths calculates again in the exact tier, even when rounding
+    # down
+    with decimal.localcontext() as context:
+        context.rounding = decimal.ROUND_FLOOR
+        exact = pygrowup.Calculator(adjust_weight_scores=True,
+                                    log_level='ERROR')
+        rough = pygrowup.Calculator(adjust_weight_scores=True, precision=3,
+                                    log_level='ERROR')
+    for row in survey_rows():
+        for indicator in ["lhfa", "wfl", "wfh", "wfa", "bmifa"]:
+            who = WHOResult(indicator, row)
+            if not who.measurement:
+                continue
+            if indicator in ["wfl", "wfh"] and not who.height:
+                continue
+            try:
+                expected = exact.zscore_for_measurement(
+                    indicator, who.measurement, who.age, who.gender,
+                    who.height)
+            except RuntimeError as e:
+                expected = type(e)
+            try:
+                result = rough.zscore_for_measurement(
+                    indicator, who.measurement, who.age, who.gender,
+                    who.height)
+            except RuntimeError as e:
+                result = type(e)
+            assert result == expected, (who, result, expected)
+    # (the working precision is less than the exact tier's)
+    for precision in ['exacting', 0, 28]:
+        try:
+            pygrowup.Calculator(precision=precision)
+        except AssertionError:
+            pass
+        else:
+            assert False
+
+
+def test_cli():
+    from . import cli
+    module_dir = os.path.split(os.path.abspath(__file__))[0]
+    test_file = os.path.join(module_dir, 'testdata', 'survey_z_rc.csv')
+    calc = pygrowup.Calculator()
+    with tempfile.TemporaryDirectory() as tmp:
+        # sexes as words, and ages as dates of birth and visit dates
+        survey_file = os.path.join(tmp, 'survey.csv')
+        visit = datetime.date(2015, 6, 26)
+        with open(test_file) as f, open(survey_file, 'w') as survey:
+            reader = csv.DictReader(f)
+            writer = csv.DictWriter(survey, reader.fieldnames + ['dob',
+                                                                 'visit'])
+            writer.writeheader()
+            for row in reader:
+                row['GENDER'] = {'1': 'male', '2': 'female'}.get(
+                    row['GENDER'], '')
+                dob = visit - datetime.timedelta(days=int(row['_agedays']))
+                row['dob'] = dob.strftime('%d/%m/%Y')
+                row['visit'] = visit.strftime('%d%m%Y')
+                writer.writerow(row)
+
+        for fmt in ['csv', 'jsonl']:
+            input_file = survey_file
+            if fmt == 'jsonl':
+                input_file = os.path.join(tmp, 'survey.jsonl')
+                with open(survey_file) as f, open(input_file, 'w') as out:
+                    for row in csv.DictReader(f):
+                        out.write(json.dumps(row) + '\n')
+            output_file = os.path.join(tmp, 'scored.' + fmt)
+            cli.main([input_file, '-o', output_file, '-z', 'wfa=WEIGHT',
+                      '-z', 'wfl=WEIGHT', '--height', 'HEIGHT',
+                      '--dob', 'dob', '--visit-date', 'visit',
+                      '--sex', 'GENDER', '--chunk-size', '100', '--quiet'])
+            with open(output_file) as f:
+                if fmt == 'csv':
+                    rows = list(csv.DictReader(f))
+                else:
+                    rows = [json.loads(line) for line in f]
+            assert len(rows) == 498
+            for row in rows:
+                age = D(int(row['_agedays'])) / D('30.4375')
+                sex = row['GENDER'][:1].upper()
+                expected = {}
+                for indicator in ['wfa', 'wfl']:
+                    try:
+                        expected[indicator] = calc.zscore_for_measurement(
+                            indicator, row['WEIGHT'], age, sex,
+                            row['HEIGHT'] or None)
+                    except (RuntimeError, AssertionError):
+                        expected[indicator] = None
+                    result = row['%s_zscore' % indicator]
+                    if expected[indicator] is None:
+                        assert result in ['', None]
+                    else:
+                        assert D(str(result)) == expected[indicator]
+
+
+def test_cli_impossible_dates():
+    # impossible days of birth are clamped to the end of the month, and
+    # scored alike by both engines rather than stopping the run
+    from . import cli
+    with tempfile.TemporaryDirectory() as tmp:
+        input_file = os.path.join(tmp, 'dates.csv')
+        with open(input_file, 'w') as f:
+            f.write('weight,dob,sex\n8.0,30-02-2015,M\n8.0,31-04-2015,F\n'
+                    '8.0,28-02-2015,M\n8.0,x,F\n')
+        outputs = []
+        for engine in ['decimal', 'float']:
+            output_file = os.path.join(tmp, 'scored.csv')
+            cli.main([input_file, '-o', output_file, '-z', 'wfa=weight',
+                      '--dob', 'dob', '--sex', 'sex', '--reference-date',
+                      '2016-01-01', '--engine', engine, '--quiet'])
+            with open(output_file) as f:
+                outputs.append([row['wfa_zscore']
+                                for row in csv.DictReader(f)])
+        assert outputs[0] == outputs[1]
+        assert outputs[0][0] == outputs[0][2] != ''
+        assert outputs[0][1] != '' and outputs[0][3] == ''
+
+
+def test_cli_malformed_input():
+    # malformed rows are passed over rather than stopping the run
+    import io
+    from . import cli
+    args = ['-z', 'wfa=weight', '--age', 'age', '--sex', 'sex', '--quiet']
+    expected = str(pygrowup.Calculator().wfa('8.0', 9, 'M'))
+    with tempfile.TemporaryDirectory() as tmp:
+        output_file = os.path.join(tmp, 'scored')
+
+        def score(text, name):
+            input_file = os.path.join(tmp, name)
+            with open(input_file, 'w') as f:
+                f.write(text)
+            stderr, sys.stderr = sys.stderr, io.StringIO()
+            try:
+                cli.main([input_file, '-o', output_file] + args)
+                warnings = sys.stderr.getvalue()
+            finally:
+                sys.stderr = stderr
+            with open(output_file) as f:
+                return f.read(), warnings
+
+        # ragged rows keep their fields, without the extras
+        output, warnings = score('weight,age,sex\n8.0,9,M,extra\n8.0,9\n',
+                                 'ragged.csv')
+        assert output.splitlines() == ['weight,age,sex,wfa_zscore',
+                                       '8.0,9,M,' + expected, '8.0,9,,']
+        # a header alone is written as it is
+        output, warnings = score('weight,age,sex\n', 'header.csv')
+        assert output.splitlines() == ['weight,age,sex,wfa_zscore']
+        # lines which are not JSON objects are skipped, with a warning
+        output, warnings = score(
+            '{"weight": 8.0, "age": 9, "sex": "M"}\n{"weight": \n[1, 2]\n'
+            '3\n\n{"weight": 8.0, "age": 9, "sex": "M"}\n', 'rows.jsonl')
+        rows = [json.loads(line) for line in output.splitlines()]
+        assert [row['wfa_zscore'] for row in rows] == [float(expected)] * 2
+        assert [line.split(':')[0] for line in warnings.splitlines()] == \
+            ['skipping line 2', 'skipping line 3', 'skipping line 4']
+
+
+def test_batch_helpers():
+    try:
+        import numpy as np
+    except ImportError:
+        raise nose.SkipTest("numpy is not installed")
+    from . import helpers
+    dates = ['26-06-2015', '26/6/15', '260615', '2606', '31.04.2015',
+             '30-02-2015', '12345', '13-13-2015', 'x', '', None]
+    result, invalid = helpers.get_good_dates(dates)
+    assert list(invalid) == [False] * 6 + [True] * 5
+    assert [str(date) for date in result[:6]] == [
+        '2015-06-26', '2015-06-26', '2015-06-26', '2006-06-02',
+        '2015-04-30', '2015-02-28']
+    for date, value in zip(dates[:6], result):
+        delimiter = not date.isdigit()
+        assert (helpers.get_good_date(date, delimiter)[1] ==
+                value.astype(datetime.date))
+    assert all(np.isnat(result[6:]))
+
+    sexes, unknown = helpers.get_good_sexes(['male', 'F', 'Female', 'm',
+                                             'x', '', None])
+    assert list(sexes) == ['M', 'F', 'F', 'M', '', '', '']
+    assert list(unknown) == [False] * 4 + [True] * 3
+
+    on = datetime.date(2015, 6, 26)
+    ages, invalid = helpers.dates_to_ages(
+        ['26-06-2014', '01-01-2015', '01-01-2016', 'x'], on)
+    assert list(invalid) == [False, False, True, True]
+    assert ages[0] == 365 / 30.4375
+    assert int(ages[1]) == int(helpers.date_to_age_in_months(
+        datetime.date(2015, 1, 1), on))
+    assert np.isnan(ages[2:]).all()
+    days, invalid = helpers.dates_to_ages(
+        np.array(['2015-06-01', 'NaT'], dtype='datetime64[D]'),
+        ['26-06-2015', '26-06-2015'], in_days=True)
+    assert days[0] == 25 and list(invalid) == [False, True]
+
+
+def test_parallel():
+    from . import parallel
+    calc = pygrowup.Calculator(include_cdc=True)
+    observations = []
+    for row in survey_rows():
+        for indicator in ["lhfa", "wfl", "wfa", "bmifa"]:
+            who = WHOResult(indicator, row)
+            observations.append((indicator, who.measurement, who.age,
+                                 who.gender, who.height or None))
+    # errors are returned rather than raised
+    observations.append(('wfa', '-1', '9', 'M', None))
+    results = list(parallel.map_zscores(observations, calculator=calc,
+                                        workers=2, chunk_size=50))
+    assert len(results) == len(observations)
+    for observation, result in zip(observations, results):
+        try:
+            expected = calc.zscore_for_measurement(*observation)
+        except Exception as e:
+            assert result.zscore is None
+            assert type(result.error) is type(e)
+        else:
+            assert result == (expected, None)
+    assert isinstance(results[-1].error,
+                      pygrowup.exceptions.InvalidMeasurement)
+
+    # as are those of malformed indicators, with either engine
+    observations = [('wfa', '8.0', '9', 'M', None), (5, '8.0', '9', 'M', None),
+                    (['wfa'], '8.0', '9', 'M', None),
+                    ('WFA', '8.0', '9', 'M', None)]
+    for engine in ['decimal', 'float']:
+        calc = pygrowup.Calculator(engine=engine, log_level='ERROR')
+        results = parallel.score(calc, observations)
+        assert results[0] == (calc.wfa('8.0', '9', 'M'), None)
+        assert [type(result.error) for result in results[1:]] == \
+            [AssertionError, AssertionError,
+             pygrowup.exceptions.DataNotFound]
+        results = list(parallel.map_zscores(observations, calculator=calc,
+                                            workers=2, chunk_size=2))
+        assert [result.error is None for result in results] == \
+            [True, False, False, False]
+
+
+def test_prevalence():
+    import pickle
+    import random
+    import statistics
+    from . import benchmarks
+    from . import prevalence
+    # Welford's accumulators agree with two-pass statistics, and merge
+    rng = random.Random(0)
+    zscores = [rng.gauss(-1, 1.5) for i in range(1000)]
+    whole, first, second = [prevalence.Accumulator() for i in range(3)]
+    for zscore in zscores:
+        whole.add(zscore)
+    for zscore in zscores[:300]:
+        first.add(zscore)
+    for zscore in zscores[300:]:
+        second.add(zscore)
+    first.merge(second)
+    for accumulator in [whole, first]:
+        assert accumulator.count == 1000
+        assert abs(accumulator.mean - statistics.mean(zscores)) < 1e-12
+        assert abs(accumulator.sd - statistics.stdev(zscores)) < 1e-12
+        assert accumulator.below_2 == len([z for z in zscores if z < -2])
+        assert accumulator.below_3 == len([z for z in zscores if z < -3])
+
+    assert [prevalence.age_group(age) for age in [0, 5.9, 6, 23.5, 59,
+                                                  60, -1, None]] == \
+        ['0-5', '0-5', '6-11', '12-23', '48-59', '60+', None, None]
+
+    records = benchmarks.survey()
+    for i, record in enumerate(records):
+        record['region'] = ['North', 'South', 'East'][i % 3]
+    # implausible z-scores are flagged, and unusable records skipped
+    records.append({'sex': 'M', 'age': '12', 'weight': '30',
+                    'height': '75', 'region': 'North'})
+    records.append({'sex': 'unknown', 'age': '12', 'weight': '9',
+                    'region': 'North'})
+    records.append({'sex': 'F', 'age': None, 'weight': '9',
+                    'region': 'North'})
+    calc = pygrowup.Calculator(log_level='ERROR')
+    group_by = ['region', 'sex', 'age_group']
+    aggregator = prevalence.Aggregator(calc, group_by=group_by)
+    for record in records:
+        aggregator.add(record)
+    assert aggregator.skipped == 2
+    results = aggregator.results()
+    assert ('North', 'M', '12-23') in results
+    assert results[('North', 'M', '12-23')]['wfa']['flagged'] == 1
+
+    # the same as scoring every record and then aggregating...
+    expected = {}
+    for record in records[:-2]:
+        zscores = calc.all_zscores(record.get('weight'),
+                                   record.get('height'),
+                                   record.get('head_circumference'),
+                                   record['age'], record['sex'])
+        group = (record['region'], record['sex'],
+                 prevalence.age_group(float(record['age'])))
+        for indicator, zscore in zscores.items():
+            if zscore is None:
+                continue
+            indicator = 'wflh' if indicator in ['wfl', 'wfh'] else indicator
+            low, high = prevalence.FLAGS[indicator]
+            if low <= zscore <= high:
+                expected.setdefault((group, indicator), []).append(
+                    float(zscore))
+    for (group, indicator), zscores in expected.items():
+        result = results[group][indicator]
+        assert result['count'] == len(zscores)
+        assert abs(result['mean'] - statistics.mean(zscores)) < 1e-9
+        if len(zscores) > 1:
+            assert abs(result['sd'] - statistics.stdev(zscores)) < 1e-9
+        assert result['prevalence_below_2'] == \
+            len([z for z in zscores if z < -2]) / len(zscores)
+    assert aggregator.total()['lhfa']['count'] == sum(
+        len(zscores) for (group, indicator), zscores in expected.items()
+        if indicator == 'lhfa')
+
+    # ...in batches, and in parts (e.g., in worker processes) merged
+    merged = prevalence.Aggregator(calc, group_by=group_by)
+    for i in range(0, len(records), 100):
+        part = prevalence.Aggregator(calc, group_by=group_by)
+        part.add_many(records[i:i + 100])
+        merged.merge(pickle.loads(pickle.dumps(part)))
+    assert merged.skipped == 2
+    merged = merged.results()
+    assert set(merged) == set(results)
+    for group in results:
+        for indicator, result in results[group].items():
+            for name, value in result.items():
+                if value is None or merged[group][indicator][name] is None:
+                    assert merged[group][indicator][name] == value
+                else:
+                    assert abs(merged[group][indicator][name] - value) < \
+                        1e-9, (group, indicator, name)
+
+
+def test_cache():
+    import decimal
+    from . import cache
+    calc = pygrowup.Calculator(cache_size=2)
+    uncached = pygrowup.Calculator()
+    assert uncached.cache_info() is None
+    expected = uncached.wfa('8.0', 9, 'M')
+    assert calc.wfa('8.0', 9, 'M') == expected
+    # equal numbers share a key, and heights are ignored for wfa
+    assert calc.wfa(8, '9.0', 'm', height='70') == expected
+    assert calc.cache_info() == cache.CacheInfo(1, 1, 0, 2, 1)
+    calc.wfa('9.0', 9, 'M')
+    calc.wfa('10.0', 9, 'M')
+    assert calc.cache_info() == cache.CacheInfo(1, 3, 1, 2, 2)
+    # invalid observations still raise, and are not cached
+    for i in range(2):
+        try:
+            calc.wfa('-1', 9, 'M')
+        except pygrowup.exceptions.InvalidMeasurement:
+            pass
+        else:
+            assert False
+    assert calc.cache_info().currsize == 2
+
+    # calculators with different settings can share a cache
+    shared = cache.LRUCache(100)
+    plain = pygrowup.Calculator(cache=shared)
+    adjusted = pygrowup.Calculator(cache=shared, adjust_weight_scores=True)
+    assert plain.wfa('30', 9, 'M') == uncached.wfa('30', 9, 'M')
+    assert adjusted.wfa('30', 9, 'M') != plain.wfa('30', 9, 'M')
+    assert shared.info().currsize == 2
+    # as can calculators with different decimal contexts
+    with decimal.localcontext() as context:
+        context.rounding = decimal.ROUND_FLOOR
+        floor = pygrowup.Calculator(cache=shared)
+    assert plain.wfa('8.3', 9, 'M') == D('-0.64')
+    assert floor.wfa('8.3', 9, 'M') == D('-0.65')
+    assert shared.info().currsize == 4
+
+    # all_zscores shares the cache of zscore_for_measurement
+    calc = pygrowup.Calculator(cache_size=10)
+    zscores = calc.all_zscores('8.0', '70', '45', 9, 'M')
+    assert calc.cache_info() == cache.CacheInfo(0, 5, 0, 10, 5)
+    assert calc.wfl('8.0', 9, 'M', '70') == zscores['wfl']
+    assert calc.all_zscores('8.0', '70', '45', 9, 'M') == zscores
+    assert calc.cache_info() == cache.CacheInfo(6, 5, 0, 10, 5)
+
+
+def test_cache_threads():
+    import concurrent.futures
+    calc = pygrowup.Calculator(cache_size=50)
+    uncached = pygrowup.Calculator()
+    weights = ['%.1f' % (5 + i / 10.0) for i in range(100)]
+    expected = [uncached.wfa(weight, 9, 'M') for weight in weights]
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        for i in range(20):
+            results = list(executor.map(
+                lambda weight: calc.wfa(weight, 9, 'M'), weights))
+            assert results == expected
+    info = calc.cache_info()
+    assert info.hits + info.misses == 2000
+    assert info.currsize == 50
+    assert info.misses - info.evictions == info.currsize
+
+
+def test_sqlite_cache():
+    import pickle
+    from . import cache
+    uncached = pygrowup.Calculator()
+    expected = uncached.wfa('8.0', 9, 'M')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'zscores.db')
+        calc = pygrowup.Calculator(cache=cache.SQLiteCache(path))
+        assert calc.wfa('8.0', 9, 'M') == expected
+        # equal numbers share a key, and heights are ignored for wfa
+        assert calc.wfa(8, '9.0', 'm', height='70') == expected
+        assert calc.cache_info() == cache.CacheInfo(1, 1, 0, None, 1)
+        floats = pygrowup.Calculator(engine='float', cache=calc.cache)
+        assert floats.wfa('8.0', 9, 'M') == -0.98
+        calc.cache.close()
+
+        # z-scores are kept from one run to the next, as they were
+        reopened = cache.SQLiteCache(path)
+        assert len(reopened) == 2
+        keys = [calc._cache_key('wfa', '8.0', 9, 'M', None),
+                floats._cache_key('wfa', '8', 9, 'M', None), None,
+                calc._cache_key('wfa', '9.0', 9, 'M', None)]
+        values = reopened.get_many(keys)
+        assert values == [expected, -0.98, None, None]
+        assert isinstance(values[0], D) and isinstance(values[1], float)
+        assert reopened.info() == cache.CacheInfo(2, 1, 0, None, 2)
+        reopened.put_many([(keys[3], D('-0.12')), (keys[2], D('1')),
+                           (keys[0], None)])
+        assert len(reopened) == 3
+        # copies (e.g., for worker processes) open the same file
+        copy = pickle.loads(pickle.dumps(reopened))
+        assert copy.get(keys[3]) == D('-0.12')
+        reopened.close()
+        copy.close()
+
+        # and are discarded when the tables change
+        changed = cache.SQLiteCache(path, version='other')
+        assert len(changed) == 0
+        changed.put(keys[0], expected)
+        changed.clear()
+        assert changed.info() == cache.CacheInfo(0, 0, 0, None, 0)
+        changed.close()
+
+        # the command line reuses z-scores from earlier runs
+        from . import benchmarks
+        from . import cli
+        test_file = os.path.join(tmp, 'survey.csv')
+        with open(test_file, 'w') as f:
+            writer = csv.DictWriter(f, ['sex', 'age', 'weight', 'height',
+                                        'head_circumference', 'bmi'])
+            writer.writeheader()
+            writer.writerows(benchmarks.survey())
+        outputs = []
+        for option in [[], ['--cache', path], ['--cache', path]]:
+            output_file = os.path.join(tmp, 'scored.csv')
+            cli.main([test_file, '-o', output_file, '-z', 'wfa=weight',
+                      '-z', 'wfh=weight', '--height', 'height', '--age',
+                      'age', '--sex', 'sex', '--quiet'] + option)
+            with open(output_file) as f:
+                outputs.append(f.read())
+        assert outputs[0] == outputs[1] == outputs[2]
+        assert len(cache.SQLiteCache(path)) > 500
+
+
+def test_threads():
+    # one calculator serves many threads at once, each calculation in its
+    # own local decimal context, and gives the results of a single thread
+    import concurrent.futures
+    import decimal
+    import time
+    from . import benchmarks
+    observations = benchmarks.scale(benchmarks.survey(), 2)
+    rows = [(indicator,) + row for indicator in ["wfa", "wfl", "lhfa"]
+            for row in benchmarks.workload(observations, indicator)]
+    chunks = [rows[i:i + 100] for i in range(0, len(rows), 100)]
+
+    def score(calc, chunk):
+        results = []
+        for indicator, measurement, age, sex, height in chunk:
+            try:
+                results.append(calc.zscore_for_measurement(
+                    indicator, measurement, age, sex, height))
+            except RuntimeError as e:
+                results.append(type(e))
+        return results
+
+    def score_in_thread(calc, chunk):
+        # (a thread's own context must not change the results)
+        decimal.getcontext().prec = 4
+        decimal.getcontext().rounding = decimal.ROUND_FLOOR
+        return score(calc, chunk)
+
+    for engine in ['decimal', 'float']:
+        calc = pygrowup.Calculator(engine=engine, adjust_weight_scores=True,
+                                   log_level='ERROR')
+        expected = [result for chunk in chunks
+                    for result in score(calc, chunk)]
+        elapsed = {}
+        for threads in [1, 4]:
+            with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                started = time.perf_counter()
+                results = [result for results in executor.map(
+                    lambda chunk: score_in_thread(calc, chunk), chunks)
+                    for result in results]
+                elapsed[threads] = time.perf_counter() - started
+            assert results == expected
+        # throughput scales with threads where there is no GIL
+        # (e.g., python3.13t)
+        gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)()
+        if not gil_enabled and (os.cpu_count() or 1) >= 4:
+            assert elapsed[1] / elapsed[4] > 2, elapsed
+
+
+def test_instrumentation():
+    from . import instrumentation
+    instruments = instrumentation.Instruments()
+    calc = pygrowup.Calculator(instruments=instruments,
+                               adjust_weight_scores=True)
+    uncounted = pygrowup.Calculator(adjust_weight_scores=True)
+    assert calc.wfa('8.0', 9, 'M') == uncounted.wfa('8.0', 9, 'M')
+    assert calc.wfl('30', 9, 'M', '70') == uncounted.wfl('30', 9, 'M', '70')
+    try:
+        calc.wfa('-1', 9, 'M')
+    except pygrowup.exceptions.InvalidMeasurement:
+        pass
+    stats = instruments.as_dict()
+    assert sorted(stats) == ['wfa', 'wfl']
+    assert stats['wfa']['errors'] == 1
+    assert stats['wfl']['errors'] == 0
+    for stage in instrumentation.STAGES:
+        assert stats['wfl'][stage]['count'] == 1
+        assert stats['wfl'][stage]['seconds'] >= 0
+    text = instruments.prometheus()
+    assert ('pygrowup_stage_calls_total{indicator="wfa",stage="lms"} 1\n'
+            in text)
+    assert 'pygrowup_errors_total{indicator="wfa"} 1\n' in text
+    instruments.reset()
+    assert instruments.as_dict() == {}
+
+    # unknown indicators are counted together, and label values escaped
+    for indicator in ['x"y\n', 5, 'WFA']:
+        try:
+            calc.zscore_for_measurement(indicator, '8.0', 9, 'M')
+        except (AssertionError, pygrowup.exceptions.DataNotFound):
+            pass
+    assert instruments.as_dict() == {'invalid': {'errors': 2},
+                                     'wfa': {'errors': 1}}
+    instruments.record('a"b\\c\nd', 'lms', 1.0)
+    assert ('pygrowup_stage_calls_total{indicator="a\\"b\\\\c\\nd",'
+            'stage="lms"} 1\n' in instruments.prometheus())
+    instruments.reset()
+
+    # every engine and precision tier is timed, once per stage
+    for settings in [{'engine': 'float'}, {'precision': 'fast'},
+                     {'precision': 2}]:
+        instruments = instrumentation.Instruments()
+        calc = pygrowup.Calculator(instruments=instruments,
+                                   adjust_weight_scores=True, **settings)
+        uncounted = pygrowup.Calculator(adjust_weight_scores=True,
+                                        **settings)
+        for measurement in ['8.0', '30', '3']:
+            assert calc.wfa(measurement, 9, 'M') == \
+                uncounted.wfa(measurement, 9, 'M')
+        stats = instruments.as_dict()['wfa']
+        for stage in instrumentation.STAGES:
+            assert stats[stage]['count'] == 3, (settings, stats)
+
+    # as is all_zscores, by indicator
+    instruments = instrumentation.Instruments()
+    calc = pygrowup.Calculator(instruments=instruments)
+    calc.all_zscores('8.0', '70', '45', 9, 'M')
+    calc.all_zscores('8.5', '71', '46', 10, 'M')
+    calc.all_zscores(head_circumference='45', age_in_months=300, sex='M')
+    stats = instruments.as_dict()
+    assert sorted(stats) == ['bmifa', 'hcfa', 'lhfa', 'wfa', 'wfl']
+    assert stats['hcfa']['errors'] == 1
+    assert stats['wfa']['errors'] == 0
+    for stage in instrumentation.STAGES:
+        assert stats['wfa'][stage]['count'] == 2
+
+
+def test_lazy_debug_logging():
+    # debug messages are only formatted if debug logging is enabled
+    class Handler(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    handler = Handler()
+    calc = pygrowup.Calculator(logger_name='pygrowup.test_debug',
+                               log_level='DEBUG')
+    calc.logger.addHandler(handler)
+    calc.wfa('8.0', 9, 'M')
+    assert 'MEDIAN: 8.9014' in handler.messages
+    calc.logger.setLevel(logging.INFO)
+    handler.messages = []
+    calc.wfa('8.0', 9, 'M')
+    assert handler.messages == []
+
+
+def test_benchmarks():
+    from . import benchmarks
+    observations = benchmarks.survey()
+    scaled = benchmarks.scale(observations, 2)
+    assert len(scaled) == 2 * len(observations)
+    assert scaled == benchmarks.scale(observations, 2)
+    metrics = benchmarks.run(scale_by=1, repeat=1)
+    for indicator in benchmarks.INDICATORS:
+        assert metrics['scalar.decimal.%s' % indicator] > 0
+        assert metrics['scalar.float.%s' % indicator] > 0
+    assert metrics['memory.tables_bytes'] > 0
+    slower = dict(metrics, **{'startup.import': metrics['startup.import'] * 2})
+    assert benchmarks.compare(metrics, metrics) == []
+    regressions = benchmarks.compare(slower, metrics, threshold=0.5)
+    assert [name for name, before, after, ratio in regressions] == [
+        'startup.import']
+
+
+def test_async_calculator():
+    import asyncio
+    from . import aio
+    observations = []
+    for row in survey_rows():
+        for indicator in ["lhfa", "wfl", "wfa", "bmifa"]:
+            who = WHOResult(indicator, row)
+            observations.append((indicator, who.measurement, who.age,
+                                 who.gender or 'X', who.height or None))
+    observations.append(('wfa', '-1', '9', 'M', None))
+    observations.append(('WFA', '8', '9', 'M', None))
+
+    for engine in ['decimal', 'float']:
+        calc = pygrowup.Calculator(engine=engine, include_cdc=True,
+                                   log_level='ERROR')
+        async_calc = aio.AsyncCalculator(calc, max_batch_size=100)
+
+        async def score(observation):
+            try:
+                return await async_calc.zscore(*observation), None
+            except Exception as e:
+                return None, type(e)
+
+        async def score_all():
+            return await asyncio.gather(*[score(observation)
+                                          for observation in observations])
+
+        results = asyncio.run(score_all())
+        for observation, result in zip(observations, results):
+            try:
+                expected = calc.zscore_for_measurement(*observation), None
+            except Exception as e:
+                expected = None, type(e)
+            assert result == expected, (observation, result, expected)
+        assert async_calc.calls == len(observations)
+        # callers were coalesced into full batches
+        assert async_calc.batches == math.ceil(len(observations) / 100.0)
+
+    # a lone caller waits no longer than max_delay
+    async_calc = aio.AsyncCalculator(max_delay=0.01)
+
+    async def score_one():
+        return await async_calc.wfa('8.0', 9, 'M')
+    assert asyncio.run(score_one()) == pygrowup.Calculator().wfa(
+        '8.0', 9, 'M')
+    assert async_calc.batches == 1
+
+
+def test_server():
+    import http.client
+    import threading
+    from . import server
+    calc = pygrowup.Calculator(log_level='ERROR')
+    httpd = server.Server(('127.0.0.1', 0), calc)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    try:
+        connection = http.client.HTTPConnection(*httpd.server_address[:2])
+
+        def request(method, path, body=None):
+            if body is not None:
+                body = json.dumps(body)
+            connection.request(method, path, body)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+
+        expected = float(calc.wfa('8.0', 9, 'M'))
+        assert request('GET', '/zscore/wfa?measurement=8.0&age=9&sex=M') == \
+            (200, {'zscore': expected})
+        # (on the same connection)
+        sock = connection.sock
+        assert request('POST', '/zscore/wfl', {
+            'measurement': 8.0, 'age': 9, 'sex': 'M', 'height': 70}) == \
+            (200, {'zscore': float(calc.wfl('8.0', 9, 'M', '70'))})
+        assert connection.sock is sock
+        status, body = request('POST', '/zscore/wfa', {
+            'measurement': -1, 'age': 9, 'sex': 'M'})
+        assert status == 400
+        assert body['error'] == 'InvalidMeasurement'
+        assert request('GET', '/zscore/xyz')[0] == 404
+        assert request('POST', '/zscores', 'oops')[0] == 400
+
+        status, body = request('POST', '/zscores', {'observations': [
+            {'indicator': 'wfa', 'measurement': '8.0', 'age': 9, 'sex': 'M'},
+            {'indicator': 'wfa', 'measurement': '8.0', 'age': 9},
+            {'indicator': 'hcfa', 'measurement': '45', 'age': 9, 'sex': 'F'}]})
+        assert status == 200
+        results = body['results']
+        assert results[0] == {'zscore': expected}
+        assert results[1]['error'] == 'AssertionError'
+        assert results[2] == {'zscore': float(calc.hcfa('45', 9, 'F'))}
+        # malformed observations are errors of their own
+        status, body = request('POST', '/zscores', [
+            {'indicator': 5, 'measurement': '8.0', 'age': 9, 'sex': 'M'},
+            {'indicator': ['wfa'], 'measurement': '8.0', 'age': 9,
+             'sex': 'M'},
+            {'indicator': 'wfa', 'measurement': '8.0', 'age': 9, 'sex': 'M'}])
+        assert status == 200
+        assert [result.get('error') for result in body['results']] == \
+            ['AssertionError', 'AssertionError', None]
+
+        # (rather than waiting for the body)
+        connection.putrequest('POST', '/zscores')
+        connection.putheader('Content-Length', '-1')
+        connection.endheaders()
+        response = connection.getresponse()
+        assert response.status == 400
+        response.read()
+
+        # unexpected errors are still responded to, and counted
+        class Broken(object):
+            engine = 'decimal'
+
+            def zscore_for_measurement(self, *args):
+                raise LookupError('broken')
+        httpd.calculator = Broken()
+        try:
+            assert request('GET', '/zscore/wfa?measurement=8.0&age=9') == \
+                (500, {'error': 'LookupError', 'message': 'broken'})
+        finally:
+            httpd.calculator = calc
+
+        status, stats = request('GET', '/stats')
+        assert stats['requests'] == 9
+        assert stats['errors'] == 5
+        assert stats['observations'] == 9
+        assert set(stats['latency_ms']) == set(['p50', 'p90', 'p99', 'max'])
+        connection.close()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
+
+
+def test_dataframe():
+    try:
+        import pandas as pd
+        import pyarrow as pa
+    except ImportError:
+        raise nose.SkipTest("pandas and pyarrow are not installed")
+    import numpy as np
+    from . import dataframe
+    calc = pygrowup.Calculator(include_cdc=True)
+    whos = [WHOResult("wfl", row) for row in survey_rows()]
+    df = pd.DataFrame({'weight': [who.measurement for who in whos],
+                       'height': [who.height for who in whos],
+                       'age': [who.age for who in whos],
+                       'sex': [who.gender for who in whos]})
+    for column in ['weight', 'height', 'age']:
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    expected = calc.zscores('wfl', df.weight.tolist(), df.age.tolist(),
+                            df.sex.tolist(), df.height.tolist())
+    zscores = df.growup.zscore('wfl', weight='weight', height='height',
+                               age='age', sex='sex', calculator=calc)
+    assert zscores.name == 'wfl_zscore'
+    assert zscores.index.equals(df.index)
+    assert np.array_equal(zscores.to_numpy(), expected, equal_nan=True)
+    nullable = df.growup.zscore('wfl', weight='weight', height='height',
+                                age='age', sex='sex', calculator=calc,
+                                nullable=True)
+    assert str(nullable.dtype) == 'Float64'
+    assert nullable.isna().sum() == np.isnan(expected).sum()
+
+    table = pa.Table.from_pandas(df)
+    arrow = dataframe.arrow_zscore(table, 'wfl', weight='weight',
+                                   height='height', age='age', sex='sex',
+                                   calculator=calc)
+    assert arrow.null_count == np.isnan(expected).sum()
+    assert np.array_equal(arrow.to_numpy(zero_copy_only=False), expected,
+                          equal_nan=True)
+
+
 if __name__ == '__main__':
     nose.main()
@@ -21,13 +21,18 @@ setup(
     long_description=open('README').read(),
     url="http://github.com/ewheeler/pygrowup",
     download_url="https://github.com/ewheeler/pygrowup/archive/0.8.2.tar.gz",
-    install_requires=[
-        "six",
-    ],
+    python_requires=">=3.7",
+    entry_points={
+        "console_scripts": ["pygrowup = pygrowup.cli:main"],
+    },
+    extras_require={
+        "numpy": ["numpy"],
+        "pandas": ["numpy", "pandas"],
+        "arrow": ["numpy", "pyarrow"],
+    },
     classifiers=[
         'Intended Audience :: Healthcare Industry',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'License :: OSI Approved :: BSD License',
         'Topic :: Scientific/Engineering :: Bio-Informatics',